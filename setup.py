@@ -1,5 +1,4 @@
-import distutils
-from distutils.core import setup
+from setuptools import setup
 
 description = "A simple work queue that actually works."
 
@@ -10,7 +9,8 @@ setup(name="wq",
       author="Erin Scott Sheldon, Anze Slosar",
       author_email="erin.sheldon@gmail.com",
       scripts=["wq/wq"],
-      packages=['wq'])
+      packages=['wq'],
+      install_requires=['pyyaml','numpy'])
 
 
 
@@ -0,0 +1,160 @@
+"""
+The numpy engine against the python loops it replaces: random clusters,
+usage, offline nodes and blocked groups, and the same hosts from both.
+
+    python -m pytest tests
+"""
+import random
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from wq import server
+from wq import placement
+
+NSEEDS = 100
+NROUNDS = 20
+NQUERIES = 20
+
+def make_cluster(rng, tmpdir):
+    """
+    A cluster of up to 60 nodes in a random order, with random cores,
+    memory and groups
+    """
+    nnodes = rng.randint(1, 60)
+    ngroups = rng.randint(1, 8)
+    lines = []
+    for i in range(nnodes):
+        grps = rng.sample(range(ngroups), rng.randint(0, min(3, ngroups)))
+        lines.append('n%03d %d %d %s\n'
+                     % (i, rng.choice([1,2,4,8,12,16]), rng.randint(1,64),
+                        ','.join('g%d' % g for g in grps)))
+    rng.shuffle(lines)
+
+    fname = str(tmpdir.join('cluster.txt'))
+    with open(fname,'w') as fobj:
+        fobj.write(''.join(lines))
+    return server.Cluster(fname, engine='numpy'), ngroups
+
+def change_usage(rng, cluster):
+    """
+    Reserve and free cores and take nodes on and offline, through the nodes
+    so the arrays are told
+    """
+    nnodes = len(cluster.hostnames)
+    for h in rng.sample(cluster.hostnames, rng.randint(0, nnodes)):
+        nd = cluster.nodes[h]
+        if rng.random() < 0.1:
+            nd.set_online(not nd.online)
+        if rng.random() < 0.5 and nd.used < nd.ncores:
+            nd.reserve(rng.randint(1, nd.ncores-nd.used))
+        elif nd.used > 0:
+            nd.unreserve(rng.randint(1, nd.used))
+
+def random_candidates(rng, cluster, ngroups):
+    groups = []
+    notgroups = []
+    if rng.random() < 0.3:
+        groups = ['g%d' % rng.randrange(ngroups+1)
+                  for i in range(rng.randint(1,2))]
+    if rng.random() < 0.3:
+        notgroups = ['g%d' % rng.randrange(ngroups+1)]
+    min_mem = float(rng.randint(0,64)) if rng.random() < 0.3 else 0.0
+    min_cores = rng.randint(0,16) if rng.random() < 0.2 else 0
+    return cluster.candidates(min_mem, groups, notgroups, min_cores)
+
+def random_N(rng, cluster):
+    if rng.random() < 0.7:
+        return rng.randint(-1, 4*len(cluster.hostnames))
+    return rng.randint(0, 3)
+
+def python_engine(cluster, func, *args):
+    arrays, cluster.arrays = cluster.arrays, None
+    try:
+        return func(*args)
+    finally:
+        cluster.arrays = arrays
+
+def node_list(hosts):
+    return [[str(h), int(n)] for h,n in hosts]
+
+@pytest.mark.parametrize('seed', range(NSEEDS))
+def test_engines(seed, tmpdir):
+    rng = random.Random(seed)
+    cluster, ngroups = make_cluster(rng, tmpdir)
+    arrays = cluster.arrays
+    first = placement.get('first')
+
+    for r in range(NROUNDS):
+        change_usage(rng, cluster)
+
+        for q in range(NQUERIES):
+            cands = random_candidates(rng, cluster, ngroups)
+            N = random_N(rng, cluster)
+            threads = rng.choice([1,1,2,3,4])
+            bmask = rng.getrandbits(ngroups) if rng.random() < 0.5 else 0
+
+            # bycore: the greedy fill of FirstFit
+            match, hosts = arrays.fill_bycore(cands.index, N, threads, bmask)
+            pymatch, pyhosts = python_engine(cluster, first.fill, cluster,
+                                             cands, N, threads, bmask)
+            assert (match, node_list(hosts)) == (pymatch, pyhosts)
+
+            # bycore1: the first node that fits
+            host = arrays.first_fit(cands.index, N, bmask)
+            pyhost = python_engine(cluster, first.pick, cluster, cands, N,
+                                   bmask)
+            assert host == pyhost
+
+            # bynode: the idle nodes, as the python loop of the matcher
+            # takes them; only asked for with N > 0
+            N = max(N, 1)
+            match, hosts = arrays.idle_nodes(cands.index, N, bmask)
+            pyidle = [h for h in cluster.idle_candidates(cands)
+                      if not cluster.nodes[h].gmask & bmask]
+            pymatch = N <= len(pyidle)
+            pyhosts = []
+            if pymatch:
+                pyhosts = [[h, cluster.nodes[h].ncores] for h in pyidle[:N]]
+            assert (match, node_list(hosts)) == (pymatch, pyhosts)
+
+def job_result(job, cluster, bmask):
+    job.match(cluster, bmask)
+    return job['status'], job['reason'], job.get('hosts')
+
+@pytest.mark.parametrize('seed', range(NSEEDS))
+def test_job_match(seed, tmpdir):
+    """
+    Whole jobs through the bycore, bycore1 and bynode matchers
+    """
+    rng = random.Random(seed)
+    cluster, ngroups = make_cluster(rng, tmpdir)
+    spool_dir = str(tmpdir)
+
+    for r in range(NROUNDS):
+        change_usage(rng, cluster)
+
+        for q in range(NQUERIES):
+            require = {'mode':rng.choice(['bycore','bycore1','bynode']),
+                       'N':random_N(rng, cluster)}
+            if rng.random() < 0.4:
+                require['threads'] = rng.choice([1,2,3,4])
+            if rng.random() < 0.3:
+                require['group'] = ['g%d' % rng.randrange(ngroups+1)]
+            if rng.random() < 0.3:
+                require['notgroup'] = ['g%d' % rng.randrange(ngroups+1)]
+            if rng.random() < 0.3:
+                require['min_mem'] = float(rng.randint(0,64))
+            if rng.random() < 0.2:
+                require['min_cores'] = rng.randint(0,16)
+            bmask = rng.getrandbits(ngroups) if rng.random() < 0.5 else 0
+
+            message = {'pid':1, 'user':'u', 'commandline':'x',
+                       'require':require}
+            res = job_result(server.Job(message, spool_dir=spool_dir),
+                             cluster, bmask)
+            pyres = python_engine(cluster, job_result,
+                                  server.Job(message, spool_dir=spool_dir),
+                                  cluster, bmask)
+            assert res == pyres, require
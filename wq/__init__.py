@@ -1,4 +1,6 @@
 from . import server
+from . import codec
+from . import client
 
 from .server import DEFAULT_HOST
 from .server import DEFAULT_PORT
@@ -9,5 +11,24 @@ from .server import DEFAULT_SOCK_TIMEOUT
 from .server import DEFAULT_WAIT_SLEEP
 from .server import DEFAULT_SPOOL_DIR
 from .server import PRIORITY_LIST
+from .server import SCHEDULER_LIST
+from .server import DEFAULT_SCHEDULER
+from .server import ENGINE_LIST
+from .server import DEFAULT_ENGINE
+from .server import DEFAULT_FAIRSHARE_HALFLIFE
+from .server import PLACEMENT_LIST
+from .server import DEFAULT_PLACEMENT
+from .server import IO_LIST
+from .server import DEFAULT_IO
+from .server import DEFAULT_BACKLOG
+from .server import DEFAULT_IDLE_TIMEOUT
+from .server import DEFAULT_METRICS_INTERVAL
+from .server import DEFAULT_ADMINS
+from .server import LISTING_FIELDS
+from .server import SORT_FIELDS
+from .sampler import DEFAULT_PROFILE_INTERVAL
+from .sampler import DEFAULT_PROFILE_DURATION
+from .sampler import MAX_PROFILE_DURATION
+from .journal import DEFAULT_PERSIST_WINDOW
 
 
@@ -0,0 +1,144 @@
+"""
+A persistent connection to the server, for programs sending many requests.
+
+    with Connection(port=port) as conn:
+        listing = conn.request({'command':'ls'})['response']
+
+        # pipelined: all requests go out before the first response is read
+        responses = conn.pipeline([{'command':'gethosts', 'pid':pid}
+                                   for pid in pids])
+
+Servers that do not keep connections open, or that closed the connection
+after it sat idle, are handled by reconnecting, and requests that were sent
+but never answered are sent again.
+"""
+import collections
+import socket
+
+from . import codec as wqcodec
+from .server import (DEFAULT_HOST, DEFAULT_PORT, FLAG_KEEPALIVE,
+                     ConnectionClosed, socket_send_frame, socket_recieve_frame)
+
+# requests sent ahead of their responses by pipeline()
+DEFAULT_PIPELINE_DEPTH = 64
+
+class Connection:
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, codec=None,
+                 timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        if codec is None:
+            self.codec = wqcodec.preferred()
+        else:
+            self.codec = wqcodec.by_name(codec)
+
+        self.sock = None
+        # sent and not yet answered, in order
+        self.outstanding = collections.deque()
+        # the connection has answered a request, so it may have been closed
+        # while idle since
+        self.answered = False
+
+    def connect(self):
+        self.close()
+        sock = socket.create_connection((self.host or 'localhost', self.port),
+                                        self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.answered = False
+
+    def send(self, message):
+        """
+        Send a request without waiting for the response; get it with
+        recieve()
+        """
+        if self.sock is None:
+            self.connect()
+        self.outstanding.append(message)
+        try:
+            self._send(message)
+        except (BrokenPipeError, ConnectionResetError):
+            if not self.answered:
+                raise
+            self._resend(list(self.outstanding))
+
+    def _send(self, message):
+        socket_send_frame(self.sock, self.codec.dumps(message),
+                          codec=self.codec.id, flags=FLAG_KEEPALIVE)
+
+    def recieve(self):
+        """
+        The response to the oldest outstanding request
+        """
+        if not self.outstanding:
+            raise RuntimeError("no request is waiting for a response")
+
+        try:
+            version, codec_id, flags, data = socket_recieve_frame(self.sock)
+        except (ConnectionClosed, ConnectionResetError):
+            if not self.answered:
+                raise
+            # closed while idle, before our requests were read
+            self._resend(list(self.outstanding))
+            return self.recieve()
+        rdict = wqcodec.get(codec_id).loads(data)
+        message = self.outstanding.popleft()
+        self.answered = True
+
+        if 'codecs' in rdict and 'error' in rdict \
+                and self.codec.id != wqcodec.CODEC_YAML:
+            # the server does not have our codec; every server speaks YAML
+            self.codec = wqcodec.get(wqcodec.CODEC_YAML)
+            self._resend([message] + list(self.outstanding))
+            return self.recieve()
+
+        if not flags & FLAG_KEEPALIVE:
+            # closed by the server, the rest were never read
+            self._resend(list(self.outstanding))
+        return rdict
+
+    def _resend(self, messages):
+        """
+        Reconnect and send the messages again
+        """
+        self.outstanding.clear()
+        self.close()
+        for message in messages:
+            self.send(message)
+
+    def request(self, message):
+        """
+        Send a request and return its response
+        """
+        self.send(message)
+        return self.recieve()
+
+    def pipeline(self, messages, depth=DEFAULT_PIPELINE_DEPTH):
+        """
+        Send the requests without waiting for each response, and return the
+        responses in the same order.  At most depth requests are sent ahead,
+        so neither side blocks with full socket buffers
+        """
+        if self.outstanding:
+            raise RuntimeError("read the outstanding responses first")
+
+        responses = []
+        for message in messages:
+            if len(self.outstanding) >= depth:
+                responses.append(self.recieve())
+            self.send(message)
+        while self.outstanding:
+            responses.append(self.recieve())
+        return responses
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
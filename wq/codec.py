@@ -0,0 +1,97 @@
+"""
+Codecs for the payload of a protocol frame.
+
+The codec of a request is given in its frame header, and the response comes
+back in the same codec, so each connection picks its own.  YAML is what
+older clients speak and is always available.  JSON uses orjson when it is
+installed, otherwise the json module; msgpack needs the msgpack package.
+"""
+import json
+
+import yaml
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_YAML = 0
+CODEC_JSON = 1
+CODEC_MSGPACK = 2
+
+# in order of preference for clients
+CODEC_PREFERENCE = ['msgpack','json','yaml']
+
+class Codec:
+    def __init__(self, codec_id, name, dumps, loads):
+        self.id = codec_id
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+def _yaml_dumps(obj):
+    return yaml.dump(obj).encode('utf-8')
+
+def _yaml_loads(data):
+    # frames arrive in a bytearray, which yaml does not read
+    return yaml.safe_load(bytes(data))
+
+if orjson is not None:
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def _json_loads(data):
+        return orjson.loads(data)
+else:
+    def _json_dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def _json_loads(data):
+        return json.loads(bytes(data).decode('utf-8'))
+
+def _msgpack_dumps(obj):
+    return msgpack.packb(obj, use_bin_type=True)
+
+def _msgpack_loads(data):
+    return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+CODECS = {}
+
+def _register(codec):
+    CODECS[codec.id] = codec
+
+_register(Codec(CODEC_YAML, 'yaml', _yaml_dumps, _yaml_loads))
+_register(Codec(CODEC_JSON, 'json', _json_dumps, _json_loads))
+if msgpack is not None:
+    _register(Codec(CODEC_MSGPACK, 'msgpack', _msgpack_dumps,
+                    _msgpack_loads))
+
+def get(codec_id):
+    """
+    The codec with this id, or None if it is not available here
+    """
+    return CODECS.get(codec_id)
+
+def by_name(name):
+    for codec in CODECS.values():
+        if codec.name == name:
+            return codec
+    raise ValueError("codec must be one of: %s, got '%s'"
+                     % (",".join(names()), name))
+
+def names():
+    return [CODECS[codec_id].name for codec_id in sorted(CODECS)]
+
+def preferred():
+    """
+    The fastest codec available
+    """
+    available = names()
+    for name in CODEC_PREFERENCE:
+        if name in available:
+            return by_name(name)
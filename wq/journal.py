@@ -0,0 +1,459 @@
+"""
+Append-only journal of queue events, with compacted snapshots.
+
+The spool directory holds
+
+    snapshot        the state at the time of the last compaction, see
+                    snapshot.py
+    journal.<gen>   records appended since that snapshot
+
+Each record is a pickled tuple, framed by its length and crc32 so a torn
+write at the end of the journal is detected and dropped.  Records are
+buffered by append() and written by commit() with a single write and fsync
+(group commit), normally by a PersistWorker thread off the request path.
+Small files, e.g. the users file and the pid.run files that waiting clients
+poll for, are written along with the records.  compact() writes a new
+snapshot and starts the next journal generation; the generation is stored in
+the snapshot so a crash between the two steps never replays records twice.
+"""
+from __future__ import print_function
+
+import os
+import fcntl
+import struct
+import time
+import threading
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import snapshot
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+# snapshots written before snapshot.py were a stream of records
+_RECORD_SNAPSHOT_VERSION = 1
+
+# compact once this many records were appended since the last snapshot
+DEFAULT_COMPACT_RECORDS = 50000
+
+# seconds the persistence worker waits for more changes to write together,
+# and how many batches of changes may be queued for it
+DEFAULT_PERSIST_WINDOW = 0.002
+DEFAULT_PERSIST_QUEUE = 1000
+
+_HEADER = struct.Struct('<II') # length, crc32
+
+def encode_record(record):
+    payload = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    crc = zlib.crc32(payload) & 0xffffffff
+    return _HEADER.pack(len(payload), crc) + payload
+
+class RecordReader:
+    """
+    Iterate over the records in a file.  Reading stops at the first torn or
+    corrupt record; end is the offset just past the last good one
+    """
+    def __init__(self, fobj):
+        self.fobj = fobj
+        self.end = fobj.tell()
+        self.torn = False
+
+    def __iter__(self):
+        fobj = self.fobj
+        hsize = _HEADER.size
+        while True:
+            header = fobj.read(hsize)
+            if len(header) < hsize:
+                self.torn = len(header) > 0
+                return
+
+            size, crc = _HEADER.unpack(header)
+            payload = fobj.read(size)
+            if len(payload) < size or \
+                    (zlib.crc32(payload) & 0xffffffff) != crc:
+                self.torn = True
+                return
+
+            try:
+                record = pickle.loads(payload)
+            except Exception:
+                self.torn = True
+                return
+
+            self.end += hsize + size
+            yield record
+
+class Journal:
+    def __init__(self, dirname, fsync=True,
+                 compact_records=DEFAULT_COMPACT_RECORDS):
+        self.dirname = dirname
+        self.fsync = fsync
+        self.compact_records = compact_records
+
+        self.snapshot_file = os.path.join(dirname, 'snapshot')
+        self.gen = 0
+        self._record_snapshot = False
+
+        self.buf = []
+        self.files = {}
+        self.fobj = None
+
+        # records in the current journal generation
+        self.nrecords = 0
+
+        self.nwrites = 0
+        self.nbytes = 0
+
+    def journal_file(self, gen=None):
+        if gen is None:
+            gen = self.gen
+        return os.path.join(self.dirname, 'journal.%d' % gen)
+
+    def read_snapshot(self):
+        """
+        Map the snapshot into memory and return it, or None if there is no
+        snapshot in the current format.  Call before replay()
+        """
+        self.gen = 0
+        self._record_snapshot = False
+        if not os.path.exists(self.snapshot_file):
+            return None
+
+        if not snapshot.is_snapshot(self.snapshot_file):
+            # written by an older version, its records come from replay()
+            self._record_snapshot = True
+            return None
+
+        snap = snapshot.Snapshot(self.snapshot_file)
+        self.gen = snap.gen
+        return snap
+
+    def replay(self):
+        """
+        Yield the records in the journal, and open it for appending.  A torn
+        record at the end of the journal is cut off.
+        """
+        if self._record_snapshot:
+            for record in self._replay_record_snapshot():
+                yield record
+
+        end = 0
+        self.nrecords = 0
+        fname = self.journal_file()
+        if os.path.exists(fname):
+            with open(fname,'rb') as fobj:
+                reader = RecordReader(fobj)
+                for record in reader:
+                    self.nrecords += 1
+                    yield record
+                end = reader.end
+                if reader.torn:
+                    print( 'dropping torn record at end of journal:',fname )
+
+        self._open(end)
+        self._remove_old()
+
+    def _replay_record_snapshot(self):
+        with open(self.snapshot_file,'rb') as fobj:
+            reader = RecordReader(fobj)
+            first = True
+            for record in reader:
+                if first:
+                    first = False
+                    if record[0] != 'snapshot' or \
+                            record[1] != _RECORD_SNAPSHOT_VERSION:
+                        raise ValueError("bad snapshot file: %s"
+                                         % self.snapshot_file)
+                    self.gen = record[2]
+                    continue
+                yield record
+            if reader.torn:
+                raise ValueError("corrupt snapshot file: %s"
+                                 % self.snapshot_file)
+
+    def _open(self, end=0):
+        fname = self.journal_file()
+        fobj = open(fname,'ab')
+        if fobj.tell() != end:
+            fobj.truncate(end)
+            fobj.seek(end)
+        self.fobj = fobj
+
+    def _remove_old(self):
+        """
+        Remove journals of earlier generations, left by a crash during
+        compaction
+        """
+        prefix = 'journal.'
+        for fn in os.listdir(self.dirname):
+            if fn.startswith(prefix):
+                try:
+                    gen = int(fn[len(prefix):])
+                except ValueError:
+                    continue
+                if gen < self.gen:
+                    os.remove(os.path.join(self.dirname,fn))
+
+    def append(self, record):
+        """
+        Buffer a record; it is written by the next commit()
+        """
+        self.buf.append(encode_record(record))
+
+    def set_file(self, fname, text):
+        """
+        Write a file with the next commit(), or remove it if text is None.
+        Only the last change to a file is kept
+        """
+        self.files[fname] = text
+
+    def take(self):
+        """
+        Return the buffered records and file changes, for write()
+        """
+        data = b''.join(self.buf)
+        files = self.files
+        self.nrecords += len(self.buf)
+        self.buf = []
+        self.files = {}
+        return data, files
+
+    def write(self, data, files=None):
+        """
+        Append the records with a single write and fsync, then apply the
+        file changes
+        """
+        if data:
+            if self.fobj is None:
+                fname = self.journal_file()
+                self._open(os.path.getsize(fname)
+                           if os.path.exists(fname) else 0)
+
+            self.fobj.write(data)
+            self.fobj.flush()
+            if self.fsync:
+                os.fsync(self.fobj.fileno())
+
+            self.nwrites += 1
+            self.nbytes += len(data)
+
+        if files:
+            for fname, text in files.items():
+                if text is None:
+                    if os.path.exists(fname):
+                        os.remove(fname)
+                else:
+                    write_file(fname, text)
+
+    def commit(self):
+        """
+        Write everything buffered
+        """
+        if self.buf or self.files:
+            self.write(*self.take())
+
+    def needs_compact(self):
+        return self.nrecords >= self.compact_records
+
+    def compact(self, sections):
+        """
+        Write the (name, bytes) sections as the new snapshot and start a new
+        journal generation.  Buffered records are committed first.
+        """
+        self.commit()
+
+        gen = self.gen + 1
+        tmpname = self.snapshot_file + '.tmp'
+        with open(tmpname,'wb') as fobj:
+            snapshot.write(fobj, gen, sections)
+            fobj.flush()
+            if self.fsync:
+                os.fsync(fobj.fileno())
+
+        os.rename(tmpname, self.snapshot_file)
+        self._fsync_dir()
+
+        # from here on the snapshot says to read the new generation
+        if self.fobj is not None:
+            self.fobj.close()
+        self.gen = gen
+        self.nrecords = 0
+        self._open()
+        self._remove_old()
+
+    def _fsync_dir(self):
+        if not self.fsync:
+            return
+        try:
+            fd = os.open(self.dirname, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def stats(self):
+        return {'gen':self.gen,
+                'nrecords':self.nrecords,
+                'nwrites':self.nwrites,
+                'nbytes':self.nbytes}
+
+    def close(self):
+        self.commit()
+        if self.fobj is not None:
+            self.fobj.close()
+            self.fobj = None
+
+def write_file(fname, text):
+    """
+    Replace the file by renaming a new one over it, so readers never see it
+    half written
+    """
+    tmpname = fname + '.tmp'
+    with open(tmpname,'w') as fobj:
+        fobj.write(text)
+    os.rename(tmpname, fname)
+
+class PersistWorker(threading.Thread):
+    """
+    Write journal changes in a background thread.
+
+    submit() queues a batch of changes and returns its sequence number; it
+    only blocks when the queue is full.  The worker writes everything that
+    arrives within the window together, then sets flushed_seq and writes a
+    byte to the wakeup pipe, so a select loop can answer the clients whose
+    changes are now on disk.
+
+    If a write fails, error is set, flushed_seq stops advancing and nothing
+    more is written; the pipe is still written so the server wakes up to
+    see the error.
+    """
+    def __init__(self, journal,
+                 window=DEFAULT_PERSIST_WINDOW,
+                 maxsize=DEFAULT_PERSIST_QUEUE):
+        threading.Thread.__init__(self, name='wq-persist')
+        self.daemon = True
+
+        self.journal = journal
+        self.window = window
+        self.queue = queue.Queue(maxsize)
+
+        # last sequence number submitted, and last one written
+        self.seq = 0
+        self.flushed_seq = 0
+        self.error = None
+        self.cond = threading.Condition()
+
+        self.wakeup_fd, self._wakeup_wfd = os.pipe()
+        for fd in (self.wakeup_fd, self._wakeup_wfd):
+            _set_nonblocking(fd)
+
+        self.nbatches = 0
+        self.nflushes = 0
+
+        # a metrics.Metrics for the write times, if set
+        self.metrics = None
+
+    def submit(self, data, files=None):
+        self.seq += 1
+        self.queue.put((self.seq, data, files))
+        self.nbatches += 1
+        return self.seq
+
+    def flushed(self, seq):
+        return self.flushed_seq >= seq
+
+    def sync(self):
+        """
+        Wait until everything submitted is written, or a write failed; check
+        error after
+        """
+        seq = self.seq
+        with self.cond:
+            while self.flushed_seq < seq and self.error is None:
+                self.cond.wait()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+    def clear_wakeup(self):
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except OSError:
+            pass
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            items = [item]
+            deadline = time.time() + self.window
+            while True:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        item = self.queue.get(timeout=timeout)
+                    else:
+                        item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                items.append(item)
+
+            self._write(items)
+
+    def _write(self, items):
+        files = {}
+        for seq, data, ifiles in items:
+            if ifiles:
+                files.update(ifiles)
+
+        tm0 = time.perf_counter()
+        if self.error is None:
+            try:
+                self.journal.write(b''.join(item[1] for item in items), files)
+                if self.metrics is not None:
+                    self.metrics.observe('spool_write_seconds',
+                                         time.perf_counter()-tm0)
+            except Exception as err:
+                print( 'error writing the journal:',err )
+                self.error = err
+            self.nflushes += 1
+
+        with self.cond:
+            if self.error is None:
+                self.flushed_seq = items[-1][0]
+            self.cond.notify_all()
+
+        try:
+            os.write(self._wakeup_wfd, b'x')
+        except OSError:
+            # the pipe is full, the reader will wake up anyway
+            pass
+
+    def stats(self):
+        return {'nbatches':self.nbatches,
+                'nflushes':self.nflushes,
+                'pending':self.seq - self.flushed_seq,
+                'error':None if self.error is None else str(self.error)}
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
@@ -0,0 +1,194 @@
+"""
+Counters and latency histograms of the server, for the metrics command and
+for Prometheus.
+
+Histograms count observations in fixed buckets, so recording one is a
+bisect and two additions, cheap enough to leave on.  Values that are already
+counted elsewhere, e.g. the pid checks of the Liveness or the bytes written
+by the Journal, are read by collectors only when the metrics are asked for.
+
+Labels are tuples of (name, value) pairs, e.g. (('command','sub'),); they
+should come from a small fixed set of values, not from the clients.
+"""
+import bisect
+
+# upper bounds of the buckets, for times in seconds and for counts
+SECONDS_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3,
+                   5e-3, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                 10000, 20000, 50000, 100000)
+
+# name: (type, help, buckets) of every metric; names get the wq_ prefix in
+# the Prometheus text
+METRICS = {
+    'command_seconds':
+        ('histogram', 'Time to process a command', SECONDS_BUCKETS),
+    'refresh_seconds':
+        ('histogram', 'Time of a full refresh of the queue', SECONDS_BUCKETS),
+    'refresh_phase_seconds':
+        ('histogram', 'Time of a refresh spent matching jobs (match), '
+                      'starting and spooling them (spool), checking their '
+                      'pids (liveness), and on everything else (other), '
+                      'e.g. removing dead jobs and walking the queues',
+         SECONDS_BUCKETS),
+    'refresh_jobs':
+        ('histogram', 'Jobs matched and started in a refresh', COUNT_BUCKETS),
+    'codec_seconds':
+        ('histogram', 'Time to decode a request or encode a response',
+         SECONDS_BUCKETS),
+    'spool_write_seconds':
+        ('histogram', 'Time to write a batch of changes to the spool',
+         SECONDS_BUCKETS),
+    'snapshot_seconds':
+        ('histogram', 'Time to write a snapshot of the queue',
+         SECONDS_BUCKETS),
+    'jobs_started_total':
+        ('counter', 'Jobs started', None),
+    'match_memo_hits_total':
+        ('counter', 'Matches answered from the memo of failed matches', None),
+    'pid_checks_total':
+        ('counter', 'Checks whether the pid of a job exists', None),
+    'pid_syscalls_total':
+        ('counter', 'System calls made to check pids', None),
+    'spool_writes_total':
+        ('counter', 'Writes to the journal', None),
+    'spool_bytes_total':
+        ('counter', 'Bytes written to the journal', None),
+    'jobs':
+        ('gauge', 'Jobs in the queue', None),
+    'cores':
+        ('gauge', 'Cores of the online nodes', None),
+}
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # the last is for values above all the bounds
+        self.counts = [0]*(len(bounds)+1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        The upper bound of the bucket holding the q quantile, or the largest
+        bound when it is above them all
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q*self.count
+        total = 0
+        for bound,n in zip(self.bounds, self.counts):
+            total += n
+            if total >= rank:
+                return bound
+        return self.bounds[-1]
+
+    def asdict(self):
+        mean = self.sum/self.count if self.count else 0.0
+        return {'count':self.count,
+                'sum':self.sum,
+                'mean':mean,
+                'p50':self.quantile(0.5),
+                'p90':self.quantile(0.9),
+                'p99':self.quantile(0.99),
+                'buckets':[[b,n] for b,n in zip(self.bounds, self.counts)]
+                          + [['+Inf', self.counts[-1]]]}
+
+class Metrics:
+    def __init__(self):
+        # (name, labels) -> value or Histogram
+        self.counters = {}
+        self.histograms = {}
+
+        # functions returning (name, labels, value) of counters and gauges
+        # kept elsewhere
+        self.collectors = []
+
+    def inc(self, name, value=1, labels=()):
+        key = (name, labels)
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(METRICS[name][2])
+        hist.observe(value)
+
+    def values(self):
+        """
+        The counters and gauges by (name, labels), including the collected
+        ones
+        """
+        values = dict(self.counters)
+        for collector in self.collectors:
+            for name,labels,value in collector():
+                values[(name, labels)] = value
+        return values
+
+    def asdict(self):
+        """
+        The metrics by name, and then by labels written name=value and comma
+        separated for those that have labels
+        """
+        res = {}
+        items = list(self.values().items())
+        items += [(key, hist.asdict())
+                  for key,hist in list(self.histograms.items())]
+        for (name,labels),value in items:
+            if labels:
+                res.setdefault(name, {})[_label_key(labels)] = value
+            else:
+                res[name] = value
+        return res
+
+    def prometheus(self):
+        """
+        The metrics in the Prometheus text format
+        """
+        byname = {}
+        for (name,labels),value in self.values().items():
+            byname.setdefault(name, []).append((labels, value))
+        for (name,labels),hist in list(self.histograms.items()):
+            byname.setdefault(name, []).append((labels, hist))
+
+        lines = []
+        for name in sorted(byname):
+            mtype, mhelp, bounds = METRICS[name]
+            pname = 'wq_' + name
+            lines.append('# HELP %s %s' % (pname, mhelp))
+            lines.append('# TYPE %s %s' % (pname, mtype))
+            for labels,value in sorted(byname[name], key=lambda x: x[0]):
+                if mtype != 'histogram':
+                    lines.append('%s%s %s'
+                                 % (pname, _label_text(labels), value))
+                    continue
+                total = 0
+                for bound,n in zip(value.bounds, value.counts):
+                    total += n
+                    lines.append('%s_bucket%s %d'
+                                 % (pname,
+                                    _label_text(labels+(('le',bound),)),
+                                    total))
+                lines.append('%s_bucket%s %d'
+                             % (pname, _label_text(labels+(('le','+Inf'),)),
+                                value.count))
+                lines.append('%s_sum%s %r'
+                             % (pname, _label_text(labels), value.sum))
+                lines.append('%s_count%s %d'
+                             % (pname, _label_text(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+def _label_key(labels):
+    return ','.join('%s=%s' % (k,v) for k,v in labels)
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k,v) for k,v in labels)
@@ -0,0 +1,170 @@
+"""
+Placement policies: which of the free candidate nodes bycore and bycore1
+jobs are given.
+
+    'first'    nodes in host name order, the first that fit
+    'pack'     nodes already in use first, fewest free cores first, so idle
+               nodes stay whole for bynode, bycore1 and bygroup jobs
+    'bestfit'  the node whose free cores fit the job most tightly; jobs too
+               big for any one node take the nodes with the most free cores,
+               spanning as few as possible
+    'spread'   the nodes with the most free cores first, spreading the load
+
+A policy has fill(), the [host, ncores] runs for a bycore job, and pick(),
+the host for a bycore1 job.  More can be added with register().  Only the
+'first' policy uses the numpy engine; the others sort the free candidates.
+"""
+
+class Placement:
+    """
+    Take the free, unblocked candidates in the order of key(), host order
+    unless a policy overrides it
+    """
+    def key(self, nd, order):
+        """
+        Sort key of a node with free cores; order is its host order
+        """
+        return order
+
+    def free_nodes(self, cluster, cands, bmask):
+        """
+        The candidates with free cores outside the blocked groups, as nodes
+        """
+        nodes = cluster.nodes
+        free = []
+        for h in cluster.free_candidates(cands):
+            nd = nodes[h]
+            if not nd.gmask & bmask:
+                free.append(nd)
+        return free
+
+    def fill(self, cluster, cands, N, threads, bmask):
+        """
+        Take free cores, a multiple of threads from each node, until N are
+        taken.  Returns match and the [host, ncores] taken
+        """
+        order = cluster.host_order
+        free = self.free_nodes(cluster, cands, bmask)
+        free.sort(key=lambda nd: self.key(nd, order[nd.host]))
+        return _fill(free, N, threads)
+
+    def pick(self, cluster, cands, N, bmask):
+        """
+        The node with at least N, and at least one, free cores that comes
+        first, or None
+        """
+        order = cluster.host_order
+        N = max(N, 1)
+        best = None
+        bestkey = None
+        for nd in self.free_nodes(cluster, cands, bmask):
+            if nd.ncores-nd.used < N:
+                continue
+            key = self.key(nd, order[nd.host])
+            if best is None or key < bestkey:
+                best, bestkey = nd, key
+        if best is None:
+            return None
+        return best.host
+
+class FirstFit(Placement):
+    """
+    Nodes in host order, walking the free host lists or free core buckets of
+    the cluster, or its arrays with the numpy engine
+    """
+    def fill(self, cluster, cands, N, threads, bmask):
+        if cluster.arrays is not None:
+            return cluster.arrays.fill_bycore(cands.index, N, threads, bmask)
+
+        def nodes():
+            for h in cluster.free_candidates(cands):
+                nd = cluster.nodes[h]
+                if not nd.gmask & bmask:
+                    yield nd
+        return _fill(nodes(), N, threads)
+
+    def pick(self, cluster, cands, N, bmask):
+        if cluster.arrays is not None:
+            return cluster.arrays.first_fit(cands.index, N, bmask)
+
+        # only nodes in the buckets with at least N free are visited
+        best=None
+        order=cluster.host_order
+        for nfree,bucket in cluster.free_buckets.items():
+            if nfree < N:
+                continue
+            for h in bucket:
+                if best is not None and order[h] > order[best]:
+                    continue
+                if h not in cands.hostset:
+                    continue
+                if cluster.nodes[h].gmask & bmask:
+                    continue
+                best=h
+        return best
+
+class Pack(Placement):
+    def key(self, nd, order):
+        return (nd.used == 0, nd.ncores-nd.used, order)
+
+class BestFit(Placement):
+    def key(self, nd, order):
+        return (nd.ncores-nd.used, order)
+
+    def fill(self, cluster, cands, N, threads, bmask):
+        order = cluster.host_order
+        free = self.free_nodes(cluster, cands, bmask)
+
+        # the tightest single node, if the job fits on one
+        best = None
+        bestkey = None
+        for nd in free:
+            if _usable(nd, threads) < N:
+                continue
+            key = (_usable(nd, threads), order[nd.host])
+            if best is None or key < bestkey:
+                best, bestkey = nd, key
+        if best is not None:
+            return _fill([best], N, threads)
+
+        free.sort(key=lambda nd: (-_usable(nd, threads), order[nd.host]))
+        return _fill(free, N, threads)
+
+class Spread(Placement):
+    def key(self, nd, order):
+        return (nd.used-nd.ncores, order)
+
+POLICIES = {}
+
+def register(name, policy):
+    """
+    Make a Placement available by name, to the server and in requirements
+    """
+    POLICIES[name] = policy
+
+def get(name):
+    return POLICIES[name]
+
+register('first', FirstFit())
+register('pack', Pack())
+register('bestfit', BestFit())
+register('spread', Spread())
+
+def _usable(nd, threads):
+    return ((nd.ncores-nd.used)//threads)*threads
+
+def _fill(nodes, N, threads):
+    """
+    Take the usable free cores of the nodes in turn until N are taken
+    """
+    hosts = []
+    for nd in nodes:
+        nfree = _usable(nd, threads)
+        if nfree >= N:
+            if N > 0:
+                hosts.append([nd.host, N])
+            return True, hosts
+        N -= nfree
+        if nfree > 0:
+            hosts.append([nd.host, nfree])
+    return False, []
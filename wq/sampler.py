@@ -0,0 +1,112 @@
+"""
+A sampling profiler that can be started and stopped in the running server.
+
+A thread wakes every interval and records the stack of the server thread,
+the one running the request loop, refreshes and request handlers.  The
+server is not slowed down beyond the sampling itself, a walk up the stack
+every few milliseconds, and the queue it is slow with stays as it is.
+
+The number of samples of each stack is written in the collapsed stack
+format read by flamegraph.pl, speedscope and similar tools, one stack per
+line from the outermost call, with the count last:
+
+    wq:<module>;server.py:run;server.py:_run;server.py:respond;server.py:refresh 12
+"""
+import collections
+import os
+import sys
+import threading
+import time
+
+from .journal import write_file
+
+# seconds between samples, and how long to sample when not stopped; the
+# duration can't be more than the maximum
+DEFAULT_PROFILE_INTERVAL = 0.005
+DEFAULT_PROFILE_DURATION = 60.0
+MAX_PROFILE_DURATION = 600.0
+
+class Sampler(threading.Thread):
+    """
+    Sample the stack of the thread with the given ident until stop() is
+    called or the duration is over, then write the counts to fname
+    """
+    def __init__(self, thread_ident, fname,
+                 interval=DEFAULT_PROFILE_INTERVAL,
+                 duration=DEFAULT_PROFILE_DURATION):
+        threading.Thread.__init__(self, name='wq-sampler')
+        self.daemon = True
+
+        self.thread_ident = thread_ident
+        self.fname = fname
+        self.interval = interval
+        self.duration = duration
+
+        self.stacks = collections.Counter()
+        self.nsamples = 0
+        self.time_start = None
+        self.time_stop = None
+        self.error = None
+        self._stop_event = threading.Event()
+
+        # frame labels by code object
+        self._labels = {}
+
+    def run(self):
+        self.time_start = time.time()
+        deadline = self.time_start + self.duration
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_ident)
+            if frame is None:
+                # the thread is gone
+                break
+            self.stacks[self._stack(frame)] += 1
+            self.nsamples += 1
+            del frame
+            if time.time() >= deadline:
+                break
+
+        self.time_stop = time.time()
+        try:
+            self.write()
+        except (IOError, OSError) as err:
+            print( 'error writing profile to %s: %s' % (self.fname,err) )
+            self.error = err
+
+    def _stack(self, frame):
+        labels = self._labels
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = '%s:%s' % (
+                    os.path.basename(code.co_filename), code.co_name)
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        return ';'.join(stack)
+
+    def stop(self):
+        """
+        Stop sampling, and return once the profile is written
+        """
+        self._stop_event.set()
+        self.join()
+
+    def write(self):
+        lines = ['%s %d' % (stack,n) for stack,n in
+                 sorted(self.stacks.items())]
+        write_file(self.fname, '\n'.join(lines) + '\n')
+
+    def stats(self):
+        if self.time_start is None:
+            seconds = 0.0
+        else:
+            seconds = (self.time_stop or time.time()) - self.time_start
+        return {'file':self.fname,
+                'running':self.is_alive(),
+                'nsamples':self.nsamples,
+                'seconds':seconds,
+                'interval':self.interval,
+                'duration':self.duration}
@@ -10,12 +10,19 @@ The groups are optional comma separated list.
 from __future__ import print_function
 
 import socket
+import pwd
 import yaml
 import time
 import copy
 import sys
 import os
-import glob
+import bisect
+import collections
+import heapq
+import itertools
+import math
+import struct
+import zlib
 
 try:
     import cPickle as pickle
@@ -23,8 +30,21 @@ except ImportError:
     import pickle
 
 import datetime
+import gc
 
 import select
+import threading
+import asyncio
+
+from .journal import Journal, PersistWorker, DEFAULT_PERSIST_WINDOW
+from . import snapshot
+from . import codec as wqcodec
+from . import vector
+from . import placement
+from . import metrics as wqmetrics
+from . import sampler
+from .journal import write_file
+from .codec import CODEC_YAML
 
 DEFAULT_HOST = ''      # Symbolic name meaning all available interfaces
 DEFAULT_PORT = 51093   # Arbitrary non-privileged port
@@ -38,28 +58,154 @@ DEFAULT_SPOOL_DIR = "~/wqspool/"
 #PRIORITY_LIST= ['block','low','med','high']
 PRIORITY_LIST= ['block','high','med','low']
 
+# 'full' matches the whole queue after every change, 'incremental' only offers
+# freed hosts to the waiting jobs that could use them, with a full refresh
+# forced every timeout seconds, busy or not
+SCHEDULER_LIST = ['full','incremental']
+DEFAULT_SCHEDULER = 'full'
+
+# 'python' searches the nodes in loops, 'numpy' with array operations over
+# the whole cluster, see vector.py, and 'check' runs both and reports any
+# match where they differ, keeping the python result
+ENGINE_LIST = ['python','numpy','check']
+DEFAULT_ENGINE = 'python'
+
+# where bycore and bycore1 jobs are placed among the free nodes: 'first' in
+# host order, 'pack' filling used nodes first, 'bestfit' on the node that
+# fits most tightly, 'spread' on the nodes with the most free cores.  Set for
+# the server, or for a job with the 'placement' requirement; see placement.py.
+# These are the registered policies, see placement.register()
+PLACEMENT_LIST = sorted(placement.POLICIES)
+DEFAULT_PLACEMENT = 'first'
+
+# 'select' serves one client at a time, 'asyncio' reads and writes all
+# clients concurrently, with one task making all changes to the queue
+IO_LIST = ['select','asyncio']
+DEFAULT_IO = 'select'
+
+# how many connections may wait to be accepted
+DEFAULT_BACKLOG = 128
+
+# fair-share scheduling: the half-life, in seconds, of the core-seconds used
+# by each user
+DEFAULT_FAIRSHARE_HALFLIFE = 86400.0
+
+# seconds a persistent connection may sit idle before the server closes it
+DEFAULT_IDLE_TIMEOUT = 60.0
+
+# the commands of the server; metrics are kept for each
+COMMAND_LIST = ['sub','bulk_sub','subarray','gethosts','ls','lsfull','stat',
+                'users','limit','rm','notify','refresh','node','metrics',
+                'profile']
+
+# users who may run admin commands, e.g. profile
+DEFAULT_ADMINS = ['root']
+
+# the fields of the ls listing; job_name is the job_name requirement, or the
+# first word of the command line
+LISTING_FIELDS = ['user','pid','priority','time_sub','time_run','status',
+                  'hosts','reason','job_name']
+# the fields listings can be sorted by; by default they are in submission
+# order
+SORT_FIELDS = ['pid','user','priority','status','time_sub','time_run',
+               'job_name']
+
+# seconds between writes of the metrics file, when there is one
+DEFAULT_METRICS_INTERVAL = 15.0
+
+# the clock the scheduler reads, for submit and start times, fair-share usage
+# and backfill; the simulator replaces it with its own, see simulate.py
+_clock = time.time
+
+def set_clock(clock=None):
+    """
+    Read the scheduler's time from clock() instead of time.time(), or from
+    time.time() again when clock is None
+    """
+    global _clock
+    if clock is None:
+        clock = time.time
+    _clock = clock
+
 # how many seconds to wait before restart
 RESTART_DELAY = 60
 
+# Messages are sent as frames: a header with the magic, the protocol version,
+# the codec of the payload, flags and the payload length, then the payload.
+# The response uses the codec of the request, see codec.py.  Clients that
+# send bare YAML without a header get bare YAML back.
+#
+# A request with FLAG_KEEPALIVE asks to keep the connection open for more
+# requests, which may be sent without waiting for the responses; they are
+# answered in order.  The server sets the flag in the response when it does
+# keep the connection.
+PROTOCOL_VERSION = 1
+FRAME_MAGIC = b'WQ'
+FRAME_HEADER = struct.Struct('!2sBBBxI')
+FLAG_KEEPALIVE = 1
+
+# largest frame payload accepted
+MAX_FRAME_SIZE = 1 << 30
+
+# how much to ask for in each recv of a frame
+DEFAULT_RECV_BUFFSIZE = 1 << 20
+
+class ProtocolError(Exception):
+    pass
+
+class SpoolFailed(Exception):
+    """
+    Changes could not be written to the spool, so the server stops
+    """
+    pass
+
+class ConnectionClosed(ProtocolError):
+    """
+    The connection was closed before anything of a frame was read, e.g. an
+    idle persistent connection closed by the server
+    """
+    pass
+
 def socket_send(conn, mess):
     """
     Send a message using a socket or connection, trying until all data is sent.
-
-    hmm... is this going to max the cpu if we can't get through right away?
+    Partial sends continue from a memoryview, so the data are not copied.
     """
 
-    mess=bytes(mess, 'utf-8')
+    if not isinstance(mess, bytes):
+        mess=bytes(mess, 'utf-8')
 
-    reslen=len(mess)
-    tnsent=conn.send(mess)
-    nsent = tnsent
-    while nsent < reslen:
-        tnsent=conn.send(mess[nsent:])
-        nsent += tnsent
+    view=memoryview(mess)
+    while view:
+        nsent=conn.send(view)
+        view=view[nsent:]
+
+def socket_send_frame(conn, payload, codec=CODEC_YAML, flags=0):
+    """
+    Send the payload as one frame.  The header and payload go out together
+    through sendmsg without being joined, and partial sends continue from
+    memoryviews
+    """
+    if not isinstance(payload, bytes):
+        payload=bytes(payload, 'utf-8')
+
+    header=FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, codec, flags,
+                             len(payload))
+    buffers=[memoryview(header), memoryview(payload)]
+    while buffers:
+        nsent=conn.sendmsg(buffers)
+        while buffers and nsent >= len(buffers[0]):
+            nsent -= len(buffers[0])
+            buffers.pop(0)
+        if nsent:
+            buffers[0]=buffers[0][nsent:]
 
 def socket_recieve(conn, buffsize):
     """
     Recieve all data from a socket or connection, dealing with buffers.
+
+    This is for clients that don't use frames: reading stops at the first
+    short recv, so long messages can be cut short.
     """
     tdata = conn.recv(buffsize)
     data=tdata
@@ -68,7 +214,116 @@ def socket_recieve(conn, buffsize):
         data += tdata
 
     return data
- 
+
+def socket_recieve_exactly(conn, nbytes, buffsize=DEFAULT_RECV_BUFFSIZE,
+                           initial=b''):
+    """
+    Recieve exactly nbytes into a preallocated buffer, the first of which
+    were already read into initial
+    """
+    buf=bytearray(nbytes)
+    view=memoryview(buf)
+    pos=len(initial)
+    view[:pos]=initial
+    while pos < nbytes:
+        nrecv=conn.recv_into(view[pos:], min(nbytes-pos, buffsize))
+        if nrecv == 0:
+            if pos == 0:
+                raise ConnectionClosed("connection closed")
+            raise ProtocolError("connection closed after %d of %d bytes"
+                                % (pos, nbytes))
+        pos += nrecv
+    return buf
+
+def parse_frame_header(header):
+    """
+    Check a frame header and return (version, codec, flags, size)
+    """
+    magic, version, codec, flags, size = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC:
+        raise ProtocolError("bad frame magic %r" % magic)
+    if size > MAX_FRAME_SIZE:
+        raise ProtocolError("frame of %d bytes is too large" % size)
+    return version, codec, flags, size
+
+def socket_recieve_frame(conn, buffsize=DEFAULT_RECV_BUFFSIZE):
+    """
+    Recieve one frame.  Returns (version, codec, flags, payload)
+    """
+    header=socket_recieve_exactly(conn, FRAME_HEADER.size)
+    version, codec, flags, size = parse_frame_header(header)
+    payload=socket_recieve_exactly(conn, size, buffsize)
+    return version, codec, flags, payload
+
+def socket_recieve_request(conn, buffsize):
+    """
+    Recieve a request, framed or not.  Returns the payload and the frame
+    (version, codec, flags), or None for unframed requests.
+
+    The start of the data is only peeked at, and a frame is read exactly, so
+    requests pipelined behind it stay in the socket for later.
+    """
+    data = conn.recv(FRAME_HEADER.size, socket.MSG_PEEK)
+    if len(data) < FRAME_HEADER.size and data \
+            and FRAME_MAGIC.startswith(data[:len(FRAME_MAGIC)]):
+        # could still be the start of a frame header
+        data = conn.recv(FRAME_HEADER.size, socket.MSG_PEEK|socket.MSG_WAITALL)
+
+    if len(data) < FRAME_HEADER.size or not data.startswith(FRAME_MAGIC):
+        # an old client sending bare YAML
+        if not data:
+            return conn.recv(buffsize), None
+        return socket_recieve(conn, buffsize), None
+
+    header = socket_recieve_exactly(conn, FRAME_HEADER.size)
+    version, codec, flags, size = parse_frame_header(header)
+    payload = socket_recieve_exactly(conn, size)
+    return payload, (version, codec, flags)
+
+def peer_user(conn):
+    """
+    The user on the other end of a connection from this host, from the
+    credentials of a unix socket or, for tcp, the owner of the connecting
+    socket in /proc/net.  None for connections from other hosts, or when
+    the system does not say
+    """
+    try:
+        if conn.family == socket.AF_UNIX:
+            creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                    struct.calcsize('3i'))
+            pid, uid, gid = struct.unpack('3i', creds)
+            return pwd.getpwuid(uid).pw_name
+
+        local = conn.getsockname()[:2]
+        peer = conn.getpeername()[:2]
+        if peer[0] != local[0]:
+            return None
+        if conn.family == socket.AF_INET6:
+            fname = '/proc/net/tcp6'
+        else:
+            fname = '/proc/net/tcp'
+        with open(fname) as fobj:
+            next(fobj)
+            for line in fobj:
+                fields = line.split()
+                # the client's end: its address is our peer and vice versa
+                if (_proc_address(fields[1], conn.family) == peer
+                        and _proc_address(fields[2], conn.family) == local):
+                    return pwd.getpwuid(int(fields[7])).pw_name
+    except (AttributeError, OSError, KeyError, ValueError, IndexError):
+        pass
+    return None
+
+def _proc_address(field, family):
+    """
+    host, port from an address in /proc/net/tcp; the host is in 32 bit
+    words of the native byte order
+    """
+    host, port = field.split(':')
+    words = [int(host[i:i+8], 16) for i in range(0, len(host), 8)]
+    packed = struct.pack('=%dI' % len(words), *words)
+    return socket.inet_ntop(family, packed), int(port, 16)
+
 class Server:
     def __init__(self, cluster_file, **keys):
 
@@ -81,6 +336,23 @@ class Server:
         self.queue = JobQueue(cluster_file, **keys)
         self.buffsize = keys.get('buffsize',DEFAULT_MAX_BUFFSIZE)
 
+        self.io = keys.get('io',DEFAULT_IO)
+        if self.io not in IO_LIST:
+            raise ValueError("io must be one of: %s, got '%s'"
+                             % (",".join(IO_LIST), self.io))
+
+        # (persist seq, client, response) waiting for the changes they made
+        # to reach the disk
+        self.parked = collections.deque()
+
+        self.codec_stats = CodecStats()
+
+        # persistent connections waiting for their next request, and when
+        # they were last active
+        self.idle_timeout = keys.get('idle_timeout',DEFAULT_IDLE_TIMEOUT)
+        self.idle = {}
+        self.inputs = []
+
         self.verbosity = 1
 
     def open_socket(self):
@@ -92,29 +364,45 @@ class Server:
         self.sock.bind((host, port))
         #self.sock.settimeout(self.timeout)
         self.sock.setblocking(0)
-        self.sock.listen(4)
+        self.sock.listen(self.keys.get('backlog',DEFAULT_BACKLOG))
 
     def run(self):
 
         do_restart=True
+        failed=None
 
         while True:
             self.open_socket()
             try:
-                self._run()
+                if self.io == 'asyncio':
+                    asyncio.run(self._run_asyncio())
+                else:
+                    self._run()
             except KeyboardInterrupt:
                 do_restart=False
+            except SpoolFailed as err:
+                do_restart=False
+                failed=err
             #except:
             #    es=sys.exc_info()
             #    print('caught exception type:', es[0],'details:',es[1])
             #    print('restarting')
             finally:
-                self.queue.save_users()
-                print('shutdown')
-                self.sock.shutdown(socket.SHUT_RDWR)
-                print('close')
-                self.sock.close()
-
+                # nothing more can be saved once writing the spool failed
+                if self.queue.persister.error is None:
+                    self.queue.sync()
+                if self.queue.persister.error is None:
+                    self.send_persisted()
+                    self.queue.save_users()
+                # the asyncio server closes the socket itself
+                if self.sock.fileno() != -1:
+                    print('shutdown')
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                    print('close')
+                    self.sock.close()
+
+            if failed is not None:
+                sys.exit("    %s" % failed)
             if not do_restart:
                 print("    keyboard interrupt: exiting")
                 break
@@ -132,22 +420,37 @@ class Server:
         dealt with later (this queue is not the job queue, just a simple list).
         The server is in the same queue so if it gets another request before a
         client is ready to be read, then another client will be queued for
-        later processing. Note we are also listening with a backlog of 4 on
-        the server socket.
+        later processing. Note we are also listening with a backlog, 128 by
+        default, on the server socket.
 
         Currently the clients are *not* dealt with in parallel.  This would be
         tricky since each client request can result in a change in the queue
         state.
 
+        Changes are written to disk by the persistence worker.  A client is
+        only answered once its changes are written, so its response is parked
+        until the worker wakes us through its pipe.
+
+        Persistent connections go back in the input list after each response,
+        and are closed when idle for longer than the idle timeout.  A client
+        whose response is parked is not read from, so responses go out in
+        order.
+
         """
         server=self.sock
-        input=[server]
+        wakeup=self.queue.persister.wakeup_fd
+        input=[server,wakeup]
+        self.inputs=input
         while True:
             try:
 
-                inputready,[],[] = select.select(input,[],[],self.timeout) 
-                if len(inputready) == 0:
+                self.close_idle()
+                inputready,[],[] = select.select(input,[],[],
+                                                 self.until_refresh())
+                self.check_persister()
+                if self.until_refresh() == 0.0:
                     self.refresh_queue()
+                if len(inputready) == 0:
                     #self.cleanup_failed_sockets()
                     continue
 
@@ -158,32 +461,43 @@ class Server:
                         print(  str(datetime.datetime.now()),'Connected by', addr )
                         # it goes in the queue
                         input.append(client) 
+                    elif sock == wakeup:
+                        # the persistence worker wrote some changes
+                        self.send_persisted()
                     else:
                         # handle clients.
                         try:
                             client=sock
-                            self.process_client_request(client)
-                            client.shutdown(socket.SHUT_RDWR)
-                            client.close()
-                        except socket.error as e:
+                            # whatever happens we won't read from this client
+                            # until it is answered
+                            input.remove(client)
+                            self.idle.pop(client, None)
+                            response = self.process_client_request(client)
+                            if response is not None \
+                                    and not self.queue.persisted():
+                                # answer once our changes are on disk,
+                                # meanwhile serving other clients
+                                seq = self.queue.persist_seq
+                                self.parked.append((seq, client, response))
+                            else:
+                                self.reply(client, response)
+                        except (socket.error, ProtocolError) as e:
                             es=sys.exc_info()
-                            if ('Broken pipe' in es[1] 
-                                    or 'Transport endpoint' in es[1]):
+                            if ('Broken pipe' in str(es[1])
+                                    or 'Transport endpoint' in str(es[1])
+                                    or isinstance(e, ProtocolError)):
                                 print( 'caught exception type:',es[0], )
                                 print( 'details:',es[1] )
                                 print( 'ignoring' )
+                            client.close()
                         #except TypeError as e:
                         #    # this happens extremely rarely, haven't tracked it down yet
                         #    # usually it is "'str' object does not support item assignment"
                         #    print( 'warning: catching and ignoring TypeError:',str(e) )
-                        finally:
-                            # whatever happens we can't talk to this client any
-                            # more
-                            input.remove(client) 
 
             except socket.error as e:
                 es=sys.exc_info()
-                if 'Broken pipe' in es[1]:
+                if 'Broken pipe' in str(es[1]):
                     # this happens sometimes when someone ctrl-c in the middle
                     # of talking with the server
                     print( 'caught exception type:', es[0],'details:',es[1] )
@@ -191,40 +505,376 @@ class Server:
                 else:
                     raise e
 
+    def reply(self, client, response):
+        """
+        Send the response, if any.  The response is the payload, its codec id,
+        None if the request was not framed, and the frame flags.  Persistent
+        connections go back to waiting for requests, the rest are closed
+        """
+        if response is not None:
+            payload, codec_id, flags = response
+            if codec_id is None:
+                socket_send(client, payload)
+            else:
+                socket_send_frame(client, payload, codec=codec_id,
+                                  flags=flags)
+            if flags & FLAG_KEEPALIVE:
+                self.idle[client] = time.time()
+                self.inputs.append(client)
+                return
+        client.shutdown(socket.SHUT_RDWR)
+        client.close()
+
+    def close_idle(self):
+        """
+        Close the persistent connections idle for longer than the idle
+        timeout
+        """
+        if not self.idle:
+            return
+        now = time.time()
+        for client, tm in list(self.idle.items()):
+            if now - tm > self.idle_timeout:
+                del self.idle[client]
+                self.inputs.remove(client)
+                client.close()
+
+    def check_persister(self):
+        """
+        If writing the spool failed, answer the clients waiting for their
+        changes to reach the disk with the error, and raise SpoolFailed
+        """
+        error = self.queue.persister.error
+        if error is None:
+            return
+
+        message = ('could not write the spool, the server is stopping: %s'
+                   % error)
+        while self.parked:
+            seq, client, response = self.parked.popleft()
+            try:
+                self.reply(client, self.error_response(response, message))
+            except socket.error as e:
+                print( 'could not answer client:',e )
+        raise SpoolFailed(message)
+
+    def error_response(self, response, error):
+        """
+        A response like the given one, the same codec and framing, with only
+        the error, and closing the connection
+        """
+        payload, codec_id, flags = response
+        if codec_id is None:
+            codec = wqcodec.get(CODEC_YAML)
+        else:
+            codec = wqcodec.get(codec_id)
+        return codec.dumps({'error':error}), codec_id, 0
+
+    def send_persisted(self):
+        """
+        Answer the parked clients whose changes are now on disk
+        """
+        persister = self.queue.persister
+        persister.clear_wakeup()
+        while self.parked and persister.flushed(self.parked[0][0]):
+            seq, client, response = self.parked.popleft()
+            try:
+                self.reply(client, response)
+            except socket.error as e:
+                print( 'could not answer client:',e )
+
     def process_client_request(self, client):
         """
         client is a socket
 
-        We should be ready to recieve since we used select()
+        We should be ready to recieve since we used select().  Returns the
+        response for reply(), or None if the client closed the connection
         """
-        data = socket_recieve(client,self.buffsize)
-        if not data:
-            return
+        data, frame = socket_recieve_request(client,self.buffsize)
+        if not data and frame is None:
+            return None
+
+        message, codec, error = self.decode_request(data, frame)
+        if error is None:
+            self.identify(message, client)
+            payload = self.respond(message, codec)
+        else:
+            payload = error
+        if frame is None:
+            return payload, None, 0
+        return payload, codec.id, self.response_flags(frame, error)
+
+    def identify(self, message, conn):
+        """
+        Note who is on the other end of the connection for profile requests,
+        which only admins may make, rather than trusting the user the client
+        sends.  Not needed for other requests, where the user only picks the
+        jobs acted on
+        """
+        if isinstance(message, dict) and message.get('command') == 'profile':
+            message['peer_user'] = peer_user(conn)
+
+    def response_flags(self, frame, error):
+        """
+        Keep the connection if the client asked, unless the request could not
+        be read
+        """
+        if error is None and frame[2] & FLAG_KEEPALIVE:
+            return FLAG_KEEPALIVE
+        return 0
 
+    def decode_request(self, data, frame=None):
+        """
+        Parse the request with the codec given in its frame, YAML if it was
+        not framed.  Returns the message, the codec for the response and
+        None, or None, the codec and the encoded error response
+        """
         print( str(datetime.datetime.now()),'processing client request' )
         if self.verbosity > 1:
             print( data )
+
+        codec = wqcodec.get(CODEC_YAML)
+        if frame is not None:
+            version, codec_id, flags = frame
+            if version != PROTOCOL_VERSION:
+                ret = {"error":"unsupported protocol version %d, the server "
+                               "speaks version %d" % (version,PROTOCOL_VERSION)}
+                return None, codec, codec.dumps(ret)
+            if wqcodec.get(codec_id) is None:
+                # clients fall back to YAML, which every server has
+                ret = {"error":"unsupported codec %d" % codec_id,
+                       "codecs":wqcodec.names()}
+                return None, codec, codec.dumps(ret)
+            codec = wqcodec.get(codec_id)
+
+        tm0 = time.perf_counter()
         try:
-            message = yaml.load(data)
+            message = codec.loads(data)
         except:
-            ret = {"error":"could not process YAML request: '%s'" % data}
-            ret = yaml.dump(ret)
-            socket_send(client, ret)
-            return
+            ret = {"error":"could not process %s request: '%s'"
+                           % (codec.name.upper(), data)}
+            return None, codec, codec.dumps(ret)
+        seconds = time.perf_counter()-tm0
+        self.codec_stats.add_request(codec, frame is not None, len(data),
+                                     seconds)
+        self.queue.metrics.observe('codec_seconds', seconds,
+                                   (('codec',codec.name),('op','decode')))
+        return message, codec, None
+
+    def respond(self, message, codec=None):
+        """
+        Process the message and return the response encoded with the codec,
+        YAML by default
+        """
+        if codec is None:
+            codec = wqcodec.get(CODEC_YAML)
 
         self.queue.process_message(message)
         response = self.queue.get_response()
+        if isinstance(message, dict) and message.get('command') == 'stat' \
+                and 'response' in response:
+            response['response']['codecs'] = self.codec_stats.stats()
 
+        tm0 = time.perf_counter()
         try:
-            yaml_response = yaml.dump(response)
+            payload = codec.dumps(response)
         except:
-            errmess="server error creating YAML response; keyboard interrupt?"
+            errmess=("server error creating %s response; keyboard interrupt?"
+                     % codec.name.upper())
             err = {"error":errmess}
-            yaml_response = yaml.dump(err)
+            payload = codec.dumps(err)
+        seconds = time.perf_counter()-tm0
+        self.codec_stats.add_response(codec, len(payload), seconds)
+        self.queue.metrics.observe('codec_seconds', seconds,
+                                   (('codec',codec.name),('op','encode')))
 
         if self.verbosity > 2:
-            print( 'response:',yaml_response )
-        socket_send(client, yaml_response)
+            print( 'response:',payload )
+        return payload
+
+    async def _run_asyncio(self):
+        """
+        Serve clients with asyncio.
+
+        Each connection gets its own task, which reads and parses the request
+        and later writes the response, so a slow client holds up nobody else.
+        The requests are handed to a single scheduler task, the only one
+        touching the queue, which processes them in order of arrival.  As in
+        _run, a response is only sent once the changes it made are on disk.
+        """
+        loop = asyncio.get_running_loop()
+        self.requests = asyncio.Queue()
+
+        # (persist seq, future) of the clients waiting for the disk
+        self.persist_waiters = collections.deque()
+        self.spool_error = None
+        wakeup = self.queue.persister.wakeup_fd
+        loop.add_reader(wakeup, self._wake_persist_waiters)
+        try:
+            server = await asyncio.start_server(self._handle_client,
+                                                sock=self.sock)
+            serving = asyncio.ensure_future(server.serve_forever())
+            try:
+                await self._schedule()
+            finally:
+                serving.cancel()
+        finally:
+            loop.remove_reader(wakeup)
+
+    async def _schedule(self):
+        """
+        Process the requests one at a time, refreshing the queue when the
+        timeout has passed since the last full refresh
+        """
+        while True:
+            try:
+                message, codec, future = await asyncio.wait_for(
+                    self.requests.get(), self.until_refresh())
+            except asyncio.TimeoutError:
+                self.refresh_queue()
+                continue
+            if self.spool_error is not None:
+                # see _wake_persist_waiters; the requests still queued are
+                # answered with the error, not processed
+                while True:
+                    if future is not None and not future.cancelled():
+                        future.set_exception(SpoolFailed(self.spool_error))
+                    if self.requests.empty():
+                        break
+                    message, codec, future = self.requests.get_nowait()
+                # let the clients be answered
+                await asyncio.sleep(0.1)
+                raise SpoolFailed(self.spool_error)
+            if self.until_refresh() == 0.0:
+                self.refresh_queue()
+
+            response = self.respond(message, codec)
+            if not future.cancelled():
+                future.set_result((response, self.queue.persist_seq))
+
+    async def _handle_client(self, reader, writer):
+        print( str(datetime.datetime.now()),'Connected by',
+               writer.get_extra_info('peername') )
+        # bytes read past the last request, the start of pipelined ones
+        pending = bytearray()
+        first = True
+        try:
+            while True:
+                if first:
+                    data, frame = await self._recieve(reader, pending, first)
+                else:
+                    try:
+                        data, frame = await asyncio.wait_for(
+                            self._recieve(reader, pending, first),
+                            self.idle_timeout)
+                    except asyncio.TimeoutError:
+                        break
+                first = False
+                if not data and frame is None:
+                    break
+
+                message, codec, error = self.decode_request(data, frame)
+                if error is None and self.spool_error is not None:
+                    error = codec.dumps({'error':self.spool_error})
+                payload = error
+                if error is None:
+                    self.identify(message, writer.get_extra_info('socket'))
+                    future = asyncio.get_running_loop().create_future()
+                    await self.requests.put((message, codec, future))
+                    try:
+                        payload, seq = await future
+                        await self._wait_persisted(seq)
+                    except SpoolFailed as err:
+                        # answer with the error and close the connection
+                        payload = error = codec.dumps({'error':str(err)})
+
+                if frame is None:
+                    writer.write(payload)
+                    await writer.drain()
+                    break
+
+                flags = self.response_flags(frame, error)
+                header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION,
+                                           codec.id, flags, len(payload))
+                writer.writelines([header, payload])
+                await writer.drain()
+                if not flags & FLAG_KEEPALIVE:
+                    break
+        except (ConnectionError, OSError, ProtocolError,
+                asyncio.IncompleteReadError) as e:
+            print( 'caught exception talking to client:',e )
+            print( 'ignoring' )
+        finally:
+            writer.close()
+
+    async def _recieve(self, reader, pending, first=True):
+        """
+        Read a request the way socket_recieve_request does.  Only the first
+        request on a connection may be bare YAML.  Bytes read past the end of
+        a frame are left in pending for the next call
+        """
+        if pending:
+            data = bytes(pending)
+            del pending[:]
+        elif first:
+            data = await reader.read(self.buffsize)
+        else:
+            data = await reader.read(DEFAULT_RECV_BUFFSIZE)
+
+        while len(data) < FRAME_HEADER.size and data \
+                and FRAME_MAGIC.startswith(data[:len(FRAME_MAGIC)]):
+            tdata = await reader.read(FRAME_HEADER.size-len(data))
+            if not tdata:
+                break
+            data += tdata
+
+        if len(data) < FRAME_HEADER.size or not data.startswith(FRAME_MAGIC):
+            if not first:
+                if not data:
+                    return data, None
+                raise ProtocolError("expected a frame")
+            tdata = data
+            while len(tdata) == self.buffsize:
+                tdata = await reader.read(self.buffsize)
+                data += tdata
+            return data, None
+
+        version, codec, flags, size = \
+                parse_frame_header(data[:FRAME_HEADER.size])
+        end = FRAME_HEADER.size + size
+        if len(data) < end:
+            data += await reader.readexactly(end-len(data))
+        pending += data[end:]
+        return data[FRAME_HEADER.size:end], (version, codec, flags)
+
+    async def _wait_persisted(self, seq):
+        if self.spool_error is not None:
+            raise SpoolFailed(self.spool_error)
+        if self.queue.persister.flushed(seq):
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.persist_waiters.append((seq, future))
+        await future
+
+    def _wake_persist_waiters(self):
+        persister = self.queue.persister
+        persister.clear_wakeup()
+        waiters = self.persist_waiters
+        if persister.error is not None and self.spool_error is None:
+            # fail the waiting clients, and stop the scheduler once they
+            # are answered
+            self.spool_error = ('could not write the spool, the server is '
+                                'stopping: %s' % persister.error)
+            while waiters:
+                seq, future = waiters.popleft()
+                if not future.cancelled():
+                    future.set_exception(SpoolFailed(self.spool_error))
+            self.requests.put_nowait((None, None, None))
+            return
+        while waiters and persister.flushed(waiters[0][0]):
+            seq, future = waiters.popleft()
+            if not future.cancelled():
+                future.set_result(None)
 
 
     def wait_for_connection(self):
@@ -241,15 +891,28 @@ class Server:
                 # we just reached the timeout, refresh the queue
                 print( 'refreshing queue' )
                 self.queue.refresh()
+                self.queue.flush()
                 if self.verbosity > 1:
                     print_stat(self.queue.cluster.status())
 
 
+    def until_refresh(self):
+        """
+        Seconds until the next full refresh of the queue.  It is due once the
+        timeout has passed since the last one, even if requests kept coming,
+        so that incremental scheduling still catches what it missed
+        """
+        due = self.queue.time_refreshed + self.timeout
+        return max(0.0, due - time.time())
+
     def refresh_queue(self):
         print( str(datetime.datetime.now()),'refreshing queue' )
         self.queue.refresh()
+        self.queue.flush()
         if self.verbosity > 1:
             print_stat(self.queue.cluster.status())
+            print( 'pid checks: %(nchecks)d syscalls saved: %(nsaved)d' \
+                        % self.queue.liveness.stats() )
 
     def cleanup_failed_sockets(self, inputs, server):
         for sock in inputs:
@@ -257,6 +920,40 @@ class Server:
                 pass
                 #select([sock],[],[],0)
 
+class CodecStats:
+    """
+    Requests served and time spent decoding and encoding, for each codec
+    """
+    def __init__(self):
+        self.codecs = {}
+        self.nunframed = 0
+
+    def _get(self, codec):
+        if codec.name not in self.codecs:
+            self.codecs[codec.name] = {'nrequests':0,
+                                       'bytes_in':0,
+                                       'bytes_out':0,
+                                       'seconds':0.0}
+        return self.codecs[codec.name]
+
+    def add_request(self, codec, framed, nbytes, seconds):
+        st = self._get(codec)
+        st['nrequests'] += 1
+        st['bytes_in'] += nbytes
+        st['seconds'] += seconds
+        if not framed:
+            self.nunframed += 1
+
+    def add_response(self, codec, nbytes, seconds):
+        st = self._get(codec)
+        st['bytes_out'] += nbytes
+        st['seconds'] += seconds
+
+    def stats(self):
+        stats = copy.deepcopy(self.codecs)
+        stats['unframed'] = self.nunframed
+        return stats
+
 class Node:
     def __init__ (self, line):
         ls = line.split()
@@ -273,53 +970,339 @@ class Node:
         self.used   = 0
         self.online = True
 
+        # mask of the groups, set by the Cluster
+        self.gmask  = 0
+
+        # the Cluster indexing this node, told about every change in
+        # usage or online state
+        self.cluster = None
+
     def get_groups(self):
         return self.grps
 
     def set_online(self,truth_value):
+        oldfree = self.ncores-self.used
+        was_online = self.online
         self.online=truth_value
+        if self.cluster is not None:
+            self.cluster._node_changed(self, oldfree, was_online)
 
-    def reserve(self):
-        self.used+=1
+    def reserve(self, ncores=1):
+        oldfree = self.ncores-self.used
+        self.used+=ncores
         if (self.used>self.ncores):
             print( "Internal error." )
             sys.exit(1)
+        if self.cluster is not None:
+            self.cluster._node_changed(self, oldfree, self.online)
 
-    def unreserve(self):
-        self.used-=1
+    def unreserve(self, ncores=1):
+        oldfree = self.ncores-self.used
+        self.used-=ncores
         if (self.used<0):
             print( "Internal error." )
             sys.exit(1)
-            
-    
+        if self.cluster is not None:
+            self.cluster._node_changed(self, oldfree, self.online)
+
+
+class Candidates:
+    """
+    The online nodes satisfying the static part of a requirement (memory,
+    groups, cores), in host name order.
+
+    These only change when nodes go on or offline, so the Cluster caches
+    them per requirement.
+    """
+    def __init__(self, hosts, nodes):
+        self.hosts = hosts
+        self.hostset = frozenset(hosts)
+        if hosts:
+            self.max_ncores = max(nodes[h].ncores for h in hosts)
+        else:
+            self.max_ncores = 0
+
+        # the groups of all the candidates
+        self.gmask = 0
+        for h in hosts:
+            self.gmask |= nodes[h].gmask
+
+        self._nodes = nodes
+        self._usable = {}
+
+        # array positions of the hosts, set by the Cluster for the numpy
+        # engine
+        self.index = None
+
+    def usable_cores(self, threads):
+        """
+        Total cores usable by jobs with this many threads per process
+        """
+        ncores = self._usable.get(threads)
+        if ncores is None:
+            ncores = 0
+            for h in self.hosts:
+                ncores += (self._nodes[h].ncores//threads)*threads
+            self._usable[threads] = ncores
+        return ncores
+
+    def any_in_groups(self, gmask):
+        """
+        True if any candidate is in the groups of the mask
+        """
+        return (self.gmask & gmask) != 0
+
 
 class Cluster:
-    def __init__(self,filename):
+    def __init__(self,filename,engine=DEFAULT_ENGINE,
+                 placement=DEFAULT_PLACEMENT):
         self.filename=filename
+        self.engine=engine
+        # for jobs that don't name one
+        self.placement=placement
         self.nodes={}
 
         with open(filename) as fobj:
             for line in fobj:
                 nd = Node(line)
                 self.nodes[nd.host] = nd
-    
+
+        self._build_index()
+
+    def _build_index(self):
+        """
+        Build the indexes the matchers use to visit only candidate nodes.
+
+        The host order, groups and memory tiers are fixed by the description
+        file.  The free core buckets and the sorted free/idle host lists are
+        kept up to date by the nodes through _node_changed
+        """
+        self.hostnames = sorted(self.nodes)
+        self.host_order = dict((h,i) for i,h in enumerate(self.hostnames))
+
+        # group names interned to bit numbers; each node has the mask of its
+        # groups, so group tests are integer ANDs
+        self.group_bits = {}
+        self.grouped_mask = 0
+        for h in self.hostnames:
+            nd = self.nodes[h]
+            nd.gmask = 0
+            for g in nd.grps:
+                bit = self.group_bits.get(g)
+                if bit is None:
+                    bit = self.group_bits[g] = len(self.group_bits)
+                nd.gmask |= 1 << bit
+            self.grouped_mask |= nd.gmask
+
+        # hosts sorted by memory, for bisecting on min_mem
+        bymem = sorted(self.hostnames, key=lambda h: self.nodes[h].mem)
+        self.mem_tiers = [self.nodes[h].mem for h in bymem]
+        self.mem_tier_hosts = bymem
+
+        # nfree -> online hosts with exactly that many free cores
+        self.free_buckets = {}
+        # online hosts with any free cores, and with no used cores
+        self.free_hosts = []
+        self.idle_hosts = []
+        self.online_hosts = set()
+        self._candidates = {}
+
+        # bumped whenever capacity may have increased: cores freed or nodes
+        # set on or offline
+        self.version = 0
+
+        for h in self.hostnames:
+            nd = self.nodes[h]
+            nd.cluster = self
+            if not nd.online:
+                continue
+            self.online_hosts.add(h)
+            nfree = nd.ncores-nd.used
+            if nfree > 0:
+                self.free_buckets.setdefault(nfree, set()).add(h)
+                self.free_hosts.append(h)
+            if nd.used == 0:
+                self.idle_hosts.append(h)
+
+        # the same state in arrays for the numpy engine
+        if self.engine != 'python':
+            self.arrays = vector.ClusterArrays(self)
+        else:
+            self.arrays = None
+
+    def _node_changed(self, nd, oldfree, was_online):
+        """
+        Update the indexes after the usage or online state of a node changed
+        """
+        h = nd.host
+        nfree = nd.ncores-nd.used
+
+        if nfree > oldfree or was_online != nd.online:
+            self.version += 1
+
+        if self.arrays is not None:
+            self.arrays.node_changed(nd)
+
+        if was_online and oldfree > 0:
+            self.free_buckets[oldfree].discard(h)
+        if nd.online and nfree > 0:
+            self.free_buckets.setdefault(nfree, set()).add(h)
+
+        _update_sorted(self.free_hosts, h,
+                       was_online and oldfree > 0,
+                       nd.online and nfree > 0)
+        _update_sorted(self.idle_hosts, h,
+                       was_online and oldfree == nd.ncores,
+                       nd.online and nd.used == 0)
+
+        if was_online != nd.online:
+            if nd.online:
+                self.online_hosts.add(h)
+            else:
+                self.online_hosts.discard(h)
+            self._candidates.clear()
+
+    def candidates(self, min_mem=0.0, groups=[], notgroups=[], min_cores=0):
+        """
+        Get the Candidates for these static requirements; any group in groups
+        is accepted, nodes in any of notgroups are rejected.
+        """
+        try:
+            key = (min_mem, tuple(groups), tuple(notgroups), min_cores)
+            cands = self._candidates.get(key)
+        except TypeError:
+            # unhashable group names, never going to match anything
+            # sensible but don't choke on it
+            key = None
+            cands = None
+
+        if cands is None:
+            cands = self._find_candidates(min_mem, groups, notgroups,
+                                          min_cores)
+            if key is not None:
+                self._candidates[key] = cands
+        return cands
+
+    def group_mask(self, groups):
+        """
+        The mask of the named groups.  Names no node has, including ones
+        first seen in a requirement, add nothing since they match no node
+        """
+        mask = 0
+        for g in groups:
+            try:
+                bit = self.group_bits.get(g)
+            except TypeError:
+                continue
+            if bit is not None:
+                mask |= 1 << bit
+        return mask
+
+    def _find_candidates(self, min_mem, groups, notgroups, min_cores):
+        nodes = self.nodes
+        if len(groups) > 0:
+            include = self.group_mask(groups)
+            hosts = set(h for h in self.online_hosts
+                        if nodes[h].gmask & include)
+        else:
+            hosts = set(self.online_hosts)
+
+        if self.mem_tiers and min_mem > self.mem_tiers[0]:
+            i = bisect.bisect_left(self.mem_tiers, min_mem)
+            hosts.intersection_update(self.mem_tier_hosts[i:])
+
+        exclude = self.group_mask(notgroups)
+        if exclude:
+            hosts = set(h for h in hosts if not nodes[h].gmask & exclude)
+
+        if min_cores > 0:
+            hosts = [h for h in hosts if self.nodes[h].ncores >= min_cores]
+
+        hosts = sorted(hosts, key=self.host_order.__getitem__)
+        cands = Candidates(hosts, self.nodes)
+        if self.arrays is not None:
+            cands.index = self.arrays.index(hosts)
+        return cands
+
+    def free_candidates(self, cands):
+        """
+        Iterate over the candidates with at least one free core, in host
+        order, walking whichever of the two lists is shorter
+        """
+        nodes = self.nodes
+        if len(cands.hosts) <= len(self.free_hosts):
+            for h in cands.hosts:
+                nd = nodes[h]
+                if nd.used < nd.ncores:
+                    yield h
+        else:
+            hostset = cands.hostset
+            for h in self.free_hosts:
+                if h in hostset:
+                    yield h
+
+    def idle_candidates(self, cands):
+        """
+        Iterate over the candidates with no used cores, in host order
+        """
+        nodes = self.nodes
+        if len(cands.hosts) <= len(self.idle_hosts):
+            for h in cands.hosts:
+                if nodes[h].used == 0:
+                    yield h
+        else:
+            hostset = cands.hostset
+            for h in self.idle_hosts:
+                if h in hostset:
+                    yield h
+
+    def fingerprint(self):
+        """
+        A checksum of the description, telling whether usage saved in a
+        snapshot still applies
+        """
+        desc = [(h, self.nodes[h].ncores, self.nodes[h].mem,
+                 self.nodes[h].grps) for h in self.hostnames]
+        return zlib.crc32(repr(desc).encode('utf-8')) & 0xffffffff
+
+    def get_used(self):
+        """
+        The used cores of all nodes, in host order
+        """
+        return [self.nodes[h].used for h in self.hostnames]
+
+    def restore_used(self, used):
+        """
+        Set the used cores of all nodes from get_used() and rebuild the
+        indexes
+        """
+        for h,n in zip(self.hostnames, used):
+            self.nodes[h].used = n
+        self._build_index()
+
     def reserve(self,hosts):
-        for h in hosts:
-            self.nodes[h].reserve()
+        for h,ncores in hosts:
+            self.nodes[h].reserve(ncores)
 
     def unreserve(self,hosts):
-        for h in hosts:
-            self.nodes[h].unreserve()
+        for h,ncores in hosts:
+            self.nodes[h].unreserve(ncores)
 
     def status(self):
+        """
+        The usage of each node and of the cluster.  fragmentation is the
+        fraction of the free cores of online nodes that are not on idle
+        nodes, so can't be given to jobs wanting whole nodes
+        """
         res={}
         tot=0
         used=0
+        free=0
+        nidle=0
+        idle_cores=0
         use=[]
         nds=[]
-        nodes=list( self.nodes.keys() )
-        nodes.sort()
-        for h in nodes:
+        for h in self.hostnames:
             nds.append({'hostname':h,
                         'used':self.nodes[h].used,
                         'ncores':self.nodes[h].ncores,
@@ -331,14 +1314,68 @@ class Cluster:
             used+=self.nodes[h].used
             if (self.nodes[h].used>0):
                 use.append((h,self.nodes[h].used))  
+            if self.nodes[h].online:
+                free+=self.nodes[h].ncores-self.nodes[h].used
+                if self.nodes[h].used==0:
+                    nidle+=1
+                    idle_cores+=self.nodes[h].ncores
 
         res['used']=used
         res['ncores']=tot
         res['nnodes']=len(self.nodes)
+        res['nidle']=nidle
+        res['idle_cores']=idle_cores
+        if free > 0:
+            res['fragmentation']=1.0-float(idle_cores)/free
+        else:
+            res['fragmentation']=0.0
         res['nodes']=nds
         return res
 
 
+def compact_hosts(hosts):
+    """
+    An allocation as [host, ncores] runs.  Older versions listed the host
+    once for each core; runs are passed through
+    """
+    alloc = []
+    for h in hosts:
+        if isinstance(h, (list, tuple)):
+            h, ncores = h
+        else:
+            ncores = 1
+        if alloc and alloc[-1][0] == h:
+            alloc[-1][1] += ncores
+        else:
+            alloc.append([h, ncores])
+    return alloc
+
+def expand_hosts(alloc):
+    """
+    The allocation with each host repeated once for each core, as in a
+    hostfile
+    """
+    hosts = []
+    for h,ncores in alloc:
+        hosts += [h]*ncores
+    return hosts
+
+def alloc_ncores(alloc):
+    return sum(ncores for h,ncores in alloc)
+
+def _update_sorted(lst, item, was_in, is_in):
+    """
+    Insert or remove item from the sorted list lst when its membership
+    changed
+    """
+    if was_in == is_in:
+        return
+    i = bisect.bisect_left(lst, item)
+    if is_in:
+        lst.insert(i, item)
+    else:
+        del lst[i]
+
 def _get_dict_int(d, key, default):
     reason=''
     try:
@@ -350,6 +1387,28 @@ def _get_dict_int(d, key, default):
 
     return N, reason
 
+def _get_walltime(d):
+    """
+    The walltime requirement in seconds, given as seconds or as a
+    [[hours:]minutes:]seconds string, or None if not given
+    """
+    val = d.get('walltime', None)
+    if val is None:
+        return None, ''
+    try:
+        if isinstance(val, str) and ':' in val:
+            seconds = 0.0
+            for part in val.split(':'):
+                seconds = seconds*60 + float(part)
+        else:
+            seconds = float(val)
+    except:
+        return None, ("failed to extract walltime requirement: %s"
+                      % (sys.exc_info()[1],))
+    if not seconds >= 0:
+        return None, "walltime must be positive, got '%s'" % (val,)
+    return seconds, ''
+
 def _get_dict_float(d, key, default):
     reason=''
     try:
@@ -361,6 +1420,140 @@ def _get_dict_float(d, key, default):
     return f, reason
 
 
+class FairShare:
+    """
+    The exponentially decayed core-seconds used by each user, and the users
+    in order of that usage.
+
+    Usage is kept scaled by 2**((t-t0)/halflife), which cancels the decay:
+    the scaled usage of a user only grows while they have cores running,
+    and the order of the others never changes.  The heap of (scaled usage,
+    count, user) gets a new entry only when a user's usage is brought up to
+    date; outdated entries are dropped as they come to the top.  The count
+    breaks ties in the order the entries were made
+    """
+    # rebase before the scale overflows a float
+    _MAX_EXPONENT = 512.0
+
+    def __init__(self, halflife=DEFAULT_FAIRSHARE_HALFLIFE, now=None):
+        self.halflife = float(halflife)
+        self.t0 = _clock() if now is None else now
+        self.scaled = {}
+        self.ncores = {}
+        # when the scaled usage was last brought up to date
+        self.since = {}
+        self.heap = []
+        self.count = 0
+
+    def _scale(self, t):
+        return 2.0 ** ((t-self.t0)/self.halflife)
+
+    def _push(self, user):
+        self.count += 1
+        heapq.heappush(self.heap, (self.scaled[user], self.count, user))
+
+    def _rebase(self, now):
+        if (now-self.t0)/self.halflife < self._MAX_EXPONENT:
+            return
+        factor = 1.0/self._scale(now)
+        for user in self.scaled:
+            self.scaled[user] *= factor
+        self.t0 = now
+        self.heap = []
+        for user in self.scaled:
+            self._push(user)
+
+    def add(self, user, now=None):
+        """
+        Start tracking a user, with no usage
+        """
+        if user not in self.scaled:
+            self.scaled[user] = 0.0
+            self.since[user] = _clock() if now is None else now
+            self._push(user)
+
+    def update(self, user, now):
+        """
+        Add the usage of a user's running cores up to now
+        """
+        self._rebase(now)
+        self.add(user, now)
+        ncores = self.ncores.get(user, 0)
+        last = self.since[user]
+        if ncores > 0 and now > last:
+            k = self.halflife/math.log(2.0)
+            self.scaled[user] += ncores*k*(self._scale(now)-self._scale(last))
+            self._push(user)
+        self.since[user] = now
+
+    def set_cores(self, user, ncores, now=None):
+        """
+        The user now has this many cores running
+        """
+        if now is None:
+            now = _clock()
+        self.update(user, now)
+        self.ncores[user] = ncores
+
+    def usage(self, user, now=None):
+        """
+        The decayed core-seconds used, up to now
+        """
+        if now is None:
+            now = _clock()
+        if user not in self.scaled:
+            return 0.0
+        self.update(user, now)
+        return self.scaled[user]/self._scale(now)
+
+    def order(self, now=None):
+        """
+        All users, least usage first
+        """
+        if now is None:
+            now = _clock()
+        for user,ncores in self.ncores.items():
+            if ncores > 0:
+                self.update(user, now)
+
+        # the entries come out sorted, and a sorted list is a heap, so it
+        # is kept as the new heap
+        heap = self.heap
+        entries = []
+        seen = set()
+        while heap:
+            entry = heapq.heappop(heap)
+            value, count, user = entry
+            if user in seen or value != self.scaled[user]:
+                continue
+            seen.add(user)
+            entries.append(entry)
+        self.heap = entries
+        return [user for value,count,user in entries]
+
+    def state(self, now=None):
+        """
+        The usage of all users at now, for saving
+        """
+        if now is None:
+            now = _clock()
+        return {'time':now,
+                'usage':dict((u, self.usage(u, now)) for u in self.scaled)}
+
+    def restore(self, state, now=None):
+        """
+        Take the usage saved by state(), decayed since it was saved
+        """
+        if now is None:
+            now = _clock()
+        decay = 2.0 ** (-max(now-state['time'], 0.0)/self.halflife)
+        scale = self._scale(now)
+        for user,usage in state['usage'].items():
+            self.add(user, now)
+            self.update(user, now)
+            self.scaled[user] += usage*decay*scale
+            self._push(user)
+
 class Users:
     """
     Simple encapsulation so we can easily serialize
@@ -369,6 +1562,8 @@ class Users:
     def __init__(self):
         self.users = {}
         self.verbosity = 1
+        # set for fair-share scheduling
+        self.fairshare = None
     def __contains__(self, user):
         return user in self.users
 
@@ -380,7 +1575,7 @@ class Users:
 
             print( 'Loading user info from:',fname )
             with open(fname) as fobj:
-                data = yaml.load(fobj)
+                data = yaml.safe_load(fobj)
 
             self.users={}
             for user,udata in data.items():
@@ -392,14 +1587,20 @@ class Users:
         """
         Write to file.  Only the username and limits are saved.
         """
+        with open(fname,'w') as fobj:
+            fobj.write(self.dumps())
+
+    def dumps(self):
+        """
+        The YAML written by tofile()
+        """
         data={}
         for user,udata in self.users.items():
             data[user] = {}
             data[user]['user'] = user
             data[user]['limits'] = udata['limits']
 
-        with open(fname,'w') as fobj:
-            yaml.dump(data, fobj)
+        return yaml.dump(data)
 
     def get(self, user):
         udata = self.users.get(user,None)
@@ -420,17 +1621,19 @@ class Users:
         if udata is None:
             udata = self.add_new(user)
 
-        ncores = len(hosts)
+        ncores = alloc_ncores(hosts)
         if ncores > 0:
             udata['Njobs'] += 1
             udata['Ncores'] += ncores
+            if self.fairshare is not None:
+                self.fairshare.set_cores(user, udata['Ncores'])
 
     def decrement_user(self, user, hosts):
         udata = self.users.get(user,None)
         if not udata:
             return
 
-        ncores = len(hosts)
+        ncores = alloc_ncores(hosts)
         if ncores > 0:
             udata['Njobs'] -= 1
             udata['Ncores'] -= ncores
@@ -440,37 +1643,99 @@ class Users:
         if udata['Ncores'] < 0:
             udata['Ncores'] = 0
 
+        if self.fairshare is not None:
+            self.fairshare.set_cores(user, udata['Ncores'])
+
+    def sync_fairshare(self):
+        """
+        Tell the fair-share usage about the running cores of all users,
+        e.g. after they were restored from a snapshot
+        """
+        now = _clock()
+        for user,udata in self.users.items():
+            self.fairshare.set_cores(user, udata['Ncores'], now)
+
 
     def _new_user(self, user):
         return {'user':user,'Njobs':0,'Ncores':0,'limits':{}}
 
     def asdict(self):
-        return copy.deepcopy(self.users)
+        users = copy.deepcopy(self.users)
+        if self.fairshare is not None:
+            now = _clock()
+            for user,udata in users.items():
+                udata['usage'] = self.fairshare.usage(user, now)
+        return users
+
+# flags of the jobs saved in a snapshot
+_SNAP_MARKER = 1
+_SNAP_TIME_RUN = 2
+_SNAP_HOSTS = 4
+
+# The parsed requirements of a job.  groups/notgroups are the 'group' and
+# 'notgroup' lists, group is the single group wanted in bygroup mode; error is
+# set when the requirements can never be met; walltime is the expected run
+# time in seconds, or None; placement is the placement policy, or None for the
+# server's.  Specs saved before walltime and placement existed load with the
+# defaults
+Requirement = collections.namedtuple('Requirement',
+                                     ['mode','N','threads','min_mem',
+                                      'min_cores','groups','notgroups',
+                                      'host','group','priority','error',
+                                      'walltime','placement'],
+                                     defaults=[None,None])
+
+# compiled requirements by value, so equal ones are kept once
+_SPECS = {}
+_MAX_SPECS = 10000
+
+# the fields every job may have, kept in slots; anything else sent in the
+# submit message goes in the job's extra dict
+JOB_FIELDS = ('command','pid','user','require','commandline','status',
+              'reason','priority','time_sub','time_run','spool_fname',
+              'spool_wait','hosts','parent')
+_JOB_FIELDS = frozenset(JOB_FIELDS)
+_UNSET = object()
+
+# string fields repeated across many jobs, kept once
+_JOB_INTERNED = frozenset(['command','user','status','reason','priority'])
+
+class Job:
+    """
+    A job in the queue.  With many thousands of jobs queued a dict per job
+    dominates the memory, so the fields are slots and the repeated strings
+    are interned.  Jobs still read and write like the dict of the submit
+    message, job['status'], and asdict() gives that dict for lsfull; the
+    scheduling loops use the attributes, job.status, which are faster
+    """
+    __slots__ = JOB_FIELDS + ('extra','spool_dir','wait_sleep','marker',
+                              'spec','seq')
 
-class Job(dict):
+    verbosity = 1
 
     def __init__(self, message, **keys):
         # make sure pid,require are in message
         # and copy them into self
 
+        self.extra = None
         for k in message:
             self[k] = message[k]
 
         if 'require' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'require' field not in message"
+            self.status = 'nevermatch'
+            self.reason = "'require' field not in message"
         elif 'pid' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'pid' field not in message"
+            self.status = 'nevermatch'
+            self.reason = "'pid' field not in message"
         elif 'user' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'user' field not in message"
+            self.status = 'nevermatch'
+            self.reason = "'user' field not in message"
         elif 'commandline' not in self:
-            self['status'] = 'nevermatch'
-            self['reason'] = "'commandline' field not in message"
+            self.status = 'nevermatch'
+            self.reason = "'commandline' field not in message"
         else:
-            self['status'] = 'wait'
-            self['reason'] = ''
+            self.status = 'wait'
+            self.reason = ''
 
         spool_dir = keys.get('spool_dir',DEFAULT_SPOOL_DIR)
         self.spool_dir = os.path.expanduser(spool_dir)
@@ -482,52 +1747,279 @@ class Job(dict):
             self['status'] = 'nevermatch'
             self['reason']="priority must be on of: " + ",".join(PRIORITY_LIST)
 
-        self['time_sub'] = time.time()
-        self['spool_fname'] = None
+        self.time_sub = _clock()
+        self.spool_fname = None
 
-        self.verbosity = 1
+        # set when the pid.run file exists
+        self.marker = False
+
+        self.compile_require()
+
+    @classmethod
+    def restore(cls, fields, spec, spool_dir, wait_sleep, marker):
+        """
+        Rebuild a job saved in a snapshot, reusing its compiled requirements
+        """
+        job = cls.__new__(cls)
+        job.extra = None
+        for k,v in fields.items():
+            job[k] = v
+        job.spool_dir = spool_dir
+        job.wait_sleep = wait_sleep
+        job.marker = marker
+        job.spec = spec
+        return job
+
+    def __getitem__(self, key):
+        if key in _JOB_FIELDS:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in _JOB_FIELDS:
+            if key in _JOB_INTERNED and type(value) is str:
+                value = sys.intern(value)
+            setattr(self, key, value)
+        else:
+            # unpickling jobs written when they were dicts sets the items
+            # before __setstate__
+            extra = getattr(self, 'extra', None)
+            if extra is None:
+                extra = self.extra = {}
+            extra[key] = value
+
+    def __delitem__(self, key):
+        if key in _JOB_FIELDS:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self.extra is None:
+            raise KeyError(key)
+        else:
+            del self.extra[key]
 
-    def spool(self):
-        if self['status'] == 'ready':
-            self['status'] = 'run'
+    def __contains__(self, key):
+        if key in _JOB_FIELDS:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
 
-        fname = os.path.join(self.spool_dir,str(self['pid'])+'.'+self['status'])
-        self.unspool() ## just remove the old one first
-                       ## we could just rename, but things that were waiting
-                       ## maybe running now
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except (KeyError, TypeError):
+            return default
 
-        self['spool_fname'] = fname
-        self['spool_wait'] = self.wait_sleep
-        if self['status'] in ['ready','run']:
-            self['time_run'] = time.time()
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def keys(self):
+        return list(self.asdict())
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return list(self.asdict().items())
+
+    def __getstate__(self):
+        # the compiled requirements are rebuilt on load
+        return (self.asdict(), {'spool_dir':self.spool_dir,
+                                'wait_sleep':self.wait_sleep,
+                                'marker':getattr(self,'marker',False)})
+
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            fields, attrs = state
         else:
-            self['time_run'] = None
-            
-        with open(fname,'wb') as fobj:
-            pickle.dump(self,fobj,-1) #highest protocol
-
-    def unspool(self):
-        if (self['spool_fname']):
-            if os.path.exists(self['spool_fname']):
-                os.remove(self['spool_fname'])
-            self['spool_fname']=None
-    
+            # written when jobs were dicts: the fields were already set
+            # item by item, the state holds the attributes
+            fields, attrs = {}, state
+        if not hasattr(self, 'extra'):
+            self.extra = None
+        for k,v in fields.items():
+            self[k] = v
+        for k in ['spool_dir','wait_sleep','marker']:
+            if k in attrs:
+                setattr(self, k, attrs[k])
+        self.compile_require()
+
+    def compile_require(self):
+        """
+        Parse the requirements into a hashable Requirement.  This is done once
+        at submit, and jobs with identical requirements get equal specs, so
+        match results can be shared between them
+        """
+        reqs = self['require']
+
+        mode = reqs.get('mode','bycore')
+        N, threads, min_mem, min_cores = 1, 1, 0.0, 0
+        host = None
+        group = None
+        reason = ''
+
+        if mode in ['bycore','bycore1','bynode','byhost']:
+            N,reason=_get_dict_int(reqs, 'N', 1)
+
+        if not reason and mode == 'bycore':
+            threads,reason = _get_dict_int(reqs, 'threads', 1)
+            if not reason:
+                if (threads<1):
+                    threads=1
+                if (N%threads>0):
+                    reason = ('Number of requested cores not divisible '
+                              'by threads')
+
+        if not reason and mode in ['bycore','bycore1','bynode']:
+            min_mem, reason = _get_dict_float(reqs,'min_mem',0.0)
+
+        if not reason and mode == 'bynode':
+            min_cores,reason=_get_dict_int(reqs, 'min_cores', 0)
+
+        walltime = None
+        if not reason:
+            walltime, reason = _get_walltime(reqs)
+
+        placement_name = reqs.get('placement',None)
+        if not reason and placement_name is not None:
+            try:
+                placement.get(placement_name)
+            except (KeyError, TypeError):
+                reason = ("placement must be one of: %s"
+                          % ",".join(placement.POLICIES))
+
+        if mode == 'byhost':
+            host = reqs.get('host',None)
+            if host is None:
+                reason = "'host' field not in requirements"
+        elif mode == 'bygroup':
+            group = reqs.get('group',None)
+            if not group:
+                reason = 'Need to specify group'
+            elif isinstance(group, list):
+                # never equal to a group name
+                group = tuple(group)
+        elif mode not in ['bycore','bycore1','bynode']:
+            reason = "bad submit_mode '%s'" % (mode,)
+
+        if reason:
+            N, threads, min_mem, min_cores = 1, 1, 0.0, 0
+            walltime = None
+            placement_name = None
+
+        spec = Requirement(mode=mode,
+                           N=N,
+                           threads=threads,
+                           min_mem=min_mem,
+                           min_cores=min_cores,
+                           groups=tuple(self._get_req_list(reqs, 'group')),
+                           notgroups=tuple(self._get_req_list(reqs,
+                                                              'notgroup')),
+                           host=host,
+                           group=group,
+                           priority=self['priority'],
+                           error=reason,
+                           walltime=walltime,
+                           placement=placement_name)
+        try:
+            hash(spec)
+        except TypeError:
+            spec = Requirement(mode=str(mode), N=1, threads=1, min_mem=0.0,
+                               min_cores=0, groups=(), notgroups=(),
+                               host=None, group=None,
+                               priority=str(self['priority']),
+                               error='requirements must be scalars or '
+                                     'lists of scalars')
+
+        # jobs with the same requirements share one spec
+        if len(_SPECS) >= _MAX_SPECS:
+            _SPECS.clear()
+        self.spec = _SPECS.setdefault(spec, spec)
+
+    def spool(self, journal, batch=None):
+        """
+        Record the job in the journal.  When a waiting job starts, an empty
+        pid.run file is written for its client, which is polling for it.
+
+        New jobs are added to the batch instead, if given, to be journaled
+        together
+        """
+        if self.status == 'ready':
+            self.status = 'run'
+
+        waited = self.spool_fname is not None
+
+        fname = os.path.join(self.spool_dir,str(self.pid)+'.run')
+        self.spool_fname = fname
+        self.spool_wait = self.wait_sleep
+        if self.status in ['ready','run']:
+            self.time_run = _clock()
+        else:
+            self.time_run = None
+
+        if waited and self.status == 'run':
+            journal.append(('run',self.pid,self.hosts,self.time_run))
+            if 'parent' not in self:
+                journal.set_file(fname,'')
+                self.marker = True
+        elif batch is not None:
+            batch.append(self)
+        else:
+            journal.append(('sub',self))
+
+    def task(self, index, commandline):
+        """
+        A task of a bulk submission, made from this job as the template and
+        sharing its compiled requirements
+        """
+        fields = dict(self)
+        fields['pid'] = '%s.%d' % (self['pid'],index)
+        fields['parent'] = self['pid']
+        fields['commandline'] = commandline
+        return Job.restore(fields, self.spec, self.spool_dir, self.wait_sleep,
+                           False)
+
+    def unspool(self, journal):
+        journal.append(('done',self.pid))
+        if getattr(self,'marker',False):
+            journal.set_file(self.spool_fname,None)
+            self.marker = False
+        self.spool_fname=None
 
     def match(self, cluster, blocked_groups):
-        if self['status'] == 'nevermatch':
+        """
+        blocked_groups is a mask of the cluster group bits
+        """
+        if self.status == 'nevermatch':
             return
-        if self['status'] != 'wait':
+        if self.status != 'wait':
             return
         ## We don't block ourserlves
-        if self['priority'] == 'block':
-            blocked_groups=[]
+        if self.priority == 'block':
+            blocked_groups=0
  
-        # default to bycore
-        submit_mode = self['require'].get('mode','bycore')
-        # can also add reasons from the match methods
-        # later
+        spec = self.spec
+        submit_mode = spec.mode
 
-        if (submit_mode=='bycore'):
+        if spec.error:
+            pmatch=False
+            reason=spec.error
+        elif (submit_mode=='bycore'):
             pmatch, match, hosts, reason = \
                     self._match_bycore(cluster,blocked_groups)
         elif (submit_mode=='bycore1'):
@@ -539,12 +2031,9 @@ class Job(dict):
         elif (submit_mode=='byhost'):
             pmatch, match, hosts,reason = \
                     self._match_byhost(cluster,blocked_groups)
-        elif (submit_mode=='bygroup'):
+        else:
             pmatch, match, hosts,reason = \
                     self._match_bygroup(cluster,blocked_groups)
-        else:
-            pmatch=False ## unknown request never mathces
-            reason="bad submit_mode '%s'" % submit_mode
 
 
         if pmatch:
@@ -568,8 +2057,8 @@ class Job(dict):
         """
         
         # if user is not even known, then we are good
-        if self['user'] in users:
-            udata = users.get(self['user'])
+        if self.user in users:
+            udata = users.get(self.user)
             # if no limits are specified, we are good
             ulimits = udata['limits']
             if ulimits:
@@ -600,99 +2089,31 @@ class Job(dict):
         return val
 
 
-    def _match_bycore(self, cluster, bgroups):
+    def _match_bycore(self, cluster, bmask):
         pmatch=False
         match=False
-        hosts=[] # actually matched hosts
+        hosts=[] # actually matched hosts, as [host, ncores]
         reason=''
 
-        reqs = self['require']
-
-        N,reason=_get_dict_int(reqs, 'N', 1)
-        if reason:
-            return pmatch, match, hosts, reason
-
-        threads,reason = _get_dict_int(reqs, 'threads', 1)
-        if reason:
-            return pmatch, match, hosts, reason
-
-        if (threads<1):
-            threads=1
-
-        if (N%threads>0):
-            reason = 'Number of requested cores not divisible by threads'
-            return pmatch, match, hosts, reason
-        print( "threads,N",threads,N )
-        Np=N
-
-        min_mem, reason = _get_dict_float(reqs,'min_mem',0.0)
-        if reason:
-            return pmatch, match, hosts, reason
-
-        block_flag=False
-        for h in sorted(cluster.nodes):
-            nd = cluster.nodes[h]
-            if(not nd.online):
-                continue
-            if (nd.mem < min_mem):
-                continue
-
-            ## is this node actually what we want
-            ing = self._get_req_list(reqs, 'group')
-            if len(ing) > 0: ##any group in any group
-                ok=False
-                for g in ing:
-                    if g in nd.grps:
-                        ok=True
-                        break
-                if (not ok):
-                    continue ### not in the group
-                    
-            ing = self._get_req_list(reqs, 'notgroup')
-            if len(ing) > 0: ##any group in any group
-                ok=True
-                for g in ing:
-                    if g in nd.grps:
-                        ok=False
-                        break
-                if (not ok):
-                    continue ### not in the group
-                
-            # usable cores must be multiple of
-            # number of threads requested
-            pucores = (nd.ncores//threads)*threads
-
-            if (pucores>=Np):
-                pmatch=True
-            else:
-                Np-=pucores
+        spec = self.spec
+        N = spec.N
+        threads = spec.threads
+        if self.verbosity > 1:
+            print( "threads,N",threads,N )
 
-            nfree= nd.ncores-nd.used
-            nfree = (nfree//threads)*threads
+        cands = cluster.candidates(spec.min_mem, spec.groups, spec.notgroups)
 
-            if len(bgroups) > 0: ##any group in any group
-                ok=True
-                for g in bgroups:
-                    if g in nd.grps:
-                        ok=False
-                        block_flag=True
-                        break
-                if (not ok):
-                    nfree=0
+        # usable cores must be multiple of number of threads requested
+        if len(cands.hosts) > 0 and cands.usable_cores(threads) >= N:
+            pmatch=True
 
-            if (nfree>=N):
-                hosts += [h]*N
-                N=0
-                match=True
-                break
-            else:
-                N-=nfree
-                hosts += [h]*nfree
+            policy = placement.get(spec.placement or cluster.placement)
+            match, hosts = policy.fill(cluster, cands, N, threads, bmask)
  
         if (not pmatch):
             reason = 'Not enough cores or mem satistifying condition.'
         elif (not match):
-            if (block_flag):
+            if cands.any_in_groups(bmask):
                 reason = ('Not enough free cores or cores waiting '
                           'for a blocking job.')
             else:
@@ -704,84 +2125,36 @@ class Job(dict):
 
 
 
-    def _match_bycore1(self, cluster,bgroups):
+    def _match_bycore1(self, cluster,bmask):
         """
         Get cores all from one node.
         """
         pmatch=False
         match=False
-        hosts=[] # actually matched hosts
+        hosts=[] # actually matched hosts, as [host, ncores]
         reason=''
 
-        reqs = self['require']
-
-        N,reason=_get_dict_int(reqs, 'N', 1)
-        if reason:
-            return pmatch, match, hosts, reason
-        Np=N
+        spec = self.spec
+        N = spec.N
 
-        min_mem, reason = _get_dict_float(reqs,'min_mem',0.0)
-        if reason:
-            return pmatch, match, hosts, reason
+        cands = cluster.candidates(spec.min_mem, spec.groups, spec.notgroups)
 
-        block_flag=False
-        for h in sorted(cluster.nodes):
-            nd = cluster.nodes[h]
-            if(not nd.online):
-                continue
-            if (nd.mem < min_mem):
-                continue
-            
-            ## is this node actually what we want
-            ing = self._get_req_list(reqs, 'group')
-            if len(ing) > 0: ##any group in any group
-                ok=False
-                for g in ing:
-                    if g in nd.grps:
-                        ok=True
-                        break
-                if (not ok):
-                    continue ### not in the group
-                    
-            ing = self._get_req_list(reqs, 'notgroup')
-            if len(ing) > 0: ##any group in any group
-                ok=True
-                for g in ing:
-                    if g in nd.grps:
-                        ok=False
-                        break
-                if (not ok):
-                    continue ### not in the group
-
-            if (nd.ncores>=Np):
-                pmatch=True
-            else:
-                pass
+        if cands.max_ncores >= N and len(cands.hosts) > 0:
+            pmatch=True
 
-            nfree= nd.ncores-nd.used
-            
-            if len(bgroups) > 0: ##any group in any group
-                ok=True
-                for g in bgroups:
-                    if g in nd.grps:
-                        ok=False
-                        block_flag=True
-                        break
-                if (not ok):
-                    nfree=0 
+            # the host with enough free cores the placement policy prefers
+            policy = placement.get(spec.placement or cluster.placement)
+            best = policy.pick(cluster, cands, N, bmask)
 
-            if (nfree>=N):
-                hosts += [h]*N
-                N=0
+            if best is not None:
+                if N > 0:
+                    hosts.append([best,N])
                 match=True
-                break
-            else:
-                pass
 
         if (not pmatch):
             reason = 'Not a node with that many cores.'
         elif (not match):
-            if (block_flag):
+            if cands.any_in_groups(bmask):
                 reason = ('Not enough free cores or cores waiting '
                           'for a blocking job.')
             else:
@@ -790,82 +2163,43 @@ class Job(dict):
         return pmatch, match, hosts, reason
        
 
-    def _match_bynode(self, cluster,bgroups):
+    def _match_bynode(self, cluster,bmask):
         pmatch=False
         match=False
-        hosts=[] # actually matched hosts
+        hosts=[] # actually matched hosts, as [host, ncores]
         reason=''
 
-        reqs = self['require']
-
-        N,reason=_get_dict_int(reqs, 'N', 1)
-        if reason:
-            return pmatch, match, hosts, reason
-
-        Np=N
-
-        min_mem, reason = _get_dict_float(reqs,'min_mem',0.0)
-        if reason:
-            return pmatch, match, hosts, reason
+        spec = self.spec
+        N = spec.N
 
-        min_cores,reason=_get_dict_int(reqs, 'min_cores', 0)
-        if reason:
-            return pmatch, match, hosts, reason
+        cands = cluster.candidates(spec.min_mem, spec.groups, spec.notgroups,
+                                   spec.min_cores)
 
-        block_flag=False
-        for h in sorted(cluster.nodes):
-            nd = cluster.nodes[h]
-            if(not nd.online):
-                continue
-            if (nd.mem < min_mem):
-                continue
-            if nd.ncores < min_cores:
-                continue
+        if N > 0 and len(cands.hosts) >= N:
+            pmatch=True
 
-            ## is this node actually what we want
-            ing = self._get_req_list(reqs, 'group')
-            if len(ing) > 0: ##any group in any group
-                ok=False
-                for g in ing:
-                    if g in nd.grps:
-                        ok=True
-                        break
-                if (not ok):
-                    continue ### not in the group
-
-            ing = self._get_req_list(reqs, 'notgroup')
-            if len(ing) > 0: ##any group in any group
-                ok=True
-                for g in ing:
-                    if g in nd.grps:
-                        ok=False
-                        break
-                if (not ok):
-                    continue ### not in the group
-            
-            Np-=1
-            if (Np==0):
-                pmatch=True
-
-            ok=True
-            if len(bgroups) > 0: ##any group in any group ##########nfree?
-                for g in bgroups:
-                    if g in nd.grps:
-                        ok=False
-                        block_flag=True
+            if cluster.arrays is not None:
+                match, hosts = cluster.arrays.idle_nodes(cands.index, N,
+                                                         bmask)
+            else:
+                for h in cluster.idle_candidates(cands):
+                    nd = cluster.nodes[h]
+                    if nd.gmask & bmask:
+                        continue
+
+                    N-=1
+                    hosts.append([h,nd.ncores])
+                    if (N==0):
+                        match=True
                         break
 
-            if (nd.used==0) and ok:
-                N-=1
-                hosts += [h]*nd.ncores
-                if (N==0):
-                    match=True
-                    break
+            if not match:
+                hosts=[]
 
         if (not pmatch):
             reason = 'Not enough total cores satistifying condition.'
         elif (not match):
-            if (block_flag):
+            if cands.any_in_groups(bmask):
                 reason = ('Not enough free cores or cores '
                           'waiting for a blocking job.')
             else:
@@ -874,19 +2208,15 @@ class Job(dict):
 
         return pmatch, match, hosts, reason
 
-    def _match_byhost(self, cluster, bgroups):
+    def _match_byhost(self, cluster, bmask):
 
         pmatch=False
         match=False
-        hosts=[] # actually matched hosts
+        hosts=[] # actually matched hosts, as [host, ncores]
         reason=''
 
-        reqs = self['require']
-        
-        h = reqs.get('host',None)
-        if h is None:
-            reason = "'host' field not in requirements"
-            return pmatch, match, hosts, reason
+        spec = self.spec
+        h = spec.host
 
         # make sure the node name exists
         if h not in cluster.nodes:
@@ -899,21 +2229,19 @@ class Job(dict):
             reason = "host is offline"
             return pmatch, match, hosts, reason
 
-        for g in nd.grps:
-            if g in bgroups:
-                reason="host in blocked group"
-                return pmatch, match, hosts, reason
-
-        N,reason=_get_dict_int(reqs, 'N', 1)
-        if reason:
+        if nd.gmask & bmask:
+            reason="host in blocked group"
             return pmatch, match, hosts, reason
 
+        N = spec.N
+
         if nd.ncores >= N:
             pmatch=True
 
         nfree = nd.ncores-nd.used
         if (nfree>=N):
-            hosts += [h]*N
+            if N > 0:
+                hosts.append([h,N])
             N=0
             match=True
         else:
@@ -922,55 +2250,110 @@ class Job(dict):
         return pmatch, match, hosts, reason
 
 
-    def _match_bygroup(self, cluster, bgroups):
+    def _match_bygroup(self, cluster, bmask):
 
         pmatch=False
         match=False
-        hosts=[] # actually matched hosts
+        hosts=[] # actually matched hosts, as [host, ncores]
         reason=''
 
-        reqs = self['require']
-        g=reqs.get('group',None)
-        if not g:
-            pmatch=False
-            reason = 'Need to specify group'
-        else:
-            for h in sorted(cluster.nodes):
-                nd = cluster.nodes[h]
-                if(not nd.online):
-                    continue
-                if g in nd.grps:
-                    pmatch=True
-                    match=True
-                    if (nd.used>0):
-                        match=False ## we actually demand the entire group
-                        reason = 'Host '+h+' not entirely free.'
-                        break
-                    ok=True
-                    for g in nd.grps:
-                        if g in bgroups:
-                            ok=False
-                            break
-                    if (not ok):
-                        match=False
-                        reason = 'Host '+h+' in a blocked group.'
-                        break
-
-                    else:
-                        hosts += [h]*nd.ncores
-                        #for x in range(nd.ncores):
-                        #    hosts.append(h)
-            if (not pmatch):
-                reason = 'Not a single node in that group'
+        cands = cluster.candidates(groups=[self.spec.group])
+        for h in cands.hosts:
+            nd = cluster.nodes[h]
+            pmatch=True
+            match=True
+            if (nd.used>0):
+                match=False ## we actually demand the entire group
+                reason = 'Host '+h+' not entirely free.'
+                break
+            if nd.gmask & bmask:
+                match=False
+                reason = 'Host '+h+' in a blocked group.'
+                break
+            else:
+                hosts.append([h,nd.ncores])
+        if (not pmatch):
+            reason = 'Not a single node in that group'
         return pmatch, match, hosts, reason
 
 
     def asdict(self):
         d={}
-        for k in self:
-            d[k] = self[k]
+        for k in JOB_FIELDS:
+            v = getattr(self, k, _UNSET)
+            if v is not _UNSET:
+                d[k] = v
+        if self.extra:
+            d.update(self.extra)
         return d
 
+    def __repr__(self):
+        return 'Job(%r)' % (self.asdict(),)
+
+def _job_name(job):
+    require = job.require
+    if 'job_name' in require:
+        return require['job_name']
+    words = str(job.commandline).split(None, 1)
+    if not words:
+        return ''
+    return words[0]
+
+def _listing_row(job, fields):
+    """
+    The fields of the job for ls; hosts is empty unless it is running
+    """
+    if fields is LISTING_FIELDS:
+        r = {'user':job.user,
+             'pid':job.pid,
+             'priority':job.priority,
+             'time_sub':job.time_sub,
+             'time_run':job.time_run,
+             'status':job.status,
+             'hosts':job.hosts if job.status == 'run' else [],
+             'job_name':_job_name(job)}
+        if 'reason' in job:
+            r['reason'] = job.reason
+        return r
+
+    r = {}
+    for f in fields:
+        if f == 'hosts':
+            r['hosts'] = job.hosts if job.status == 'run' else []
+        elif f == 'job_name':
+            r['job_name'] = _job_name(job)
+        elif f in job:
+            r[f] = job[f]
+    return r
+
+def _pid_order(job):
+    # tasks, with pids '<pid>.<index>', come after the pid that submitted
+    # them.  A list, to compare with the cursor as sent back
+    parent = job.get('parent')
+    if parent is None:
+        return [job.pid, -1]
+    return [parent, int(job.pid.rsplit('.', 1)[1])]
+
+def _listing_key(sort):
+    """
+    The sort key of jobs for listings, also used as the cursor.  The
+    submission order breaks ties, and jobs without the field go last
+    """
+    if sort is None:
+        return lambda job: (job.seq,)
+    if sort == 'pid':
+        return lambda job: (False, _pid_order(job), job.seq)
+    if sort == 'priority':
+        # in the order jobs are scheduled, block first
+        return lambda job: (False, PRIORITY_LIST.index(job.priority), job.seq)
+    if sort == 'job_name':
+        return lambda job: (False, str(_job_name(job)), job.seq)
+
+    def key(job):
+        value = job.get(sort)
+        return (value is None, value, job.seq)
+    return key
+
 class JobQueue:
     def __init__(self, cluster_file, **keys):
 
@@ -979,12 +2362,102 @@ class JobQueue:
 
         self.setup_spool()
 
+        engine = self.keys.get('engine',DEFAULT_ENGINE)
+        if engine not in ENGINE_LIST:
+            raise ValueError("engine must be one of: %s, got '%s'"
+                             % (",".join(ENGINE_LIST), engine))
+        if engine != 'python' and vector.numpy is None:
+            print( "numpy is not installed, using the python engine" )
+            engine = 'python'
+        self.engine = engine
+        self.engine_checks = 0
+        self.engine_mismatches = 0
+
+        placement_name = self.keys.get('placement',DEFAULT_PLACEMENT)
+        if placement_name not in placement.POLICIES:
+            raise ValueError("placement must be one of: %s, got '%s'"
+                             % (",".join(placement.POLICIES), placement_name))
+
         print( "Loading cluster from:",cluster_file )
-        self.cluster = Cluster(cluster_file)
-        self.queue = []
+        self.cluster = Cluster(cluster_file, engine=engine,
+                               placement=placement_name)
+
+        # all jobs by pid, in submission order, and a FIFO for each priority.
+        # dicts keep insertion order and allow O(1) removal
+        self.jobs = {}
+        self.queues = dict((p,{}) for p in PRIORITY_LIST)
+        self._nextseq = 0
+
+        # all jobs by user and by status, for listings.  'ready' jobs are
+        # still kept as waiting until they start
+        self.user_jobs = {}
+        self.status_jobs = {}
+
+        # waiting jobs by (priority, what they can use): None for any host,
+        # ('host',h), ('group',g), and ('user',u) for the owner
+        self.waiting_index = {}
+
+        # waiting block jobs by pid, with the number of them blocking each
+        # group, or blocking everything when they name no groups.  The set
+        # of blocked groups is cached until one of them starts or leaves
+        self.blockers = {}
+        self.block_group_count = collections.Counter()
+        self.block_all_count = 0
+        self.blocked_groups = None
+
+        # backfill: jobs with a walltime may use the nodes held for block
+        # jobs if they will end before the block jobs can start.  The start
+        # times are cached like the blocked groups, and while the cluster
+        # version is unchanged
+        self.backfill = bool(self.keys.get('backfill', False))
+        self.reservations = None
+        self.reservations_version = None
+        self.nbackfilled = 0
+
+        # fair-share: within each priority the users with the least decayed
+        # usage go first.  Jobs are also kept by priority and user, in
+        # submission order
+        self.fairshare = bool(self.keys.get('fairshare', False))
+        self.user_queues = dict((p,{}) for p in PRIORITY_LIST)
+
+        scheduler = self.keys.get('scheduler',DEFAULT_SCHEDULER)
+        if scheduler not in SCHEDULER_LIST:
+            raise ValueError("scheduler must be one of: %s, got '%s'"
+                             % (",".join(SCHEDULER_LIST), scheduler))
+        self.incremental = (scheduler == 'incremental')
+
+        # failed match results by (requirement, blocked groups), valid while
+        # the cluster version is unchanged
+        self.match_memo = {}
+        self.match_memo_version = None
+        self.match_memo_hits = 0
+
+        self.liveness = Liveness()
+        self.nrefresh = 0
+        # wall time of the last full refresh, for the periodic one
+        self.time_refreshed = time.time()
+
+        # counters and latency histograms, optionally written to a file in
+        # the Prometheus text format
+        self.metrics = wqmetrics.Metrics()
+        self.metrics.collectors.append(self._collect_metrics)
+        self.metrics_file = self.keys.get('metrics_file',None)
+        self.metrics_interval = self.keys.get('metrics_interval',
+                                              DEFAULT_METRICS_INTERVAL)
+        self.metrics_written = 0.0
+
+        self.admins = self.keys.get('admins',DEFAULT_ADMINS)
+        # profiles the request loop when asked to, see sampler.py
+        self.sampler = None
 
         self.load_users()
+        if self.fairshare:
+            halflife = self.keys.get('fairshare_halflife',
+                                     DEFAULT_FAIRSHARE_HALFLIFE)
+            self.users.fairshare = FairShare(halflife)
         self.load_spool()
+        if self.fairshare:
+            self.users.sync_fairshare()
 
         print_users(self.users.asdict())
 
@@ -992,50 +2465,386 @@ class JobQueue:
 
         self.verbosity = 1
 
-    def setup_spool(self):
-        spool_dir=self.keys.get('spool_dir',DEFAULT_SPOOL_DIR)
-        self.spool_dir = os.path.expanduser(spool_dir)
-        if not os.path.exists(self.spool_dir):
-            print( 'making spool dir:',self.spool_dir )
-            os.makedirs(self.spool_dir)
+    def setup_spool(self):
+        spool_dir=self.keys.get('spool_dir',DEFAULT_SPOOL_DIR)
+        self.spool_dir = os.path.expanduser(spool_dir)
+        if not os.path.exists(self.spool_dir):
+            print( 'making spool dir:',self.spool_dir )
+            os.makedirs(self.spool_dir)
+
+    def users_file(self):
+        return os.path.join(self.spool_dir, 'users.yaml')
+
+    def load_users(self):
+        self.users = Users()
+        fname = self.users_file()
+        self.users.fromfile(fname)
+
+    def save_users(self):
+        fname = self.users_file()
+        print( 'saving users to:',fname )
+        self.users.tofile(fname)
+
+    def load_spool(self):
+        """
+        Load the snapshot and replay the journal, then move any job files
+        written by older versions of the server into it
+        """
+        print( "Loading jobs from:",self.spool_dir )
+        self.journal = Journal(self.spool_dir,
+                               fsync=self.keys.get('fsync',True))
+
+        window = self.keys.get('persist_window',DEFAULT_PERSIST_WINDOW)
+        self.persister = PersistWorker(self.journal, window=window)
+        self.persister.metrics = self.metrics
+        self.persister.start()
+
+        # sequence number of the last changes handed to the persister, and
+        # whether the users file needs rewriting
+        self.persist_seq = 0
+        self.users_changed = False
+
+        # nothing loaded is garbage, don't let the collector walk it all
+        # over and over
+        gc.disable()
+        try:
+            jobs = {}
+            snap = self.journal.read_snapshot()
+            if snap is not None:
+                try:
+                    jobs = self._restore_snapshot(snap)
+                finally:
+                    snap.close()
+
+            for record in self.journal.replay():
+                self._replay_record(jobs, record)
+
+            legacy_files = self._load_legacy_spool(jobs)
+
+            self._add_loaded_jobs(jobs)
+        finally:
+            gc.enable()
+
+        if legacy_files:
+            print( 'moved %d job files into the journal' % len(legacy_files) )
+            self.compact()
+            for fn in legacy_files:
+                os.remove(fn)
+
+    def _replay_record(self, jobs, record):
+        """
+        Apply a journal record to the jobs being loaded, reserving hosts for
+        the running ones
+        """
+        kind = record[0]
+        if kind == 'sub':
+            self._replay_submit(jobs, record[1])
+        elif kind == 'subs':
+            for job in record[1]:
+                self._replay_submit(jobs, job)
+        elif kind == 'run':
+            job = jobs.get(record[1])
+            if job is not None and job['status'] != 'run':
+                job['status'] = 'run'
+                job['reason'] = ''
+                job['hosts'] = compact_hosts(record[2])
+                job['time_run'] = record[3]
+                job.marker = True
+                self._reserve_loaded(job)
+        elif kind == 'done':
+            job = jobs.pop(record[1],None)
+            if job is not None:
+                self._release_loaded(job)
+        elif kind == 'limit':
+            self.users.get(record[1])['limits'] = record[2]
+
+    def _replay_submit(self, jobs, job):
+        if 'hosts' in job:
+            job['hosts'] = compact_hosts(job['hosts'])
+        old = jobs.pop(job['pid'],None)
+        if old is not None:
+            self._release_loaded(old)
+        jobs[job['pid']] = job
+        self._reserve_loaded(job)
+
+    def _reserve_loaded(self, job):
+        if job['status']=='run':
+            self.cluster.reserve(job['hosts'])
+            self.users.increment_user(job['user'], job['hosts'])
+
+    def _release_loaded(self, job):
+        if job['status']=='run':
+            self.cluster.unreserve(job['hosts'])
+            self.users.decrement_user(job['user'], job['hosts'])
+
+    def _snapshot_sections(self):
+        """
+        The users, cluster usage and jobs as snapshot sections.  Jobs are
+        stored in columns; strings and requirements are stored once and
+        referred to by index, and hosts are stored as (host, ncores) runs
+        """
+        strings = {}
+        specs = {}
+        def index(table, value):
+            i = table.get(value)
+            if i is None:
+                i = table[value] = len(table)
+            return i
+
+        pids, users, status, priority, spec = [], [], [], [], []
+        time_sub, time_run, flags = [], [], []
+        spool_dir, wait_sleep = [], []
+        host_start, hosts, host_count = [0], [], []
+        misc = []
+        for job in self.jobs.values():
+            fields = dict(job)
+            pids.append(fields.pop('pid'))
+            users.append(index(strings, fields.pop('user')))
+            status.append(index(strings, fields.pop('status')))
+            priority.append(index(strings, fields.pop('priority')))
+            time_sub.append(fields.pop('time_sub'))
+
+            flag = 0
+            if getattr(job,'marker',False):
+                flag |= _SNAP_MARKER
+            trun = float('nan')
+            if 'time_run' in fields:
+                flag |= _SNAP_TIME_RUN
+                trun = fields.pop('time_run')
+                if trun is None:
+                    trun = float('nan')
+            time_run.append(trun)
+            if 'hosts' in fields:
+                flag |= _SNAP_HOSTS
+                for h,ncores in fields.pop('hosts'):
+                    hosts.append(index(strings, h))
+                    host_count.append(ncores)
+            host_start.append(len(hosts))
+            flags.append(flag)
+
+            spec.append(index(specs, job.spec))
+            spool_dir.append(index(strings, job.spool_dir))
+            wait_sleep.append(job.wait_sleep)
+            misc.append(fields)
+
+        try:
+            pid_section = (b'PID ', snapshot.pack_array('q', pids))
+        except (TypeError, OverflowError):
+            pid_section = (b'PIDS', snapshot.dumps(pids))
+
+        udata = [(u, d['Njobs'], d['Ncores'], d['limits'])
+                 for u,d in self.users.users.items()]
+        meta = {'njobs':len(pids),
+                'cluster':self.cluster.fingerprint()}
+
+        sections = [(b'META', snapshot.dumps(meta)),
+                (b'USED', snapshot.pack_array('i', self.cluster.get_used())),
+                (b'USER', snapshot.dumps(udata)),
+                (b'STRS', snapshot.dumps(list(strings))),
+                (b'SPEC', snapshot.dumps(list(specs))),
+                pid_section,
+                (b'UIDX', snapshot.pack_array('i', users)),
+                (b'STAT', snapshot.pack_array('i', status)),
+                (b'PRIO', snapshot.pack_array('i', priority)),
+                (b'SIDX', snapshot.pack_array('i', spec)),
+                (b'TSUB', snapshot.pack_array('d', time_sub)),
+                (b'TRUN', snapshot.pack_array('d', time_run)),
+                (b'FLAG', snapshot.pack_array('b', flags)),
+                (b'SDIR', snapshot.pack_array('i', spool_dir)),
+                (b'WAIT', snapshot.pack_array('d', wait_sleep)),
+                (b'HOFF', snapshot.pack_array('i', host_start)),
+                (b'HOST', snapshot.pack_array('i', hosts)),
+                (b'HCNT', snapshot.pack_array('i', host_count)),
+                (b'MISC', snapshot.dumps(misc))]
+        if self.users.fairshare is not None:
+            sections.append((b'FAIR',
+                             snapshot.dumps(self.users.fairshare.state())))
+        return sections
+
+    def _restore_snapshot(self, snap):
+        """
+        Rebuild the jobs saved by _snapshot_sections.  The cluster usage and
+        user counters are taken from the snapshot when the cluster
+        description is unchanged, otherwise they are recomputed from the
+        running jobs
+        """
+        meta = snap.load(b'META')
+        strings = snap.load(b'STRS')
+        specs = snap.load(b'SPEC')
+        misc = snap.load(b'MISC')
+        if b'PIDS' in snap:
+            pids = snap.load(b'PIDS')
+        else:
+            pids = snap.array(b'PID ','q')
+
+        host_start = snap.array(b'HOFF','i')
+        hosts = snap.array(b'HOST','i')
+        host_count = snap.array(b'HCNT','i')
+
+        columns = zip(pids, misc,
+                      snap.array(b'UIDX','i'),
+                      snap.array(b'STAT','i'),
+                      snap.array(b'PRIO','i'),
+                      snap.array(b'SIDX','i'),
+                      snap.array(b'TSUB','d'),
+                      snap.array(b'TRUN','d'),
+                      snap.array(b'FLAG','b'),
+                      snap.array(b'SDIR','i'),
+                      snap.array(b'WAIT','d'))
+
+        restore = Job.restore
+        jobs = {}
+        for i,(pid,fields,user,status,priority,spec,tsub,trun,flag,
+               spool_dir,wait_sleep) in enumerate(columns):
+            fields['pid'] = pid
+            fields['user'] = strings[user]
+            fields['status'] = strings[status]
+            fields['priority'] = strings[priority]
+            fields['time_sub'] = tsub
+            if flag & _SNAP_TIME_RUN:
+                fields['time_run'] = None if trun != trun else trun
+            if flag & _SNAP_HOSTS:
+                fields['hosts'] = [[strings[hosts[k]], host_count[k]]
+                                   for k in range(host_start[i],
+                                                  host_start[i+1])]
+
+            jobs[pid] = restore(fields, specs[spec], strings[spool_dir],
+                                wait_sleep, bool(flag & _SNAP_MARKER))
+
+        same_cluster = meta['cluster'] == self.cluster.fingerprint()
+        if same_cluster:
+            self.cluster.restore_used(snap.array(b'USED','i'))
+        else:
+            print( 'cluster description changed, reserving hosts again' )
+            for job in jobs.values():
+                self._reserve_loaded(job)
+
+        for user,njobs,ncores,limits in snap.load(b'USER'):
+            udata = self.users.get(user)
+            udata['limits'] = limits
+            if same_cluster:
+                udata['Njobs'] = njobs
+                udata['Ncores'] = ncores
+
+        if b'FAIR' in snap and self.users.fairshare is not None:
+            self.users.fairshare.restore(snap.load(b'FAIR'))
+
+        return jobs
+
+    def _load_legacy_spool(self, jobs):
+        """
+        Load the pid.run and pid.wait pickle files of older versions of the
+        server into jobs, returning the names of the files loaded.  The empty
+        pid.run files written for waiting clients are skipped
+        """
+        loaded = []
+        for fn in sorted(os.listdir(self.spool_dir)):
+            if fn[-4:] != '.run' and fn[-5:] != '.wait':
+                continue
+
+            fn = os.path.join(self.spool_dir,fn)
+            if os.path.getsize(fn) == 0:
+                continue
+
+            job = None
+            with open(fn,'rb') as fobj:
+                try:
+                    job = pickle.load(fobj)
+                except:
+                    print( 'could not unpickle job file:',fn )
+                    es=sys.exc_info()
+                    print( 'caught unpickle exception:', es[0],'details:',es[1] )
+
+            if job:
+                job.marker = False
+                if 'hosts' in job:
+                    job['hosts'] = compact_hosts(job['hosts'])
+                if job['pid'] not in jobs:
+                    jobs[job['pid']] = job
+                    self._reserve_loaded(job)
+                loaded.append(fn)
+
+        return loaded
+
+    def flush(self):
+        """
+        Hand the journal records and file changes of the latest requests to
+        the persistence worker, compacting the journal when it has grown
+        long.  Responses should only be sent once persisted() is true
+        """
+        if self.users_changed:
+            self.journal.set_file(self.users_file(), self.users.dumps())
+            self.users_changed = False
+
+        data, files = self.journal.take()
+        if data or files:
+            self.persist_seq = self.persister.submit(data, files)
 
-    def users_file(self):
-        return os.path.join(self.spool_dir, 'users.yaml')
+        if self.journal.needs_compact():
+            self.compact()
 
-    def load_users(self):
-        self.users = Users()
-        fname = self.users_file()
-        self.users.fromfile(fname)
+        if self.metrics_file is not None \
+                and time.time()-self.metrics_written >= self.metrics_interval:
+            self.write_metrics()
 
-    def save_users(self):
-        fname = self.users_file()
-        print( 'saving users to:',fname )
-        self.users.tofile(fname)
+    def persisted(self):
+        """
+        True if all changes handed to the worker are on disk
+        """
+        return self.persister.flushed(self.persist_seq)
 
-    def load_spool(self):
-        print( "Loading jobs from:",self.spool_dir )
-        pattern = os.path.join(self.spool_dir,'*')
-        flist = glob.glob(pattern)
-        for fn in sorted(flist):
-            if fn[-4:] == '.run' or fn[-5:] == '.wait':
-                job = None
+    def sync(self):
+        """
+        Flush and wait until everything is on disk
+        """
+        self.flush()
+        self.persister.sync()
 
-                with open(fn,'rb') as fobj:
-                    try:
-                        job = pickle.load(fobj)
-                    except:
-                        print( 'could not unpickle job file:',fn )
-                        es=sys.exc_info()
-                        print( 'caught unpickle exception:', es[0],'details:',es[1] )
+    def compact(self):
+        """
+        Replace the journal with a snapshot of the current users, cluster
+        usage and jobs
+        """
+        self.persister.sync()
+        if self.persister.error is not None:
+            # the server is stopping, see Server.check_persister
+            return
+        tm0 = time.perf_counter()
+        self.journal.compact(self._snapshot_sections())
+        self.metrics.observe('snapshot_seconds', time.perf_counter()-tm0)
 
-                if job:
-                    if job['status']=='run':
-                        # here we need to reserve the cluster and increment the
-                        # user data
-                        self.cluster.reserve(job['hosts'])
-                        self.users.increment_user(job['user'], job['hosts'])
-                    self.queue.append(job)
+    def write_metrics(self):
+        """
+        Write the metrics file in the Prometheus text format
+        """
+        self.metrics_written = time.time()
+        try:
+            write_file(self.metrics_file, self.metrics.prometheus())
+        except (IOError, OSError) as err:
+            print( 'error writing metrics to %s: %s' % (self.metrics_file,err) )
 
+    def _collect_metrics(self):
+        """
+        The counters and gauges kept by the queue, liveness and journal
+        """
+        liveness = self.liveness.stats()
+        journal = self.journal.stats()
+        nrun = sum(1 for job in self.jobs.values() if job.status == 'run')
+        ncores = 0
+        used = 0
+        for nd in self.cluster.nodes.values():
+            if nd.online:
+                ncores += nd.ncores
+                used += nd.used
+        return [('match_memo_hits_total', (), self.match_memo_hits),
+                ('pid_checks_total', (), liveness['nchecks']),
+                ('pid_syscalls_total', (), liveness['nsyscalls']),
+                ('spool_writes_total', (), journal['nwrites']),
+                ('spool_bytes_total', (), journal['nbytes']),
+                ('jobs', (('status','run'),), nrun),
+                ('jobs', (('status','wait'),), len(self.jobs)-nrun),
+                ('cores', (('state','used'),), used),
+                ('cores', (('state','free'),), ncores-used)]
 
     def process_message(self, message):
         # we will overwrite this
@@ -1046,7 +2855,15 @@ class JobQueue:
         elif 'command' not in message:
             self.response['error'] = "message should contain a command"
         else:
+            command = message['command']
+            tm0 = time.perf_counter()
             self._process_command(message)
+            if command not in COMMAND_LIST:
+                command = 'unknown'
+            self.metrics.observe('command_seconds', time.perf_counter()-tm0,
+                                 (('command',command),))
+
+        self.flush()
 
     def refresh(self):
         """
@@ -1061,25 +2878,55 @@ class JobQueue:
 
         """
 
-        pids_to_del = []
-        blocked_groups=[]
+        tm0 = time.perf_counter()
+        match_seconds = 0.0
+        spool_seconds = 0.0
+        nmatched = 0
+        nstarted = 0
+
+        # all pids are checked against one listing of /proc
+        self.liveness.snapshot()
+        liveness_seconds = time.perf_counter()-tm0
+        self.nrefresh += 1
+        self.time_refreshed = time.time()
+
+        if self.fairshare:
+            # the jobs ahead in fair-share order must see the cores of every
+            # job that ended, so dead jobs are removed first
+            for job in list(self.jobs.values()):
+                tm1 = time.perf_counter()
+                alive = self._job_alive(job)
+                liveness_seconds += time.perf_counter()-tm1
+                if not alive:
+                    print( 'removing job %s, pid no longer valid' % job.pid )
+                    self._unreserve_job_and_decrement_user(job)
+                    self._remove_job(job)
+            order = self.users.fairshare.order()
+
+        blocked_groups=0
         have_blocked_groups=False
         for priority in PRIORITY_LIST:
-            for job in self.queue:
-                if job['priority'] != priority:
-                    continue
+            # a copy, since dead jobs are removed as we go
+            if self.fairshare:
+                jobs = self._fair_queue(priority, order)
+            else:
+                jobs = list(self.queues[priority].values())
+            for job in jobs:
                 # job was told to run.
                 # see if the pid is still running, if not remove the job
-                if not self._pid_exists(job['pid']):
+                tm1 = time.perf_counter()
+                alive = self._job_alive(job)
+                liveness_seconds += time.perf_counter()-tm1
+                if not alive:
                     print( 'removing job %s, pid no longer valid' % job['pid'] )
-                    pids_to_del.append(job['pid'])
 
                     self._unreserve_job_and_decrement_user(job)
+                    self._remove_job(job)
 
-                elif job['status'] != 'run':
+                elif job.status != 'run':
                     if not job.match_users(self.users):
                         # blame yourself
-                        job['reason'] = 'user limits exceeded'
+                        job.reason = 'user limits exceeded'
                     else:
                         # see if we can now run the job.
                         # After all blocked jobs have been scheduled (or not)
@@ -1089,23 +2936,428 @@ class JobQueue:
                             blocked_groups=self._blocked_groups()
                             have_blocked_groups = True
                             
-                        job.match(self.cluster, blocked_groups)
-                        
-                        if job['status'] == 'ready':
-                            self.cluster.reserve(job['hosts'])
-                            # this will remove any pid.wait file and write a
-                            # pid.run file sets status to 'run'
-                            job.spool()
+                        tm1 = time.perf_counter()
+                        self._match_job(job, blocked_groups)
+                        tm2 = time.perf_counter()
+                        match_seconds += tm2-tm1
+                        nmatched += 1
+
+                        if job.status == 'ready':
+                            self._start_job(job)
+                            spool_seconds += time.perf_counter()-tm2
+                            nstarted += 1
+
+        self.liveness.clear()
+
+        seconds = time.perf_counter()-tm0
+        observe = self.metrics.observe
+        observe('refresh_seconds', seconds)
+        observe('refresh_phase_seconds', match_seconds, (('phase','match'),))
+        observe('refresh_phase_seconds', spool_seconds, (('phase','spool'),))
+        observe('refresh_phase_seconds', liveness_seconds,
+                (('phase','liveness'),))
+        observe('refresh_phase_seconds',
+                seconds-match_seconds-spool_seconds-liveness_seconds,
+                (('phase','other'),))
+        observe('refresh_jobs', nmatched, (('jobs','matched'),))
+        observe('refresh_jobs', nstarted, (('jobs','started'),))
+
+    def _schedule_freed(self, hosts, users=()):
+        """
+        Incremental scheduling: offer freed hosts to the waiting jobs that
+        could use them, found through the waiting_index.
+
+        Every waiting job failed to match since capacity last grew, so only
+        jobs that can use the freed hosts, or jobs of users whose limits were
+        relaxed by a finished job, can start now.  Once the freed hosts are
+        full again only the latter are considered.
+        """
+        freed = set(h for h,ncores in hosts)
+        lockeys = [None]
+        for h in freed:
+            lockeys.append(('host',h))
+            for g in self.cluster.nodes[h].grps:
+                lockeys.append(('group',g))
+        userkeys = [('user',u) for u in set(users)
+                    if u in self.users and self.users.get(u)['limits']]
+
+        # the order jobs are offered the hosts in
+        if self.fairshare:
+            rank = dict((u,i) for i,u in
+                        enumerate(self.users.fairshare.order()))
+            order_key = lambda job: (rank.get(job.user, len(rank)), job.seq)
+        else:
+            rank = None
+            order_key = _job_seq
+
+        blocked_groups = None
+        started_block = False
+        seen = set()
+        for priority in PRIORITY_LIST:
+            if started_block:
+                # the blocked groups shrank, which can let anything start;
+                # the refresh offers the cores in order
+                break
+            last = None
+            while True:
+                if self._has_free(freed):
+                    keys = lockeys + userkeys
+                else:
+                    keys = userkeys
+
+                lists = []
+                for key in keys:
+                    bucket = self.waiting_index.get((priority,)+(key or ()))
+                    if bucket:
+                        lists.append(list(bucket.values()))
+
+                restart = False
+                for job in _merge_waiting(lists, rank):
+                    key = order_key(job)
+                    if (last is not None and key <= last) \
+                            or job['pid'] in seen:
+                        continue
+                    seen.add(job['pid'])
+                    last = key
+
+                    if not job.match_users(self.users):
+                        job['reason'] = 'user limits exceeded'
+                        continue
+
+                    if priority != 'block' and blocked_groups is None:
+                        blocked_groups = self._blocked_groups()
+                    self._match_job(job, blocked_groups or 0)
+
+                    if job['status'] == 'ready':
+                        self._start_job(job)
+                        if priority == 'block':
+                            started_block = True
+                        if len(keys) > len(userkeys) \
+                                and not self._has_free(freed):
+                            # only the users' jobs are left to try
+                            restart = True
+                            break
+                if not restart:
+                    break
+
+        if started_block:
+            self.refresh()
+
+    def _has_free(self, hosts):
+        for h in hosts:
+            nd = self.cluster.nodes[h]
+            if nd.online and nd.used < nd.ncores:
+                return True
+        return False
+
+    def _reap(self, jobs=None):
+        """
+        Incremental scheduling: remove jobs whose pid is gone, by default
+        checking all jobs, and offer what they held to waiting jobs
+        """
+        if jobs is None:
+            self.liveness.snapshot()
+            jobs = list(self.jobs.values())
+
+        hosts = []
+        users = []
+        blocking = False
+        for job in jobs:
+            if not self._job_alive(job):
+                print( 'removing job %s, pid no longer valid' % job['pid'] )
+                if job['status'] == 'run':
+                    hosts += job['hosts']
+                    users.append(job['user'])
+                elif job['priority'] == 'block':
+                    blocking = True
+                self._unreserve_job_and_decrement_user(job)
+                self._remove_job(job)
+        self.liveness.clear()
+
+        if blocking:
+            self.refresh()
+        elif hosts:
+            self._schedule_freed(hosts, users)
+
+    def _start_job(self, job, batch=None):
+        """
+        Reserve the matched hosts of a 'ready' job and mark it running
+        """
+        self._unindex_waiting(job)
+        self.cluster.reserve(job.hosts)
+        # sets status to 'run'
+        job.spool(self.journal, batch)
+        self._restatus_listing(job, 'wait')
+
+        if self.backfill and self.blockers and job.priority != 'block':
+            blocked = self._blocked_groups()
+            nodes = self.cluster.nodes
+            if any(nodes[h].gmask & blocked for h,n in job.hosts):
+                self.nbackfilled += 1
+
+        # keep statistics for each user
+        self.users.increment_user(job.user, job.hosts)
+        self.metrics.inc('jobs_started_total')
+
+    def _add_job(self, job):
+        old = self.jobs.get(job.pid)
+        if old is not None:
+            self._drop_reused_pid(old)
+
+        job.seq = self._nextseq
+        self._nextseq += 1
+
+        self.jobs[job.pid] = job
+        self.queues[job.priority][job.pid] = job
+        self._index_listing(job)
+        if self.fairshare:
+            self._queue_user_job(job)
+        if job.status == 'wait':
+            self._index_waiting(job)
+
+    def _add_loaded_jobs(self, jobs):
+        """
+        _add_job for all the jobs loaded at startup, sharing the waiting index
+        keys between jobs with the same owner and requirements
+        """
+        index = self.waiting_index
+        keys_memo = {}
+        for pid,job in jobs.items():
+            job.seq = self._nextseq
+            self._nextseq += 1
+
+            self.jobs[pid] = job
+            self.queues[job.priority][pid] = job
+            self._index_listing(job)
+            if self.fairshare:
+                self._queue_user_job(job)
+            if job.status == 'wait':
+                memo_key = (job.priority, job.user, job.spec)
+                keys = keys_memo.get(memo_key)
+                if keys is None:
+                    keys = keys_memo[memo_key] = self._waiting_keys(job)
+                for key in keys:
+                    bucket = index.get(key)
+                    if bucket is None:
+                        bucket = index[key] = {}
+                    bucket[pid] = job
+                if job.priority == 'block':
+                    self._add_blocker(job)
+
+    def _drop_reused_pid(self, job):
+        # the pid was reused, so the old client is gone
+        print( 'replacing job %s, pid was reused' % job.pid )
+        self._unreserve_job_and_decrement_user(job)
+        self._remove_job(job)
+
+    def _remove_job(self, job):
+        del self.jobs[job.pid]
+        del self.queues[job.priority][job.pid]
+        self._unindex_listing(job)
+        if self.fairshare:
+            queues = self.user_queues[job.priority]
+            queue = queues[job.user]
+            del queue[job.pid]
+            if not queue:
+                del queues[job.user]
+        self._unindex_waiting(job)
+
+    def _index_listing(self, job):
+        pid = job.pid
+        jobs = self.user_jobs.get(job.user)
+        if jobs is None:
+            jobs = self.user_jobs[job.user] = {}
+        jobs[pid] = job
+
+        jobs = self.status_jobs.get(job.status)
+        if jobs is None:
+            jobs = self.status_jobs[job.status] = {}
+        jobs[pid] = job
+
+    def _unindex_listing(self, job):
+        pid = job.pid
+        jobs = self.user_jobs[job.user]
+        del jobs[pid]
+        if not jobs:
+            del self.user_jobs[job.user]
+
+        # the status may have changed on the way out, e.g. to 'done'
+        for jobs in self.status_jobs.values():
+            if jobs.get(pid) is job:
+                del jobs[pid]
+                break
+
+    def _restatus_listing(self, job, old):
+        """
+        Move a job of the queue whose status changed from old in the index
+        by status; new jobs are indexed when added
+        """
+        jobs = self.status_jobs.get(old)
+        if jobs is None or jobs.get(job.pid) is not job:
+            return
+        del jobs[job.pid]
+        jobs = self.status_jobs.get(job.status)
+        if jobs is None:
+            jobs = self.status_jobs[job.status] = {}
+        jobs[job.pid] = job
+
+    def _queue_user_job(self, job):
+        queues = self.user_queues[job.priority]
+        queue = queues.get(job.user)
+        if queue is None:
+            queue = queues[job.user] = {}
+            self.users.fairshare.add(job.user)
+        queue[job.pid] = job
+
+    def _fair_queue(self, priority, order):
+        """
+        The jobs of a priority for fair-share, the users in the given order
+        and the jobs of each user in submission order
+        """
+        queues = self.user_queues[priority]
+        jobs = []
+        for user in order:
+            queue = queues.get(user)
+            if queue:
+                jobs.extend(queue.values())
+        return jobs
+
+    def _waiting_keys(self, job):
+        priority = job.priority
+        spec = job.spec
+        keys = [(priority,'user',job.user)]
+        if spec.mode == 'byhost':
+            keys.append((priority,'host',spec.host))
+        elif spec.mode == 'bygroup':
+            keys.append((priority,'group',spec.group))
+        elif spec.groups:
+            for g in spec.groups:
+                keys.append((priority,'group',g))
+        else:
+            keys.append((priority,))
+        return keys
+
+    def _index_waiting(self, job):
+        pid = job.pid
+        for key in self._waiting_keys(job):
+            bucket = self.waiting_index.get(key)
+            if bucket is None:
+                bucket = self.waiting_index[key] = {}
+            bucket[pid] = job
+        if job.priority == 'block':
+            self._add_blocker(job)
+
+    def _unindex_waiting(self, job):
+        pid = job.pid
+        for key in self._waiting_keys(job):
+            bucket = self.waiting_index.get(key)
+            if bucket is not None and pid in bucket:
+                del bucket[pid]
+                if not bucket:
+                    del self.waiting_index[key]
+        if job.priority == 'block':
+            self._remove_blocker(job)
+
+    def _add_blocker(self, job):
+        pid = job.pid
+        if pid in self.blockers:
+            return
+        groups = job.spec.groups
+        self.blockers[pid] = groups
+        if groups:
+            self.block_group_count.update(groups)
+        else:
+            self.block_all_count += 1
+        self.blocked_groups = None
+        self.reservations = None
+
+    def _check_engines(self, job, blocked_groups):
+        """
+        Match with the numpy engine, then again with the python loops,
+        reporting any difference.  The python result is kept
+        """
+        status, reason = job['status'], job['reason']
+        cluster = self.cluster
+
+        job.match(cluster, blocked_groups)
+        res = (job['status'], job['reason'], job.get('hosts'))
+
+        job['status'], job['reason'] = status, reason
+        job.pop('hosts', None)
+
+        arrays, cluster.arrays = cluster.arrays, None
+        try:
+            job.match(cluster, blocked_groups)
+        finally:
+            cluster.arrays = arrays
+
+        self.engine_checks += 1
+        if res != (job['status'], job['reason'], job.get('hosts')):
+            self.engine_mismatches += 1
+            print( "engine mismatch for job",job['pid'],
+                   "numpy:",res[0],res[2],
+                   "python:",job['status'],job.get('hosts') )
+
+    def _remove_blocker(self, job):
+        groups = self.blockers.pop(job.pid, None)
+        if groups is None:
+            return
+        if groups:
+            self.block_group_count.subtract(groups)
+            for g in groups:
+                if self.block_group_count[g] <= 0:
+                    del self.block_group_count[g]
+        else:
+            self.block_all_count -= 1
+        self.blocked_groups = None
+        self.reservations = None
+
+    def _match_job(self, job, blocked_groups):
+        """
+        Run job.match, remembering failures for each requirement shape.
+
+        Capacity only shrinks until the cluster version changes, so a shape
+        that could not be matched stays unmatched; identical jobs then get
+        the remembered status and reason without matching again.
+        """
+        if job.status != 'wait':
+            return
+
+        if self.match_memo_version != self.cluster.version:
+            self.match_memo.clear()
+            self.match_memo_version = self.cluster.version
+
+        if self.backfill and blocked_groups and job.spec.walltime is not None \
+                and job.priority != 'block':
+            blocked_groups = self._backfill_mask(job, blocked_groups)
+
+        if job.priority == 'block':
+            key = (job.spec, 0)
+        else:
+            key = (job.spec, blocked_groups)
+
+        res = self.match_memo.get(key)
+        if res is not None:
+            job.status, job.reason = res
+            self.match_memo_hits += 1
+        else:
+            if self.engine == 'check':
+                self._check_engines(job, blocked_groups)
+            else:
+                job.match(self.cluster, blocked_groups)
 
-                            # keep statistics for each user
-                            self.users.increment_user(job['user'], job['hosts'])
+            # the bygroup reason names the first busy host, which can change
+            if job.status != 'ready' and job.spec.mode != 'bygroup':
+                self.match_memo[key] = (job.status, job.reason)
 
-        # rebuild the queue without these items
-        if len(pids_to_del) > 0:
-            self.queue = [j for j in self.queue if j['pid'] not in pids_to_del]
+        if job.status == 'nevermatch':
+            self._restatus_listing(job, 'wait')
+            if job.priority == 'block':
+                # blocks nothing from now on
+                self._remove_blocker(job)
 
     def _unreserve_job_and_decrement_user(self, job):
-        job.unspool()
+        job.unspool(self.journal)
         if job['status'] == 'run':
             self.users.decrement_user(job['user'], job['hosts'])
             self.cluster.unreserve(job['hosts'])
@@ -1122,6 +3374,8 @@ class JobQueue:
 
         if command in ['sub']:
             self._process_submit_request(message)
+        elif command in ['bulk_sub','subarray']:
+            self._process_bulk_submit_request(message)
         elif command == 'gethosts':
             self._process_gethosts(message)
         elif command in ['ls']:
@@ -1139,14 +3393,19 @@ class JobQueue:
         elif command == 'notify':
             self._process_notification(message)
         elif command == 'refresh':
-            self.refresh()
+            self._refresh_after_change()
             self.response['response'] = 'OK'
         elif command =='node':
             self._process_node_request(message)
+        elif command == 'metrics':
+            self._process_metrics_request(message)
+        elif command == 'profile':
+            self._process_profile_request(message)
         else:
-            self.response['error'] = ("only support 'sub','gethosts', "
-                                      "'ls','stat','users','rm','notify','node'"
-                                      "'refresh' commands")
+            self.response['error'] = ("only support 'sub','bulk_sub',"
+                                      "'gethosts','ls','stat','users','rm',"
+                                      "'notify','node','refresh','metrics',"
+                                      "'profile' commands")
     def _process_node_request(self, message):
 
         nodename = message['node']
@@ -1179,37 +3438,137 @@ class JobQueue:
         return None
 
     def _blocking_job(self):
-        for job in self.queue:
-            if job['priority'] == 'block' and job['status'] == 'wait':
+        for job in self.queues['block'].values():
+            if job['status'] == 'wait':
                 return job['pid']
         return None
     
     def _blocked_groups(self):
-        bg=[]
-        block_all=False
-        for job in self.queue:
-            reqs = job['require']
-            if job['priority'] == 'block' and job['status'] == 'wait':
-                
-                req_groups = job._get_req_list(reqs, 'group')
-                if (len(req_groups)==0):
-                    ## Dude didn't specify group, we need to block all
-                    block_all=True
-                    break
-                else:
-                    for group in req_groups:
-                        if group not in bg:
-                            bg.append(group)
-        if (block_all):
-            for n in self.cluster.nodes.keys():
-                #Enough to take 
-                cg = self.cluster.nodes[n].get_groups()
-                if (len(cg)>0):
-                    ### Enough to add just the first group, this will block it
-                    if cg[0] not in bg:
-                        bg.append(cg[0])
+        """
+        The groups blocked by waiting block jobs, as a mask of cluster group
+        bits, kept up to date as they come and go
+        """
+        if self.blocked_groups is not None:
+            return self.blocked_groups
+
+        if self.block_all_count > 0:
+            ## Dude didn't specify group, we need to block all nodes in
+            ## any group
+            mask = self.cluster.grouped_mask
+        else:
+            mask = self.cluster.group_mask(self.block_group_count)
+
+        self.blocked_groups = mask
+        return mask
+
+    def _backfill_mask(self, job, blocked_groups):
+        """
+        Backfill: the groups still blocked for a job with a walltime, those
+        of the block jobs that may start before it would end
+        """
+        times, masks = self._reservations()
+        end = _clock() + job.spec.walltime
+        return masks[bisect.bisect_left(times, end)] & blocked_groups
+
+    def _reservations(self):
+        """
+        Backfill: the start times of the waiting block jobs, in order, and
+        for each count of them the mask of the groups they block.  The
+        first mask holds the groups of those whose start time is unknown,
+        which stay blocked for everyone
+        """
+        if self.reservations is not None \
+                and self.reservations_version == self.cluster.version:
+            return self.reservations
+
+        now = _clock()
+        running = [job for job in self.jobs.values() if job.status == 'run']
+        always = 0
+        timed = []
+        for pid,groups in self.blockers.items():
+            if groups:
+                mask = self.cluster.group_mask(groups)
+            else:
+                mask = self.cluster.grouped_mask
+            job = self.jobs.get(pid)
+            start = None
+            if job is not None:
+                start = self._reservation_time(job, running, now)
+            if start is None:
+                always |= mask
+            else:
+                timed.append((start, mask))
+
+        timed.sort(key=lambda x: x[0])
+        times = [start for start,mask in timed]
+        masks = [always]
+        for start,mask in timed:
+            masks.append(masks[-1] | mask)
+
+        self.reservations = (times, masks)
+        self.reservations_version = self.cluster.version
+        return self.reservations
+
+    def _reservation_time(self, job, running, now):
+        """
+        Backfill: the earliest time the block job could start, releasing the
+        cores of the running jobs on its candidate nodes as their walltimes
+        run out.  None if that depends on jobs without a walltime
+        """
+        cluster = self.cluster
+        spec = job.spec
+        if spec.mode == 'byhost':
+            nd = cluster.nodes.get(spec.host)
+            hosts = [spec.host] if nd is not None and nd.online else []
+        elif spec.mode == 'bygroup':
+            hosts = cluster.candidates(groups=[spec.group]).hosts
+        else:
+            min_cores = spec.min_cores if spec.mode == 'bynode' else 0
+            hosts = cluster.candidates(spec.min_mem, spec.groups,
+                                       spec.notgroups, min_cores).hosts
+        if not hosts:
+            return None
+
+        free = dict((h, cluster.nodes[h].ncores-cluster.nodes[h].used)
+                    for h in hosts)
+        if self._fits(spec, free):
+            return now
+
+        releases = []
+        for other in running:
+            walltime = other.spec.walltime
+            if walltime is None or other.time_run is None:
+                continue
+            held = [(h,n) for h,n in other.hosts if h in free]
+            if held:
+                # overdue jobs may end any time
+                releases.append((max(other.time_run+walltime, now), held))
+        releases.sort(key=lambda x: x[0])
+
+        for end,held in releases:
+            for h,n in held:
+                free[h] += n
+            if self._fits(spec, free):
+                return end
+        return None
 
-        return bg
+    def _fits(self, spec, free):
+        """
+        Backfill: could the requirement be met with these free cores on its
+        candidate nodes
+        """
+        nodes = self.cluster.nodes
+        if spec.mode == 'bycore':
+            threads = spec.threads
+            return sum((n//threads)*threads for n in free.values()) >= spec.N
+        elif spec.mode in ['bycore1','byhost']:
+            return any(n >= spec.N for n in free.values())
+        elif spec.mode == 'bynode':
+            nidle = sum(1 for h,n in free.items() if n == nodes[h].ncores)
+            return nidle >= spec.N
+        else:
+            # bygroup needs all of them
+            return all(n == nodes[h].ncores for h,n in free.items())
 
 
 
@@ -1226,12 +3585,16 @@ class JobQueue:
             self.response['error'] = err
             return
 
+        old = self.jobs.get(pid)
+        if old is not None:
+            self._drop_reused_pid(old)
+
         # pass on the state
         keys = self.keys
         newjob = Job(message, **keys)
 
         # no side effects on cluster inside here
-        newjob.match(self.cluster, self._blocked_groups())
+        self._match_job(newjob, self._blocked_groups())
 
         if newjob['status'] == 'nevermatch':
             self.response['error'] = newjob['reason']
@@ -1242,23 +3605,17 @@ class JobQueue:
                 # this job
                 newjob['status'] = 'wait'
                 newjob['reason'] = 'user limits exceeded'
-            elif newjob['status'] == 'ready':
-
+            if newjob['status'] == 'ready':
                 # only by reaching here to we reserve the hosts and
                 # update user info
-                self.cluster.reserve(newjob['hosts'])
-                
-                # keep statistics for each user
-                self.users.increment_user(newjob['user'], newjob['hosts'])
-
-            # this will create a pid.wait or pid.run depending on status if
-            # status='ready', sets status to 'run' once the pid file is written
-            newjob.spool()
+                self._start_job(newjob)
+            else:
+                newjob.spool(self.journal)
 
             # if the status is 'run', the job will immediately
             # run. Otherwise it will wait and can't run till
             # we do a refresh
-            self.queue.append(newjob)
+            self._add_job(newjob)
             self.response['response'] = newjob['status']
             self.response['spool_fname']= \
                     newjob['spool_fname'].replace('wait','run')
@@ -1269,6 +3626,78 @@ class JobQueue:
                 self.response['reason'] = newjob['reason']
 
 
+    def _process_bulk_submit_request(self, message):
+        """
+        Submit a task for each of the commands, all with the requirements of
+        the message.  The requirements are checked once, the tasks are
+        matched in one pass against one list of blocked groups, and all are
+        journaled in one record.
+
+        Task pids are '<pid>.<index>'.  Tasks live as long as the pid that
+        submitted them, or until they are notified done, and no pid.run
+        files are written for them; their status is found with gethosts or
+        ls
+        """
+        pid = message.get('pid')
+        if pid is None:
+            err="bulk submit requests must contain the 'pid' field"
+            self.response['error'] = err
+            return
+
+        commands = message.get('commands')
+        if not commands or not isinstance(commands, list) \
+                or not all(isinstance(c, str) and c.strip() for c in commands):
+            err=("bulk submit requests must contain a list of 'commands', "
+                 "each a non-empty string")
+            self.response['error'] = err
+            return
+
+        template = dict(message)
+        del template['commands']
+        template['commandline'] = commands[0]
+        template = Job(template, **self.keys)
+        if template['status'] == 'nevermatch':
+            self.response['error'] = template['reason']
+            return
+
+        blocked_groups = self._blocked_groups()
+        batch = []
+        tasks = []
+        for i,commandline in enumerate(commands):
+            task = template.task(i, commandline)
+            old = self.jobs.get(task['pid'])
+            if old is not None:
+                self._drop_reused_pid(old)
+
+            self._match_job(task, blocked_groups)
+            if task['status'] == 'nevermatch':
+                # the same for all tasks, so this is the first
+                self.response['error'] = task['reason']
+                break
+
+            if not task.match_users(self.users):
+                task['status'] = 'wait'
+                task['reason'] = 'user limits exceeded'
+            if task['status'] == 'ready':
+                self._start_job(task, batch)
+            else:
+                task.spool(self.journal, batch)
+            self._add_job(task)
+
+            r = {'pid':task['pid'], 'status':task['status']}
+            if task['status'] == 'run':
+                r['hosts'] = task['hosts']
+            else:
+                r['reason'] = task['reason']
+            tasks.append(r)
+
+        if batch:
+            self.journal.append(('subs',batch))
+        # don't send the commands back
+        del self.response['commands']
+        if 'error' not in self.response:
+            self.response['response'] = tasks
+
     def _process_gethosts(self, message):
         pid = message.get('pid',None)
         if pid is None:
@@ -1276,11 +3705,13 @@ class JobQueue:
                     "submit requests must contain the 'pid' field"
             return
 
-        for job in self.queue:
-            if job['pid']==pid:
-                self.response['hosts']=job['hosts']
-                self.response['response']='OK'
-                return
+        job = self.jobs.get(pid)
+        if job is not None:
+            # waiting jobs have no hosts yet
+            self.response['hosts']=job.get('hosts')
+            self.response['status']=job['status']
+            self.response['response']='OK'
+            return
 
         self.response['error'] = "we don't have this pid"
         return
@@ -1289,54 +3720,171 @@ class JobQueue:
 
     def _process_listing_request(self, message):
         """
-        'user'
-        'pid'
-        'priority'
-        'time_sub'
-        'time_run'
-        'status'
-        'hosts'
-
-        These we can maybe not send if we extract job_name
-            or beginning of command
-            'require'
-            'commandline'
-        """
-        listing = []
-        for job in self.queue:
-            r = {}
-            r['user'] = job['user']
-            r['pid'] = job['pid']
-            r['priority'] = job['priority']
-            r['time_sub'] = job['time_sub']
-            r['time_run'] = job['time_run']
-            r['status'] = job['status']
-            if r['status'] == 'run':
-                r['hosts'] = job['hosts']
-            else:
-                # should we do this?
-                r['hosts'] = []
+        The jobs selected by _listing_jobs, with the fields given by 'fields',
+        by default all of LISTING_FIELDS.  The hosts are only sent for
+        running jobs
+        """
+        jobs = self._listing_jobs(message)
+        if jobs is None:
+            return
 
-            if 'reason' in job:
-                r['reason'] = job['reason']
-            if 'job_name' in job['require']:
-                r['job_name'] = job['require']['job_name']
-            else:
-                r['job_name'] = job['commandline'].split()[0]
-            listing.append(r)
-        
-        self.response['response'] = listing
+        fields = message.get('fields',None)
+        if fields is None:
+            fields = LISTING_FIELDS
+        else:
+            bad = [f for f in fields if f not in LISTING_FIELDS]
+            if bad:
+                self.response['error'] = ("fields must be among: %s, got %s"
+                                          % (",".join(LISTING_FIELDS),
+                                             ",".join(map(str,bad))))
+                return
+
+        self.response['response'] = [_listing_row(job, fields)
+                                     for job in jobs]
 
     def _process_full_listing_request(self, message):
         """
-        Send everything
+        Send everything about the jobs selected by _listing_jobs, or only the
+        fields given by 'fields'
         """
-        listing = []
-        for job in self.queue:
-            listing.append(job.asdict())
-        
+        jobs = self._listing_jobs(message)
+        if jobs is None:
+            return
+
+        fields = message.get('fields',None)
+        if fields is None:
+            listing = [job.asdict() for job in jobs]
+        else:
+            listing = [dict((f,job[f]) for f in fields if f in job)
+                       for job in jobs]
+
         self.response['response'] = listing
 
+    def _listing_jobs(self, message):
+        """
+        The jobs for a listing request, filtered, sorted and paged
+
+            user, status, priority  only jobs with one of these values; a
+                                    value or a list
+            pid                     only these pids, a list
+            sort                    one of SORT_FIELDS, descending if it
+                                    starts with '-'; jobs are in submission
+                                    order otherwise
+            limit                   send at most this many jobs
+            cursor                  the cursor sent with the previous page
+
+        The jobs are taken from the smallest of the indexes for the filters,
+        by user, status, priority or pid, and only the others are checked
+        for each job.  With a limit the response has a cursor for the next
+        page, None after the last page; pages are given with the same
+        filters and sort.  Returns None after setting the error
+        """
+        filters = []
+        for name,index in (('user',self.user_jobs),
+                           ('status',self.status_jobs),
+                           ('priority',self.queues)):
+            values = message.get(name,None)
+            if values is None:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            if not all(isinstance(v, (str,int)) for v in values):
+                self.response['error'] = ("%s must be a string or number, "
+                                          "or a list of them" % name)
+                return None
+            values = set(values)
+            buckets = [index[v] for v in values if v in index]
+            filters.append((sum(len(b) for b in buckets), name, values,
+                            buckets))
+
+        pids = message.get('pid',None)
+        if pids is not None:
+            if not isinstance(pids, list):
+                pids = [pids]
+            bucket = {}
+            for pid in pids:
+                if not isinstance(pid, (int,str)):
+                    self.response['error'] = 'pid must be a list of pids'
+                    return None
+                job = self.jobs.get(pid)
+                if job is None and isinstance(pid, str) and pid.isdigit():
+                    job = self.jobs.get(int(pid))
+                if job is not None:
+                    bucket[job.pid] = job
+            filters.append((len(bucket), 'pid', set(bucket), [bucket]))
+
+        sort = message.get('sort',None)
+        reverse = False
+        if sort is not None:
+            if isinstance(sort, str) and sort.startswith('-'):
+                reverse = True
+                sort = sort[1:]
+            if sort not in SORT_FIELDS:
+                self.response['error'] = ("sort must be one of: %s, "
+                                          "optionally starting with '-'"
+                                          % ",".join(SORT_FIELDS))
+                return None
+        key = _listing_key(sort)
+
+        limit = message.get('limit',None)
+        if limit is not None:
+            try:
+                limit = int(limit)
+            except (TypeError, ValueError):
+                limit = 0
+            if limit < 1:
+                self.response['error'] = 'limit must be a positive integer'
+                return None
+
+        if filters:
+            filters.sort(key=lambda f: f[0])
+            checks = [(name,values) for n,name,values,b in filters[1:]]
+            jobs = [job for bucket in filters[0][3] for job in bucket.values()
+                    if all(job[name] in values for name,values in checks)]
+            ordered = False
+        else:
+            # the queue is in submission order
+            jobs = self.jobs.values()
+            ordered = sort is None
+
+        cursor = message.get('cursor',None)
+        if cursor is not None:
+            try:
+                cursor = tuple(cursor)
+                if len(cursor) != (1 if sort is None else 3):
+                    raise ValueError("cursor is for another sort")
+                if ordered:
+                    after = int(cursor[0])
+                    jobs = itertools.dropwhile(lambda job: job.seq <= after,
+                                               jobs)
+                elif reverse:
+                    jobs = [job for job in jobs if key(job) < cursor]
+                else:
+                    jobs = [job for job in jobs if key(job) > cursor]
+            except (TypeError, ValueError, IndexError):
+                self.response['error'] = 'invalid cursor'
+                return None
+
+        if limit is None:
+            if ordered:
+                return list(jobs)
+            return sorted(jobs, key=key, reverse=reverse)
+
+        # one more than the limit tells whether there is another page
+        if ordered:
+            page = list(itertools.islice(jobs, limit+1))
+        elif reverse:
+            page = heapq.nlargest(limit+1, jobs, key=key)
+        else:
+            page = heapq.nsmallest(limit+1, jobs, key=key)
+
+        if len(page) > limit:
+            page = page[:limit]
+            self.response['cursor'] = list(key(page[-1]))
+        else:
+            self.response['cursor'] = None
+        return page
+
     def _process_userlist_request(self):
         self.response['response'] = self.users.asdict()
 
@@ -1372,48 +3920,133 @@ class JobQueue:
             for l,v in limits.items():
                 udata['limits'][l] = v
 
-        self.save_users()
+        self.journal.append(('limit',user,udata['limits']))
+        self.users_changed = True
         self.response['response'] = 'OK'
         
     def _process_status_request(self, message):
-        self.response['response'] = self.cluster.status()
+        status = self.cluster.status()
+        status['nrefresh'] = self.nrefresh
+        status['placement'] = self.cluster.placement
+        if self.backfill:
+            times, masks = self._reservations()
+            status['backfill'] = {'nbackfilled':self.nbackfilled,
+                                  'reservations':times}
+        status['engine'] = {'name':self.engine,
+                            'nchecks':self.engine_checks,
+                            'nmismatch':self.engine_mismatches}
+        status['liveness'] = self.liveness.stats()
+        status['journal'] = self.journal.stats()
+        status['persist'] = self.persister.stats()
+        self.response['response'] = status
+
+    def _process_metrics_request(self, message):
+        """
+        The metrics as a dict, or as Prometheus text with
+        format: prometheus
+        """
+        if message.get('format') == 'prometheus':
+            self.response['response'] = self.metrics.prometheus()
+        else:
+            self.response['response'] = self.metrics.asdict()
 
-    def _process_remove_request(self, message):
-        self.refresh()
+    def _process_profile_request(self, message):
+        """
+        Start or stop sampling the stack of the server, or get the state of
+        the sampling; admins only.  The profile is written to the spool
+        directory when sampling stops, at the latest after the duration.
+
+        The admin is the user the server found on the other end of a
+        connection from its own host; for other connections it is the user
+        the client sends, which is trusted as it is for rm by root
+        """
+        user = message.get('peer_user',None)
+        if user is None:
+            user = message.get('user',None)
+        if user not in self.admins:
+            self.response['error'] = ('only %s may profile the server'
+                                      % ','.join(self.admins))
+            return
+
+        action = message.get('action','status')
+        if action == 'start':
+            if self.sampler is not None and self.sampler.is_alive():
+                self.response['error'] = 'the server is already being profiled'
+                return
+            try:
+                duration = float(message.get('duration',
+                                             sampler.DEFAULT_PROFILE_DURATION))
+                interval = float(message.get('interval',
+                                             sampler.DEFAULT_PROFILE_INTERVAL))
+            except (TypeError, ValueError):
+                self.response['error'] = 'duration and interval must be numbers'
+                return
+            duration = min(max(duration, 0.0), sampler.MAX_PROFILE_DURATION)
+            interval = max(interval, 0.001)
+
+            fname = time.strftime('profile-%Y%m%d-%H%M%S.folded')
+            fname = os.path.join(self.spool_dir, fname)
+            # the thread handling requests is the one running the server
+            self.sampler = sampler.Sampler(threading.get_ident(), fname,
+                                           interval=interval,
+                                           duration=duration)
+            self.sampler.start()
+        elif action == 'stop':
+            if self.sampler is None:
+                self.response['error'] = 'the server is not being profiled'
+                return
+            self.sampler.stop()
+        elif action != 'status':
+            self.response['error'] = "action should be 'start', 'stop' or 'status'"
+            return
+
+        if self.sampler is None:
+            self.response['response'] = {'running':False}
+        else:
+            self.response['response'] = self.sampler.stats()
 
+    def _process_remove_request(self, message):
         pid = message.get('pid',None)
         user = message.get('user',None)
+
         if pid is None:
             self.response['error'] = \
                     "remove requests must contain the 'pid' field"
             return
+        if not isinstance(pid, (str,int)):
+            self.response['error'] = "pid must be a string or number"
+            return
         if user is None:
             self.response['error'] = \
                     "remove requests must contain the 'user' field"
             return
-            
+
+        if not self.incremental:
+            self.refresh()
+        elif pid == 'all':
+            self._reap([j for j in self.jobs.values() if j['user'] == user])
+        elif pid in self.jobs:
+            self._reap([self.jobs[pid]])
+
         if pid == 'all':
             self._process_remove_all_request(user)
         else:
-            found = False
-            for job in self.queue:
-                if job['pid'] == pid:
-                    # we don't actually remove anything, refresh will do it.
-                    if (job['user']!=user and user!='root'):
-                        self.response['error']=\
-                                'PID belongs to user '+job['user']
-                        return
-
-                    self.response['response'] = 'OK'
-                    self.response['pids_to_kill'] = [pid]
-                    found=True
-                    break
-            if not found:
+            job = self.jobs.get(pid)
+            if job is not None:
+                # we don't actually remove anything, refresh will do it.
+                if (job['user']!=user and user!='root'):
+                    self.response['error']=\
+                            'PID belongs to user '+job['user']
+                    return
+
+                self.response['response'] = 'OK'
+                self.response['pids_to_kill'] = [pid]
+            else:
                 self.response['error'] = 'pid %s not found' % pid
 
     def _process_remove_all_request(self, user):
         pids_to_kill=[]
-        for job in self.queue:
+        for job in self.jobs.values():
             if job['user'] == user:
                 pids_to_kill.append(job['pid'])
                 # we rely on the refresh to do this
@@ -1435,9 +4068,8 @@ class JobQueue:
                         "remove requests must contain the 'pid' field"
                 return
             self._remove_from_notify(pid)
-            self.refresh()
         elif notifi == 'refresh':
-            self.refresh()
+            self._refresh_after_change()
         else:
             self.response['error'] = \
                     "Only support 'done' or 'refresh' notifications for now"
@@ -1448,29 +4080,140 @@ class JobQueue:
         this is when the user has notified us the job is done.  we don't
         send a kill message back
         """
-        found = False
-        for i,job in enumerate(self.queue):
-            if job['pid'] == pid:
+        job = self.jobs.get(pid)
+        if job is not None:
+            status = job['status']
+            self._unreserve_job_and_decrement_user(job)
+            self._remove_job(job)
+            self.response['response'] = 'OK'
 
-                self._unreserve_job_and_decrement_user(job)
+            if not self.incremental:
+                self.refresh()
+            elif status == 'run':
+                self._schedule_freed(job['hosts'], [job['user']])
+            elif job['priority'] == 'block':
+                self.refresh()
+        else:
+            self.response['error'] = 'pid %s not found' % pid
+            self._refresh_after_change()
 
-                del self.queue[i]
-                self.response['response'] = 'OK'
-                found=True
-                break
 
-        if not found:
-            self.response['error'] = 'pid %s not found' % pid
+    def _refresh_after_change(self):
+        """
+        Refresh after clients asked for it; incremental scheduling only looks
+        for dead jobs and reschedules what they held
+        """
+        if self.incremental:
+            self._reap()
+        else:
+            self.refresh()
 
+    def _job_alive(self, job):
+        """
+        Tasks of a bulk submission live as long as the pid that submitted
+        them
+        """
+        return self._pid_exists(getattr(job, 'parent', job.pid))
 
     def _pid_exists(self, pid):        
         """ Check For the existence of a unix pid. """
+        return self.liveness.exists(pid)
+
+class Liveness:
+    """
+    Answer whether pids exist from one listing of /proc per refresh, instead
+    of a stat of /proc/<pid> for every queued job.
+
+    Where /proc can't be listed, each pid is checked with its own syscall.
+    """
+    def __init__(self, proc_dir='/proc'):
+        self.proc_dir = proc_dir
+        self.pids = None
+
+        # pid checks made, and syscalls made to answer them
+        self.nchecks = 0
+        self.nsyscalls = 0
+        self.nsnapshots = 0
+
+    def snapshot(self):
+        """
+        List the running pids; call at the start of each refresh
+        """
+        self.nsnapshots += 1
+        self.nsyscalls += 1
+        try:
+            it = os.scandir(self.proc_dir)
+        except (OSError, AttributeError):
+            self.pids = None
+            return
+
+        pids = set()
+        with it:
+            for entry in it:
+                name = entry.name
+                if name.isdigit():
+                    pids.add(int(name))
+        self.pids = pids
+
+    def clear(self):
+        """
+        Forget the snapshot; later checks go to the system again
+        """
+        self.pids = None
+
+    def exists(self, pid):
+        self.nchecks += 1
+        if self.pids is not None:
+            try:
+                return int(pid) in self.pids
+            except (TypeError, ValueError):
+                return False
+
+        self.nsyscalls += 1
         pid_path =  "/proc/%s" % pid
         if os.path.exists(pid_path):
             return True
         else:
             return False
 
+    @property
+    def nsaved(self):
+        """
+        Syscalls saved compared to checking each pid on its own
+        """
+        return self.nchecks - self.nsyscalls
+
+    def stats(self):
+        return {'nsnapshots':self.nsnapshots,
+                'nchecks':self.nchecks,
+                'nsyscalls':self.nsyscalls,
+                'nsaved':self.nsaved}
+
+
+def _merge_waiting(lists, rank=None):
+    """
+    Merge lists of waiting jobs in submission order.  With the fair-share
+    rank of the users, the jobs of the lower ranked users come first, each
+    user's still in submission order
+    """
+    if rank is None:
+        return heapq.merge(*lists, key=_job_seq)
+
+    byuser = {}
+    for jobs in lists:
+        split = {}
+        for job in jobs:
+            split.setdefault(job.user, []).append(job)
+        for user,ujobs in split.items():
+            byuser.setdefault(user, []).append(ujobs)
+
+    users = sorted(byuser, key=lambda u: rank.get(u, len(rank)))
+    return itertools.chain.from_iterable(
+        heapq.merge(*byuser[u], key=_job_seq) for u in users)
+
+def _job_seq(job):
+    return job.seq
+
 def print_stat(status):
     """
     input status is the result of cluster.status
@@ -1524,6 +4267,12 @@ def print_stat(status):
                  status['ncores']-tot_active_cores)
 
     print( mess )
+    if 'fragmentation' in status:
+        mess=' Idle nodes: %i (%i cores), %3.1f%% of free cores fragmented'
+        mess=mess % (status['nidle'],
+                     status['idle_cores'],
+                     100.*status['fragmentation'])
+        print( mess )
 
 def print_users(users):
     """
@@ -1531,6 +4280,9 @@ def print_users(users):
     using asdict()
     """
     keys = ['user','Njobs','Ncores','limits']
+    # fair-share usage, when the server has it
+    if any('usage' in users[u] for u in users):
+        keys.insert(3, 'usage')
     lens={}
     for k in keys:
         lens[k] = len(k)
@@ -1545,6 +4297,8 @@ def print_users(users):
         limits = user['limits']
         limits = '{' + ';'.join(['%s:%s' % (y,limits[y]) for y in limits]) +'}'
         udata[uname]['limits'] = limits
+        if 'usage' in lens:
+            udata[uname]['usage'] = '%.0f' % user.get('usage',0.0)
 
         for k in lens:
             lens[k] = max( lens[k],len(str(udata[uname][k])) )
@@ -1552,6 +4306,8 @@ def print_users(users):
     fmt =  ' %(user)-'+str(lens['user'])+'s'
     fmt += '  %(Njobs)-'+str(lens['Njobs'])+'s'
     fmt += '  %(Ncores)-'+str(lens['Ncores'])+'s'
+    if 'usage' in lens:
+        fmt += '  %(usage)-'+str(lens['usage'])+'s'
     fmt += '  %(limits)-'+str(lens['limits'])+'s'
 
     hdr = {}
@@ -1561,3 +4317,37 @@ def print_users(users):
     for uname in sorted(udata):
         print( fmt % udata[uname] )
 
+
+def print_metrics(metrics):
+    """
+    input is the response to the metrics command.  Times are shown in
+    milliseconds; the percentiles are the upper bounds of their buckets
+    """
+    hists = []
+    values = []
+    for name in sorted(metrics):
+        entries = metrics[name]
+        if not isinstance(entries, dict) or 'buckets' in entries:
+            entries = {'':entries}
+        scale = 1000.0 if name.endswith('_seconds') else 1.0
+        for labels in sorted(entries):
+            value = entries[labels]
+            if labels:
+                label = '%s{%s}' % (name, labels)
+            else:
+                label = name
+            if isinstance(value, dict):
+                hists.append((label, value['count']) +
+                             tuple('%.3f' % (value[k]*scale) for k in
+                                   ('mean','p50','p90','p99')))
+            else:
+                values.append((label, value))
+
+    width = max([len(h[0]) for h in hists+values] + [4])
+    fmt = ' %-'+str(width)+'s %9s %10s %10s %10s %10s'
+    print( fmt % ('Name','Count','Mean','p50','p90','p99') )
+    for h in hists:
+        print( fmt % h )
+    print()
+    for label,value in values:
+        print( (' %-'+str(width)+'s %s') % (label,value) )
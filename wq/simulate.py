@@ -0,0 +1,821 @@
+"""
+Run the scheduler on a simulated cluster and workload, and report how fast it
+schedules and how well.
+
+    python -m wq.simulate --nodes 2000 --jobs 20000 --seed 1
+
+The JobQueue is the one the server uses, driven with the messages clients
+send: a sub for each job, and a notify when it ends.  Time is simulated, so
+hours of work run in seconds; the clock of the scheduler is set with
+server.set_clock(), and whether client pids are alive is answered by the
+simulation instead of /proc.  As in the server, the queue is also refreshed
+when no message arrived for the refresh interval.
+
+The cluster is a synthetic one, or a description file given with --cluster.
+The workload is synthetic, or replayed from a YAML list of jobs written with
+--save-workload or by hand:
+
+    - {time: 0.0, user: anze, runtime: 3600, require: {N: 4}}
+    - {time: 12.5, user: esheldon, runtime: 600, require: {mode: bynode, N: 2}}
+
+time is when the job is submitted, runtime how long it runs once started.
+With the same seed and options the same jobs start at the same times, so the
+scheduling results repeat exactly and the timings can be compared between
+versions.
+
+With --memory the memory kept per waiting job is measured instead:
+
+    python -m wq.simulate --memory 10000,100000,1000000
+
+With --compare the workload is run with each way the queue can schedule the
+same jobs, the full and incremental schedulers, with and without the match
+memo and with the blocked groups rebuilt on every use, and the jobs must
+start at the same times on the same hosts in each.  Backfill must change
+nothing when no job gives a walltime, and when every job runs until its
+walltime it may not delay a block job waiting alone:
+
+    python -m wq.simulate --nodes 200 --jobs 5000 --block-all 0.5 --compare
+"""
+from __future__ import print_function
+
+import contextlib
+import gc
+import heapq
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from optparse import OptionParser
+
+import yaml
+
+from . import placement
+from . import server
+
+# the simulated clock starts here
+START_TIME = 1500000000.0
+
+# first pid given to the simulated clients
+FIRST_PID = 1000
+
+DEFAULT_NNODES = 1000
+DEFAULT_NJOBS = 10000
+DEFAULT_NUSERS = 10
+DEFAULT_NGROUPS = 8
+DEFAULT_LOAD = 1.2
+DEFAULT_RUNTIME = 3600.0
+
+class SimClock:
+    """
+    The simulated time, read by the scheduler through server.set_clock()
+    """
+    def __init__(self, now=START_TIME):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+class SimLiveness:
+    """
+    Stands in for server.Liveness: the pids of the simulated clients that
+    are alive
+    """
+    def __init__(self):
+        self.pids = set()
+        self.nchecks = 0
+
+    def snapshot(self):
+        pass
+
+    def clear(self):
+        pass
+
+    def exists(self, pid):
+        self.nchecks += 1
+        return pid in self.pids
+
+    def stats(self):
+        return {'nsnapshots':0,
+                'nchecks':self.nchecks,
+                'nsyscalls':0,
+                'nsaved':self.nchecks}
+
+class SimQueue(server.JobQueue):
+    """
+    A JobQueue that times its refreshes and tells the simulation when jobs
+    start and stop using cores
+    """
+    def __init__(self, cluster_file, sim, **keys):
+        self.sim = sim
+        self.refresh_depth = 0
+        server.JobQueue.__init__(self, cluster_file, **keys)
+        self.liveness = sim.liveness
+
+    def refresh(self):
+        # refreshes run from inside a request are timed with the request
+        if self.refresh_depth > 0 or self.sim.in_request:
+            return server.JobQueue.refresh(self)
+
+        self.refresh_depth += 1
+        tm0 = time.perf_counter()
+        try:
+            server.JobQueue.refresh(self)
+        finally:
+            self.refresh_depth -= 1
+            self.sim.refresh_times.append(time.perf_counter()-tm0)
+
+    def _start_job(self, job, batch=None):
+        server.JobQueue._start_job(self, job, batch)
+        self.sim.job_started(job)
+
+    def _match_job(self, job, blocked_groups):
+        if not self.sim.memo:
+            # forget the remembered failures, so every job is matched
+            self.match_memo_version = None
+        server.JobQueue._match_job(self, job, blocked_groups)
+
+    def _blocked_groups(self):
+        if not self.sim.scan_blocked:
+            return server.JobQueue._blocked_groups(self)
+
+        # from the waiting block jobs themselves, not the kept counts, as
+        # names: a block job naming no group blocks the first group of every
+        # node, where the queue takes every group of every node
+        names = set()
+        block_all = False
+        for job in self.jobs.values():
+            if job.priority == 'block' and job.status == 'wait':
+                if job.spec.groups:
+                    names.update(job.spec.groups)
+                else:
+                    block_all = True
+        if block_all:
+            for nd in self.cluster.nodes.values():
+                if nd.grps:
+                    names.add(nd.grps[0])
+        return self.cluster.group_mask(names)
+
+    def _unreserve_job_and_decrement_user(self, job):
+        if job.status == 'run':
+            self.sim.used -= server.alloc_ncores(job.hosts)
+        server.JobQueue._unreserve_job_and_decrement_user(self, job)
+
+class Simulator:
+    """
+    Run the workload, a list of jobs as described in the module doc, through
+    a JobQueue for the cluster description file.  keys are passed to the
+    JobQueue, e.g. scheduler, engine, placement, backfill and fairshare.
+
+    crash_fraction of the jobs end without notifying the server, so they are
+    only found by a refresh checking pids.
+
+    For comparing the ways of scheduling, memo=False makes the queue match
+    every job instead of remembering failed requirements, and scan_blocked
+    makes it find the names of the blocked groups from the waiting block
+    jobs each time
+    """
+    def __init__(self, cluster_file, workload,
+                 refresh_interval=server.DEFAULT_SOCK_TIMEOUT,
+                 crash_fraction=0.0, seed=0, memo=True, scan_blocked=False,
+                 **keys):
+        self.cluster_file = cluster_file
+        self.workload = sorted(workload, key=lambda j: j['time'])
+        self.refresh_interval = refresh_interval
+        self.crash_fraction = crash_fraction
+        self.seed = seed
+        self.memo = memo
+        self.scan_blocked = scan_blocked
+        self.keys = keys
+
+    def run(self):
+        """
+        Run the simulation and return the results, see print_report()
+        """
+        self.clock = SimClock()
+        self.liveness = SimLiveness()
+        self.rng = random.Random(self.seed)
+
+        # (time, order, kind, pid) of the submits and job ends to come
+        self.events = []
+        self.norder = 0
+        self.jobs = {}
+        self.used = 0
+        self.in_request = False
+
+        self.refresh_times = []
+        self.request_times = {'sub':[], 'notify':[]}
+        self.waits = []
+        self.nstarted = 0
+        # (time, pid, hosts) of each job started, in order
+        self.starts = []
+
+        for i,job in enumerate(self.workload):
+            self._push(START_TIME+job['time'], 'sub', FIRST_PID+i)
+
+        spool_dir = tempfile.mkdtemp(prefix='wqsim-')
+        server.set_clock(self.clock)
+        try:
+            with open(os.devnull,'w') as devnull, \
+                    contextlib.redirect_stdout(devnull):
+                self.queue = SimQueue(self.cluster_file, self,
+                                      spool_dir=spool_dir, fsync=False,
+                                      **self.keys)
+                try:
+                    self._loop()
+                finally:
+                    self.queue.persister.stop()
+                    self.queue.journal.close()
+        finally:
+            server.set_clock(None)
+            shutil.rmtree(spool_dir, ignore_errors=True)
+
+        return self._results()
+
+    def _push(self, when, kind, pid):
+        self.norder += 1
+        heapq.heappush(self.events, (when, self.norder, kind, pid))
+
+    def _loop(self):
+        cluster = self.queue.cluster
+        self.ncores = sum(nd.ncores for nd in cluster.nodes.values()
+                          if nd.online)
+        self.core_seconds = 0.0
+        last = START_TIME
+        while True:
+            if not self.events:
+                if not self.queue.jobs:
+                    break
+                # jobs are left; a refresh may find crashed ones and start
+                # the rest
+                self._advance(last+self.refresh_interval)
+                self.queue.refresh()
+                self.queue.flush()
+                if not self.events:
+                    break
+                last = self.clock.now
+            when = self.events[0][0]
+
+            # the server refreshes when no message came for a while; with
+            # nothing running and nothing to come nothing can change
+            while when-last > self.refresh_interval and self.queue.jobs:
+                self._advance(last+self.refresh_interval)
+                last = self.clock.now
+                self.queue.refresh()
+                self.queue.flush()
+
+            when, order, kind, pid = heapq.heappop(self.events)
+            self._advance(when)
+            last = when
+            if kind == 'sub':
+                self._submit(pid)
+            else:
+                self._end(pid)
+
+        self.end_time = self.clock.now
+
+    def _advance(self, when):
+        self.core_seconds += self.used*(when-self.clock.now)
+        self.clock.now = when
+
+    def _request(self, message):
+        self.in_request = True
+        tm0 = time.perf_counter()
+        try:
+            self.queue.process_message(message)
+        finally:
+            self.in_request = False
+        self.request_times[message['command']].append(time.perf_counter()-tm0)
+        return self.queue.get_response()
+
+    def _submit(self, pid):
+        job = self.workload[pid-FIRST_PID]
+        self.jobs[pid] = job
+        self.liveness.pids.add(pid)
+        resp = self._request({'command':'sub',
+                              'pid':pid,
+                              'user':job.get('user','sim'),
+                              'require':job['require'],
+                              'commandline':job.get('commandline','sim')})
+        if 'error' in resp:
+            # never matches; the client gives up
+            self.liveness.pids.discard(pid)
+
+    def job_started(self, job):
+        pid = job.pid
+        self.used += server.alloc_ncores(job.hosts)
+        self.nstarted += 1
+        self.waits.append(self.clock.now-job.time_sub)
+        self.starts.append((self.clock.now, pid, job.hosts))
+        runtime = self.jobs[pid].get('runtime',server.DEFAULT_SOCK_TIMEOUT)
+        self._push(self.clock.now+runtime, 'end', pid)
+
+    def _end(self, pid):
+        self.liveness.pids.discard(pid)
+        if self.rng.random() < self.crash_fraction:
+            # found by a later refresh
+            return
+        self._request({'command':'notify', 'notification':'done', 'pid':pid})
+
+    def _results(self):
+        span = self.end_time-START_TIME
+        busy = sum(self.refresh_times)
+        for times in self.request_times.values():
+            busy += sum(times)
+
+        res = {'nnodes':len(self.queue.cluster.nodes),
+               'ncores':self.ncores,
+               'njobs':len(self.workload),
+               'nstarted':self.nstarted,
+               'nleft':len(self.queue.jobs),
+               'keys':dict(self.keys),
+               'simulated_seconds':span,
+               'scheduler_seconds':busy,
+               'throughput':self.nstarted/busy if busy > 0 else 0.0,
+               'utilization':(self.core_seconds/(span*self.ncores)
+                              if span > 0 and self.ncores > 0 else 0.0),
+               'wait':distribution(self.waits),
+               'refresh':distribution(self.refresh_times)}
+        for command,times in self.request_times.items():
+            res[command] = distribution(times)
+        return res
+
+def compare(cluster_file, workload, variants, **keys):
+    """
+    Run the workload with each of the variants, a label and keys for the
+    Simulator added to keys, and compare the jobs started with those of the
+    first.  Returns the number of jobs the first started, and None if all
+    started the same, or the label of the first that did not, the index of
+    its first different start and that start
+    """
+    first = None
+    for label,vkeys in variants:
+        sim = Simulator(cluster_file, workload, **dict(keys, **vkeys))
+        sim.run()
+        if first is None:
+            first = sim.starts
+            continue
+        for i in range(max(len(first), len(sim.starts))):
+            if i >= len(first) or i >= len(sim.starts) \
+                    or first[i] != sim.starts[i]:
+                start = sim.starts[i] if i < len(sim.starts) else None
+                return len(first), (label, i, start)
+    return len(first), None
+
+def comparisons(workload, scheduler_keys):
+    """
+    The groups of variants compare() runs, with their workload: each way of
+    scheduling gives the same starts, with and without fair-share, and
+    backfill changes nothing when no job gives a walltime
+    """
+    groups = []
+    for fairshare in (False, True):
+        variants = []
+        for scheduler in ('full','incremental'):
+            variants.append((scheduler,
+                             {'scheduler':scheduler}))
+            variants.append((scheduler+' no-memo',
+                             {'scheduler':scheduler, 'memo':False}))
+            variants.append((scheduler+' scan-blocked',
+                             {'scheduler':scheduler, 'scan_blocked':True}))
+        keys = dict(scheduler_keys, fairshare=fairshare)
+        groups.append(('fairshare' if fairshare else 'priority',
+                       workload, keys, variants))
+
+    untimed = []
+    for job in workload:
+        job = dict(job, require=dict(job['require']))
+        job['require'].pop('walltime', None)
+        untimed.append(job)
+    for scheduler in ('full','incremental'):
+        keys = dict(scheduler_keys, scheduler=scheduler)
+        variants = [('no backfill', {'backfill':False}),
+                    ('backfill', {'backfill':True})]
+        groups.append(('%s without walltimes' % scheduler,
+                       untimed, keys, variants))
+    return groups
+
+def backfill_delays(cluster_file, workload, **keys):
+    """
+    Run the workload without and with backfill, every job giving its runtime
+    as its walltime, so the start times backfill works out are exact, and
+    compare the starts of the block jobs backfill must not delay.
+
+    Those are the block jobs submitted before the first job started
+    differently, as later ones find other jobs running, that waited with no
+    other block job waiting, as block jobs may start on the nodes held for
+    each other
+
+    Returns the number of jobs backfilled, the number of block jobs
+    compared, and the (pid, start, start with backfill) of those that
+    started later with backfill, or never
+    """
+    timed = []
+    for job in workload:
+        job = dict(job, require=dict(job['require']))
+        job['require']['walltime'] = job['runtime']
+        timed.append(job)
+
+    runs = []
+    for backfill in (False, True):
+        keys['backfill'] = backfill
+        sim = Simulator(cluster_file, timed, **keys)
+        sim.run()
+        runs.append(sim.starts)
+
+    # when the runs part
+    apart = None
+    for first,second in zip(*runs):
+        if first != second:
+            apart = min(first[0], second[0])
+            break
+
+    # when each block job waited, in either run
+    starts = [dict((pid,when) for when,pid,hosts in run) for run in runs]
+    waits = {}
+    for i,job in enumerate(sim.workload):
+        if job['require'].get('priority') == 'block':
+            pid = FIRST_PID+i
+            ends = [run.get(pid, float('inf')) for run in starts]
+            waits[pid] = (START_TIME+job['time'], max(ends))
+
+    ncompared = 0
+    late = []
+    for pid,(sub,end) in sorted(waits.items()):
+        if apart is not None and sub >= apart:
+            continue
+        if any(osub < end and oend > sub
+               for opid,(osub,oend) in waits.items() if opid != pid):
+            continue
+        ncompared += 1
+        start, bfstart = starts[0].get(pid), starts[1].get(pid)
+        if start is not None and (bfstart is None or bfstart > start):
+            late.append((pid, start, bfstart))
+    return sim.queue.nbackfilled, ncompared, late
+
+def distribution(values):
+    """
+    The count, mean, median, 90th and 99th percentiles and maximum
+    """
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return {'n':0, 'mean':0.0, 'p50':0.0, 'p90':0.0, 'p99':0.0,
+                'max':0.0}
+
+    def percentile(p):
+        return values[min(n-1, int(p*n/100.0))]
+
+    return {'n':n,
+            'mean':sum(values)/n,
+            'p50':percentile(50),
+            'p90':percentile(90),
+            'p99':percentile(99),
+            'max':values[-1]}
+
+def write_cluster(fname, nnodes, seed=0, ngroups=DEFAULT_NGROUPS):
+    """
+    Write the description of a synthetic cluster: nodes of 8 to 32 cores in
+    ngroups racks of consecutive nodes, with some large memory nodes
+    """
+    rng = random.Random(seed)
+    with open(fname,'w') as fobj:
+        for i in range(nnodes):
+            ncores = rng.choice([8,12,16,16,24,32])
+            mem = ncores*rng.choice([2,4,4,8])
+            groups = ['rack%d' % (i*ngroups//nnodes)]
+            if mem >= 128:
+                groups.append('bigmem')
+            fobj.write('node%05d %d %d %s\n'
+                       % (i, ncores, mem, ','.join(groups)))
+
+def synthetic_workload(cluster, njobs, seed=0, nusers=DEFAULT_NUSERS,
+                       load=DEFAULT_LOAD, runtime=DEFAULT_RUNTIME,
+                       walltime_fraction=0.5, block_all_fraction=0.0):
+    """
+    A mix of the job types of the README for the Cluster: mostly bycore jobs
+    of a few cores, some with threads, groups or a priority, and bycore1,
+    bynode and block jobs.  A few users submit most of the jobs.
+    block_all_fraction of the block jobs name no group, blocking all.
+
+    Runtimes are exponential with the given mean; walltime_fraction of the
+    jobs give a walltime of one to two times their runtime.  Jobs arrive at
+    random, at the rate that asks for load times the cores of the cluster
+    """
+    rng = random.Random(seed)
+    users = ['user%02d' % i for i in range(nusers)]
+    weights = [1.0/(i+1) for i in range(nusers)]
+    racks = sorted(g for g in cluster.group_bits if g.startswith('rack'))
+    if not racks:
+        racks = sorted(cluster.group_bits)
+    ncores = [nd.ncores for nd in cluster.nodes.values()]
+    node_cores = float(sum(ncores))/max(len(ncores),1)
+
+    jobs = []
+    demand = 0.0
+    for i in range(njobs):
+        r = rng.random()
+        if r < 0.55:
+            req = {'N':rng.choice([1,1,1,2,4,8])}
+        elif r < 0.65:
+            threads = rng.choice([2,4])
+            req = {'N':threads*rng.randint(1,4), 'threads':threads}
+        elif r < 0.75:
+            req = {'mode':'bycore1', 'N':rng.choice([1,2,4,8])}
+        elif r < 0.85 and racks:
+            req = {'N':rng.choice([1,2,4]), 'group':rng.choice(racks)}
+        elif r < 0.93:
+            req = {'N':rng.choice([1,2,4]), 'priority':'high'}
+        elif r < 0.995 or not racks:
+            req = {'mode':'bynode', 'N':rng.choice([1,1,2])}
+        else:
+            req = {'mode':'bynode', 'N':rng.choice([2,4]),
+                   'group':rng.choice(racks), 'priority':'block'}
+            if block_all_fraction > 0 and rng.random() < block_all_fraction:
+                del req['group']
+
+        if req.get('mode') == 'bynode':
+            demand += req['N']*node_cores
+        else:
+            demand += req['N']
+
+        jobrun = max(1.0, round(rng.expovariate(1.0/runtime)))
+        if rng.random() < walltime_fraction:
+            req['walltime'] = int(jobrun*rng.uniform(1.0, 2.0))+1
+
+        jobs.append({'user':rng.choices(users, weights)[0],
+                     'runtime':jobrun,
+                     'require':req})
+
+    # the mean time between submits that asks for load times the cores
+    total = float(sum(ncores))
+    if njobs > 0 and total > 0:
+        interval = (demand/njobs)*runtime/(load*total)
+    else:
+        interval = 1.0
+    now = 0.0
+    for job in jobs:
+        job['time'] = round(now, 3)
+        now += rng.expovariate(1.0/interval)
+    return jobs
+
+def memory_benchmark(cluster_file, counts, seed=0):
+    """
+    The memory kept per waiting job for each of the counts of jobs.  The
+    jobs of a synthetic workload are sent as JSON and made from the decoded
+    messages, as the server makes them, and matched against the cluster with
+    every core in use, so they wait with a reason as in a long queue.
+
+    Returns (njobs, rss bytes, traced bytes) per job for each count.  The
+    rss is the growth of the resident size, None where /proc is not
+    available; the traced size is what tracemalloc finds allocated, from a
+    second build as tracing slows it and adds to the rss
+    """
+    with open(os.devnull,'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        cluster = server.Cluster(cluster_file)
+    for nd in cluster.nodes.values():
+        if nd.used < nd.ncores:
+            nd.reserve(nd.ncores-nd.used)
+
+    results = []
+    for njobs in counts:
+        workload = synthetic_workload(cluster, njobs, seed=seed)
+        messages = [json.dumps({'command':'sub',
+                                'pid':FIRST_PID+i,
+                                'user':job['user'],
+                                'require':job['require'],
+                                'commandline':'sim --seed %d' % i})
+                    for i,job in enumerate(workload)]
+        del workload
+
+        gc.collect()
+        rss0 = _rss()
+        jobs = _waiting_jobs(cluster, messages)
+        rss = _rss()
+        if rss is not None:
+            rss = float(rss-rss0)/njobs
+        del jobs
+        gc.collect()
+
+        tracemalloc.start()
+        try:
+            traced0 = tracemalloc.get_traced_memory()[0]
+            jobs = _waiting_jobs(cluster, messages)
+            traced = float(tracemalloc.get_traced_memory()[0]-traced0)/njobs
+        finally:
+            tracemalloc.stop()
+        del jobs
+        gc.collect()
+
+        results.append((njobs, rss, traced))
+    return results
+
+def _waiting_jobs(cluster, messages):
+    jobs = {}
+    for text in messages:
+        job = server.Job(json.loads(text), spool_dir=server.DEFAULT_SPOOL_DIR)
+        job.match(cluster, 0)
+        jobs[job.pid] = job
+    return jobs
+
+def _rss():
+    """
+    The resident size of this process in bytes, or None
+    """
+    try:
+        with open('/proc/self/statm') as fobj:
+            pages = int(fobj.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages*os.sysconf('SC_PAGE_SIZE')
+
+def print_memory(results, fobj=sys.stdout):
+    """
+    Print the results of memory_benchmark()
+    """
+    fmt = ' %10s %14s %14s'
+    print( fmt % ('jobs','rss B/job','traced B/job'), file=fobj )
+    for njobs,rss,traced in results:
+        print( fmt % (njobs, 'n/a' if rss is None else '%.0f' % rss,
+                      '%.0f' % traced), file=fobj )
+
+def load_workload(fname):
+    with open(fname) as fobj:
+        return yaml.safe_load(fobj)
+
+def save_workload(jobs, fname):
+    with open(fname,'w') as fobj:
+        yaml.safe_dump(jobs, fobj, default_flow_style=None)
+
+def print_report(res, fobj=sys.stdout):
+    """
+    Print the results of Simulator.run()
+    """
+    keys = ' '.join('%s=%s' % (k,res['keys'][k]) for k in sorted(res['keys']))
+    print( 'cluster: %(nnodes)d nodes, %(ncores)d cores' % res, file=fobj )
+    print( 'options: %s' % (keys or 'defaults'), file=fobj )
+    print( 'jobs: %(njobs)d submitted, %(nstarted)d started, '
+           '%(nleft)d never ran' % res, file=fobj )
+    print( 'simulated time: %.0f s' % res['simulated_seconds'], file=fobj )
+    print( 'utilization: %.1f%%' % (100.0*res['utilization']), file=fobj )
+    print( 'scheduler time: %.3f s, %.0f jobs started per second'
+           % (res['scheduler_seconds'], res['throughput']), file=fobj )
+    print( file=fobj )
+
+    fmt = ' %-10s %8s %10s %10s %10s %10s %10s'
+    print( fmt % ('','n','mean','p50','p90','p99','max'), file=fobj )
+    rows = [('wait s', res['wait'], 1.0),
+            ('refresh ms', res['refresh'], 1000.0),
+            ('sub ms', res['sub'], 1000.0),
+            ('notify ms', res['notify'], 1000.0)]
+    for name,dist,scale in rows:
+        print( fmt % ((name, dist['n']) +
+                      tuple('%.3f' % (dist[k]*scale) for k in
+                            ('mean','p50','p90','p99','max'))),
+               file=fobj )
+
+def main(args=None):
+    parser = OptionParser(__doc__.split('\n\n')[1])
+    parser.add_option("--nodes", type=int, default=DEFAULT_NNODES,
+                      help="nodes in the synthetic cluster, default %default")
+    parser.add_option("--cluster", default=None,
+                      help="use this cluster description file instead")
+    parser.add_option("--jobs", type=int, default=DEFAULT_NJOBS,
+                      help="jobs in the synthetic workload, default %default")
+    parser.add_option("--workload", default=None,
+                      help="replay the jobs in this YAML file instead")
+    parser.add_option("--save-workload", default=None,
+                      help="write the workload to this YAML file")
+    parser.add_option("--users", type=int, default=DEFAULT_NUSERS,
+                      help="users in the synthetic workload, default %default")
+    parser.add_option("--load", type=float, default=DEFAULT_LOAD,
+                      help=("cores asked for over cores in the cluster, "
+                            "default %default"))
+    parser.add_option("--block-all", type=float, default=0.0,
+                      help=("fraction of the block jobs that name no group, "
+                            "so block all, default %default"))
+    parser.add_option("--runtime", type=float, default=DEFAULT_RUNTIME,
+                      help="mean job runtime in seconds, default %default")
+    parser.add_option("--seed", type=int, default=0,
+                      help="random seed, default %default")
+    parser.add_option("--crash-fraction", type=float, default=0.0,
+                      help=("fraction of jobs that end without telling the "
+                            "server, default %default"))
+    parser.add_option("--refresh-interval", type=float,
+                      default=server.DEFAULT_SOCK_TIMEOUT,
+                      help=("seconds without messages before the queue is "
+                            "refreshed, default %default"))
+    parser.add_option("--scheduler", default=server.DEFAULT_SCHEDULER,
+                      help="'full' or 'incremental', default %default")
+    parser.add_option("--engine", default=server.DEFAULT_ENGINE,
+                      help="'python', 'numpy' or 'check', default %default")
+    parser.add_option("--placement", default=server.DEFAULT_PLACEMENT,
+                      help=("one of "
+                            + ",".join(sorted(placement.POLICIES))
+                            + ", default %default"))
+    parser.add_option("--backfill", action='store_true',
+                      help="backfill around block jobs")
+    parser.add_option("--fairshare", action='store_true',
+                      help="fair-share ordering of the users")
+    parser.add_option("--compare", action='store_true',
+                      help=("check the ways of scheduling start the same "
+                            "jobs at the same times on the same hosts"))
+    parser.add_option("--memory", default=None,
+                      help=("measure the memory per waiting job for these "
+                            "comma separated numbers of jobs instead"))
+    parser.add_option("--yaml", action='store_true',
+                      help="print the results as YAML")
+
+    options, args = parser.parse_args(args)
+    if options.compare and options.crash_fraction > 0:
+        # the full scheduler checks pids on every request, the incremental
+        # one on its refreshes, so crashed jobs are found at other times
+        parser.error("--compare needs every job to notify the server, "
+                     "without --crash-fraction")
+
+    tmpdir = tempfile.mkdtemp(prefix='wqsim-')
+    try:
+        cluster_file = options.cluster
+        if cluster_file is None:
+            cluster_file = os.path.join(tmpdir, 'cluster.txt')
+            write_cluster(cluster_file, options.nodes, seed=options.seed)
+
+        if options.memory is not None:
+            counts = [int(n) for n in options.memory.split(',')]
+            res = memory_benchmark(cluster_file, counts, seed=options.seed)
+            if options.yaml:
+                print( yaml.safe_dump([list(r) for r in res],
+                                      default_flow_style=False) )
+            else:
+                print_memory(res)
+            return
+
+        if options.workload is not None:
+            workload = load_workload(options.workload)
+        else:
+            workload = synthetic_workload(server.Cluster(cluster_file),
+                                          options.jobs,
+                                          seed=options.seed,
+                                          nusers=options.users,
+                                          load=options.load,
+                                          runtime=options.runtime,
+                                          block_all_fraction=options.block_all)
+        if options.save_workload is not None:
+            save_workload(workload, options.save_workload)
+
+        if options.compare:
+            scheduler_keys = {'engine':options.engine,
+                              'placement':options.placement,
+                              'backfill':bool(options.backfill)}
+            groups = comparisons(workload, scheduler_keys)
+            for name,jobs,keys,variants in groups:
+                nstarted, diff = compare(
+                    cluster_file, jobs, variants,
+                    refresh_interval=options.refresh_interval,
+                    seed=options.seed, **keys)
+                if diff is not None:
+                    label, i, start = diff
+                    sys.exit("%s: %s differs from %s at start %d: %s"
+                             % (name, label, variants[0][0], i, start))
+                print( "%s: %d jobs started the same by %s"
+                       % (name, nstarted,
+                          ', '.join(label for label,vkeys in variants)) )
+
+            nbackfilled, ncompared, late = backfill_delays(
+                cluster_file, workload,
+                refresh_interval=options.refresh_interval,
+                seed=options.seed,
+                engine=options.engine,
+                placement=options.placement,
+                scheduler=options.scheduler)
+            if late:
+                sys.exit("block jobs started later with backfill, "
+                         "(pid, start, start with backfill): %s" % late)
+            print( "backfill: %d jobs backfilled, none of %d block jobs "
+                   "started later" % (nbackfilled, ncompared) )
+            return
+
+        sim = Simulator(cluster_file, workload,
+                        refresh_interval=options.refresh_interval,
+                        crash_fraction=options.crash_fraction,
+                        seed=options.seed,
+                        scheduler=options.scheduler,
+                        engine=options.engine,
+                        placement=options.placement,
+                        backfill=bool(options.backfill),
+                        fairshare=bool(options.fairshare))
+        res = sim.run()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if options.yaml:
+        print( yaml.safe_dump(res, default_flow_style=False) )
+    else:
+        print_report(res)
+
+if __name__ == '__main__':
+    main()
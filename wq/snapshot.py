@@ -0,0 +1,139 @@
+"""
+Binary snapshot file of named sections.
+
+    header   magic, format version, journal generation, body size, crc32
+    body     sections, each a name, size and payload padded to 8 bytes
+
+Numeric columns are stored as raw arrays in native byte order so they can be
+used straight from the memory map; the rest are pickles.  The whole body is
+checked against the crc32 before anything is used.
+"""
+import mmap
+import struct
+import zlib
+from array import array
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+MAGIC = b'WQSNAP\r\n'
+VERSION = 2
+
+_HEADER = struct.Struct('<8sIQQI4x')   # magic, version, gen, size, crc32
+_SECTION = struct.Struct('<4s4xQ')     # name, size
+
+def is_snapshot(fname):
+    """
+    True if the file starts like a snapshot written by write()
+    """
+    with open(fname,'rb') as fobj:
+        return fobj.read(len(MAGIC)) == MAGIC
+
+def write(fobj, gen, sections):
+    """
+    Write the (name, bytes) sections to the open file
+    """
+    parts = []
+    for name, data in sections:
+        if len(name) != 4:
+            raise ValueError("section names have 4 characters: %r" % name)
+        parts.append(_SECTION.pack(name, len(data)))
+        parts.append(data)
+        pad = -len(data) % 8
+        if pad:
+            parts.append(b'\0'*pad)
+
+    size = 0
+    crc = 0
+    for part in parts:
+        size += len(part)
+        crc = zlib.crc32(part, crc)
+
+    fobj.write(_HEADER.pack(MAGIC, VERSION, gen, size, crc & 0xffffffff))
+    for part in parts:
+        fobj.write(part)
+
+class Snapshot:
+    """
+    A snapshot file mapped into memory.  sections maps names to memoryviews
+    of the payloads, valid until close()
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname,'rb') as fobj:
+            self.map = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.sections = {}
+
+        # views into the map, released before it is closed
+        self._views = []
+
+        try:
+            self._read()
+        except:
+            self.close()
+            raise
+
+    def _read(self):
+        view = self.view
+        if len(view) < _HEADER.size:
+            raise ValueError("snapshot too short: %s" % self.fname)
+
+        magic, version, gen, size, crc = _HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError("not a snapshot file: %s" % self.fname)
+        if version != VERSION:
+            raise ValueError("snapshot %s has version %d, expected %d"
+                             % (self.fname, version, VERSION))
+
+        start = _HEADER.size
+        body = view[start:start+size]
+        self._views.append(body)
+        if len(body) != size or (zlib.crc32(body) & 0xffffffff) != crc:
+            raise ValueError("corrupt snapshot file: %s" % self.fname)
+
+        self.gen = gen
+        pos = 0
+        while pos < size:
+            name, nbytes = _SECTION.unpack_from(body, pos)
+            pos += _SECTION.size
+            section = body[pos:pos+nbytes]
+            self._views.append(section)
+            self.sections[name] = section
+            pos += nbytes + (-nbytes % 8)
+
+    def __getitem__(self, name):
+        return self.sections[name]
+
+    def __contains__(self, name):
+        return name in self.sections
+
+    def array(self, name, typecode):
+        """
+        Copy a numeric column out of the map
+        """
+        arr = array(typecode)
+        arr.frombytes(self.sections[name])
+        return arr
+
+    def load(self, name):
+        """
+        Unpickle a section
+        """
+        return pickle.loads(self.sections[name])
+
+    def close(self):
+        self.sections = {}
+        for view in self._views:
+            view.release()
+        self._views = []
+        self.view.release()
+        self.map.close()
+
+def pack_array(typecode, values):
+    return array(typecode, values).tobytes()
+
+def dumps(obj):
+    return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,142 @@
+"""
+NumPy versions of the searches the matchers make over the nodes, for large
+clusters.
+
+The cores, usage, online state and groups of the nodes are kept in arrays in
+host order, and the greedy fill of bycore, the free node selection of bynode
+and the first fit of bycore1 become masks and cumulative sums over the
+candidate nodes.  The results are the same hosts the pure Python loops in
+Job pick, which remain in use when NumPy is not installed.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# blocked node masks kept for this many different blocked group masks
+_MAX_BLOCKED_CACHE = 64
+
+class ClusterArrays:
+    def __init__(self, cluster):
+        nodes = cluster.nodes
+        hostnames = cluster.hostnames
+        self.hostnames = numpy.array(hostnames, dtype=object)
+        self.host_order = cluster.host_order
+
+        self.ncores = numpy.array([nodes[h].ncores for h in hostnames],
+                                  dtype=numpy.int64)
+        self.used = numpy.array([nodes[h].used for h in hostnames],
+                                dtype=numpy.int64)
+        self.online = numpy.array([nodes[h].online for h in hostnames],
+                                  dtype=bool)
+
+        # node by group bit, any number of groups
+        self.groups = numpy.zeros((len(hostnames), len(cluster.group_bits)),
+                                  dtype=bool)
+        for i,h in enumerate(hostnames):
+            for g in nodes[h].grps:
+                self.groups[i, cluster.group_bits[g]] = True
+
+        self._blocked = {}
+
+    def node_changed(self, nd):
+        i = self.host_order[nd.host]
+        self.used[i] = nd.used
+        self.online[i] = nd.online
+
+    def index(self, hosts):
+        """
+        The array positions of the hosts
+        """
+        return numpy.array([self.host_order[h] for h in hosts],
+                           dtype=numpy.intp)
+
+    def blocked(self, bmask):
+        """
+        Which nodes are in the groups of the mask, or None if it is empty
+        """
+        if not bmask:
+            return None
+        blocked = self._blocked.get(bmask)
+        if blocked is None:
+            bits = [b for b in range(self.groups.shape[1]) if bmask >> b & 1]
+            blocked = self.groups[:, bits].any(axis=1)
+            if len(self._blocked) >= _MAX_BLOCKED_CACHE:
+                self._blocked.clear()
+            self._blocked[bmask] = blocked
+        return blocked
+
+    def _unblocked(self, idx, bmask):
+        blocked = self.blocked(bmask)
+        if blocked is None:
+            return None
+        return ~blocked[idx]
+
+    def _alloc(self, sel, ncores):
+        """
+        The [host, ncores] runs for the nodes at sel
+        """
+        return [[h,n] for h,n in zip(self.hostnames[sel].tolist(),
+                                     ncores.tolist())]
+
+    def fill_bycore(self, idx, N, threads, bmask):
+        """
+        Take free cores from the unblocked candidates at idx in host order, a
+        multiple of threads from each, until N are taken.  Returns match and
+        the [host, ncores] taken
+        """
+        free = self.ncores[idx] - self.used[idx]
+        unblocked = self._unblocked(idx, bmask)
+        if N <= 0:
+            # the first free node is enough
+            ok = free > 0
+            if unblocked is not None:
+                ok &= unblocked
+            return bool(ok.any()), []
+
+        usable = (free // threads) * threads
+        if unblocked is not None:
+            usable[~unblocked] = 0
+
+        cum = numpy.cumsum(usable)
+        if len(cum) == 0 or cum[-1] < N:
+            return False, []
+
+        # the first node where the running total reaches N
+        k = int(numpy.searchsorted(cum, N))
+        take = usable[:k+1]
+        take[k] = N - (cum[k-1] if k > 0 else 0)
+
+        nz = numpy.flatnonzero(take)
+        return True, self._alloc(idx[nz], take[nz])
+
+    def idle_nodes(self, idx, N, bmask):
+        """
+        The first N unblocked candidates with no used cores, each with all
+        its cores.  Returns match and the [host, ncores] runs
+        """
+        ok = self.used[idx] == 0
+        unblocked = self._unblocked(idx, bmask)
+        if unblocked is not None:
+            ok &= unblocked
+
+        sel = idx[ok][:N]
+        if len(sel) < N:
+            return False, []
+
+        return True, self._alloc(sel, self.ncores[sel])
+
+    def first_fit(self, idx, N, bmask):
+        """
+        The first unblocked candidate in host order with at least N, and at
+        least one, free cores, or None
+        """
+        ok = (self.ncores[idx] - self.used[idx]) >= max(N, 1)
+        unblocked = self._unblocked(idx, bmask)
+        if unblocked is not None:
+            ok &= unblocked
+
+        nz = numpy.flatnonzero(ok)
+        if len(nz) == 0:
+            return None
+        return self.hostnames[idx[nz[0]]]